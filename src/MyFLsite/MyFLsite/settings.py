@@ -148,3 +148,10 @@ CELERY_RESULT_BACKEND='djcelery.backends.database:DatabaseBackend'
 
 # FLAD settings
 FLAD_BACKUPFILE = 'FLADbackup' # Make sure django user has write access
+
+# MyFLq settings
+MYFLQ_CACHE_DIR = '/var/lib/myflsite/analysiscache/' #Cache of processed reads, keep outside MEDIA_ROOT and STATIC_ROOT
+    #as it holds the users' reads. Make sure it is owned by the celery user with mode 700, otherwise it is not used
+MYFLQ_CACHE_SIZE = 1024 #Maximum size of the cache in MB, least recently used analyses are removed first
+MYFLQ_PROFILE = False #Time the analysis stages and count the read outcomes (printed in the celery log),
+    #read processing is slower when profiled
@@ -6,18 +6,22 @@
 def login(user="""admin""", passwd="""passall""" ,database='', test=False):
     """
     Returns the formed connection with the db using variablenames: conn, sql
+    If database is an SQLite file (see isSQLite), user and passwd are not used.
     If test: just tests the connection, and closes it again returning None. 
         An exception should be raised automatically 
         if there's a problem with the connection.
     """
-    try: import pymysql as MySQLdb
-    except ImportError: import MySQLdb #py2#
-    conn = MySQLdb.connect(host = "localhost",
-                           user = user,
-                           passwd = passwd,
-                           db = database)
-    #conn.autocommit(True)
-    sql = conn.cursor(MySQLdb.cursors.DictCursor)
+    if isSQLite(database): conn = SQLiteConnection(database)
+    else:
+        try: import pymysql as MySQLdb
+        except ImportError: import MySQLdb #py2#
+        conn = MySQLdb.connect(host = "localhost",
+                               user = user,
+                               passwd = passwd,
+                               db = database,
+                               cursorclass = MySQLdb.cursors.DictCursor)
+        #conn.autocommit(True)
+    sql = conn.cursor()
     #sql.connection().autocommit(True)
     if not test: return (conn,sql)
     else: logout(conn, sql)
@@ -30,6 +34,146 @@ def logout(conn,sql):
     conn.commit()
     conn.close()
 
+#Embedded SQLite databases
+def isSQLite(database):
+    """
+    Databases given as 'sqlite:' followed by a file name, or as a file path (containing a /),
+    are embedded SQLite databases, that do not need a MySQL server (MySQL database names cannot contain a /).
+    """
+    import os
+    return database.startswith('sqlite:') or '/' in database or os.sep in database
+
+def sqlitePath(database):
+    """
+    Returns the file of an embedded SQLite database (see isSQLite).
+    In-memory databases are refused, as each connection (see MyFLq.Login) would get its own empty database.
+    """
+    if database.startswith('sqlite:'): database = database[len('sqlite:'):]
+    if database in ('',':memory:'):
+        raise ValueError('In-memory SQLite databases are not supported, provide a database file')
+    return database
+
+class SQLiteConnection:
+    """
+    Connection to an embedded SQLite database, with the methods of a pymysql connection
+    that are used by MyFLdb and MyFLq (cursor, commit, rollback, ping and close).
+    The MySQL functions used in the queries (getSeq, CONCAT and LAST_INSERT_ID) are registered on the connection.
+    """
+    def __init__(self,database):
+        import sqlite3
+        self.conn = sqlite3.connect(sqlitePath(database))
+        self.lastInsertID = 0 #first rowid of the last INSERT, as MySQL's LAST_INSERT_ID()
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.create_function('getSeq',1,self.getSeq)
+        self.conn.create_function('CONCAT',-1,lambda *args: None if None in args else ''.join(map(str,args)))
+        self.conn.create_function('LAST_INSERT_ID',0,lambda: self.lastInsertID)
+
+    def getSeq(self,seqID):
+        seq = self.conn.execute('SELECT sequence FROM BASEseqs WHERE seqID = ?',(seqID,)).fetchone()
+        return seq[0] if seq else None
+        
+    def cursor(self,cursorclass=None):
+        return SQLiteCursor(self)
+    def commit(self):
+        self.conn.commit()
+    def rollback(self):
+        self.conn.rollback()
+    def ping(self,reconnect=False):
+        pass
+    def close(self):
+        self.conn.close()
+
+class SQLiteCursor:
+    """
+    DictCursor for an SQLiteConnection. Queries written for MySQL are translated (see translate).
+    Results are fetched upon execution, so that rowcount is also set for SELECT queries.
+    As for pymysql, lastrowid after a (multi-row) INSERT is the first rowid it inserted.
+    """
+    def __init__(self,connection):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+        self.rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self,query,args=None):
+        if args is not None and not isinstance(args,(tuple,list)): args = (args,) #as pymysql does for a single value
+        for statement in self.translate(query,withArgs=args is not None):
+            self.cursor.execute(statement,args or ())
+        self.fetchResults()
+        if query.lstrip().upper().startswith('INSERT') and self.rowcount > 0:
+            self.lastrowid = self.connection.lastInsertID = self.lastrowid-self.rowcount+1
+        return self.rowcount
+
+    def executemany(self,query,args):
+        for statement in self.translate(query): self.cursor.executemany(statement,args)
+        self.fetchResults()
+        return self.rowcount
+
+    def fetchResults(self):
+        if self.cursor.description:
+            columns = [column[0] for column in self.cursor.description]
+            self.rows = [dict(zip(columns,row)) for row in self.cursor.fetchall()]
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = []
+            self.rowcount = self.cursor.rowcount
+        self.rows.reverse() #fetchone pops from the end
+        self.lastrowid = self.cursor.lastrowid
+
+    def fetchone(self):
+        return self.rows.pop() if self.rows else None
+    def fetchall(self):
+        rows,self.rows = self.rows[::-1],[]
+        return rows
+    def close(self):
+        self.cursor.close()
+
+    @staticmethod
+    def translate(query,withArgs=True):
+        """
+        Returns the list of SQLite statements for a MySQL query:
+            %s placeholders become ?, <=> becomes IS, FOR UPDATE is dropped (SQLite locks the whole database),
+            DROP TEMPORARY TABLE is done per table,
+            CREATE TABLE statements lose their comments, get the column constraints after the columns,
+            AUTO_INCREMENT primary keys become INTEGER PRIMARY KEY AUTOINCREMENT and
+            CHAR/TEXT columns compare case insensitive as they do in MySQL
+            (except for the columns of a CREATE TABLE ... SELECT, that SQLite makes without collation).
+        """
+        import re
+        query = query.strip().rstrip(';').strip()
+        if withArgs: query = query.replace('%s','?')
+        query = query.replace('<=>',' IS ')
+        query = re.sub(r'\s+FOR UPDATE$','',query)
+        drop = re.match(r'DROP TEMPORARY TABLE (IF EXISTS )?(.+)$',query,re.S)
+        if drop: return ['DROP TABLE '+(drop.group(1) or '')+'temp.'+table.strip() for table in drop.group(2).split(',')]
+        if not re.match(r'CREATE (TEMPORARY )?TABLE',query): return [query]
+        query = re.sub(r"\s*COMMENT\s*'(?:[^'\\]|\\.|'')*'",'',query)
+        if re.match(r'CREATE TEMPORARY TABLE \w+\s+SELECT',query):
+            return [re.sub(r'^(CREATE TEMPORARY TABLE \w+)\s+SELECT',r'\1 AS SELECT',query)]
+        head,body = query.split('(',1)
+        body,tail = body.rsplit(')',1)
+        items,depth,item = [],0,''
+        for c in body:
+            if c == ',' and not depth:
+                items.append(item)
+                item = ''
+                continue
+            depth += {'(':1,')':-1}.get(c,0)
+            item += c
+        items.append(item)
+        columns,constraints = [],[]
+        for item in items:
+            item = ' '.join(item.split())
+            if re.match(r'(FOREIGN KEY|UNIQUE|PRIMARY KEY)\s*\(',item):
+                constraints.append(item)
+                continue
+            item = item.replace('INT NOT NULL AUTO_INCREMENT PRIMARY KEY','INTEGER PRIMARY KEY AUTOINCREMENT')
+            item = item.replace('UNIQUE KEY','UNIQUE')
+            if re.match(r'`?\w+`?\s+(CHAR|TEXT)\b',item): item += ' COLLATE NOCASE'
+            columns.append(item)
+        return [head+'(\n'+',\n'.join(columns+constraints)+'\n)'+tail]
+
 def dbBackup(backupfile='strdb.sql',restore=True,flush=False):
     """
     Backup database
@@ -57,7 +201,7 @@ def dbBackup(backupfile='strdb.sql',restore=True,flush=False):
 def dropTables(sql):
     tables = ('BASEseqs','BASEnames','BASEprimersets','BASEqual','BASEtrack',
               'BASEstat','laboratories','LOCInames','LOCIalleles','LOCIalleles',
-              'LOCIalleles_CE','LOCIconflicts')
+              'LOCIalleles_CE','LOCIconflicts','LOCIdigests')
     for table in tables: sql.execute ("DROP TABLE "+table)
 
 
@@ -70,7 +214,9 @@ def makeTables(sql):
     CREATE TABLE IF NOT EXISTS BASEseqs (
     `seqID` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     `sequence` TEXT(1000) NOT NULL 
-             COMMENT 'sequence of allele, error sequence or primer'
+             COMMENT 'sequence of allele, error sequence or primer',
+    `seqHash` BINARY(20) NOT NULL UNIQUE KEY
+             COMMENT 'SHA1 of the upper case sequence, for indexed lookups'
     )
     COMMENT 'All sequences are maintained here, ref to seqID in other tables';
          """)    
@@ -199,6 +345,7 @@ def makeTables(sql):
     )
     COMMENT 'all the alleles that were used for determining flanks';
          """)
+    makeDigestTable(sql)
     sql.execute ("""
     CREATE TABLE IF NOT EXISTS LOCIalleles_CE (
     `locusName` CHAR(40) NOT NULL 
@@ -219,6 +366,30 @@ def makeTables(sql):
     );
          """)
 
+def makeDigestTable(sql):
+    sql.execute ("""
+    CREATE TABLE IF NOT EXISTS LOCIdigests (
+    `locusName` CHAR(40) NOT NULL UNIQUE KEY COMMENT 'id of the locus',
+    `digest` BINARY(20) NOT NULL 
+     COMMENT 'SHA1 of the base information the LOCInames/LOCIalleles rows were processed from'
+    )
+    COMMENT 'to only reprocess loci with changed base information';
+         """)
+
+#Update tables of an existing database to the current makeTables
+def upgradeTables(sql):
+    #BASEseqs digest column, to look up sequences with an index (SQLite databases always had it)
+    if not isinstance(sql,SQLiteCursor): sql.execute("SHOW COLUMNS FROM BASEseqs LIKE 'seqHash'")
+    if not isinstance(sql,SQLiteCursor) and not sql.rowcount:
+        sql.execute("""
+        ALTER TABLE BASEseqs ADD COLUMN `seqHash` BINARY(20) NULL 
+             COMMENT 'SHA1 of the upper case sequence, for indexed lookups';
+             """)
+        sql.execute("UPDATE BASEseqs SET seqHash = UNHEX(SHA1(UPPER(sequence)));")
+        sql.execute("ALTER TABLE BASEseqs MODIFY `seqHash` BINARY(20) NOT NULL, ADD UNIQUE KEY (`seqHash`);")
+    #LOCIdigests, for processing only changed loci
+    makeDigestTable(sql)
+
 #Create views and functions
 #sql.execute('DROP VIEW BASEcombined;')
 def makeViews(sql):
@@ -232,6 +403,7 @@ def makeViews(sql):
          """)
 
 def makeFunctions(sql):
+    if isinstance(sql,SQLiteCursor): return #getSeq is registered on each SQLiteConnection
     sql.execute("""
                 CREATE FUNCTION getSeq (primer INT)
                 RETURNS TEXT(1000) DETERMINISTIC
@@ -246,9 +418,13 @@ if __name__ == '__main__':
                             'Add a user, or database for the MyFLq application')
     parser.add_argument('user',
                         help='User for which a database will be created')
-    parser.add_argument('db',nargs='*',help='Database[s] to create')
+    parser.add_argument('db',nargs='*',help='''Database[s] to create. A file path (containing a /) or a file name
+                        prefixed with sqlite: is made as an embedded SQLite database,
+                        for which no MySQL user or password is needed''')
     parser.add_argument('-p','--password',
                 help='MySQL user password (if not provided, will be asked for)')
+    parser.add_argument('--upgrade', action="store_true",
+                        help='Upgrade the tables of existing database[s] instead')
     parser.add_argument('--delete', action="store_true",
                         help='Delete database[s] instead')
     parser.add_argument('--delete-user', action="store_true",
@@ -256,7 +432,21 @@ if __name__ == '__main__':
     parser.add_argument('--install', action="store_true", 
                         help='No longer implemented => use sed -i ...')
     args = parser.parse_args()
-    if not args.password:
+    if args.db and all(isSQLite(db) for db in args.db):
+        import os
+        for db in args.db:
+            if args.delete or args.delete_user:
+                if os.path.exists(sqlitePath(db)): os.remove(sqlitePath(db))
+                continue
+            if not args.upgrade and os.path.exists(sqlitePath(db)): raise Exception(db+' already exists')
+            conn,sql = login(database=db)
+            if args.upgrade: upgradeTables(sql)
+            else:
+                makeTables(sql)
+                makeViews(sql)
+                makeFunctions(sql)
+            logout(conn,sql)
+    elif not args.password:
         import getpass
         try: args.password = getpass.getpass(
                 'MySQL password for '+args.user+': ')
@@ -272,7 +462,11 @@ if __name__ == '__main__':
         if not sql.rowcount:
             sql.execute("CREATE USER %s@'localhost' IDENTIFIED BY %s;",
                         (args.user,args.password))
-        if not (args.delete or args.delete_user):
+        if args.upgrade:
+            for db in args.db:
+                sql.execute("USE "+db+";")
+                upgradeTables(sql)
+        elif not (args.delete or args.delete_user):
             for db in args.db:
                 sql.execute("CREATE DATABASE "+db+";")
                 sql.execute("GRANT ALL ON "+db+
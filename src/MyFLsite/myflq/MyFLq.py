@@ -37,32 +37,88 @@ from itertools import repeat
     
 #Database functions
 class Login: #Passwd and profiler depend on how you set up MySQL
+    poolSize = 4 #maximum number of idle connections kept for reuse
     def __init__(self,user="testuser",passwd="testuser",database='testdb'):
         """
         Makes a callable object, that returns a connection with given credentials.
+        Connections given back with logout are kept (up to poolSize) and reused by later calls,
+        as long as the credentials have not changed since they were given out.
+        database can also be an embedded SQLite file (see MyFLdb.isSQLite), user and passwd are then not used.
         """
+        import threading
         self.user=user
         self.passwd=passwd
         self.database=database
+        self.pool = [] #idle connections
+        self.lent = {} #connections given out, that have not been given back yet => their credentials
+        self.lock = threading.Lock()
     def __call__(self,user=None,passwd=None,database=None):
         """
         When a call is made to a Login object, provided arguments are applied to the object attributes.
         Hence, future calls can be made without the argument and will give the same result.
         
         Returns the formed connection with the db using variablenames: conn, sql
+        The connection is taken from the pool if possible.
         """
+        if (user,passwd,database) != (None,None,None) and (
+                (user or self.user,passwd or self.passwd,database or self.database) != 
+                (self.user,self.passwd,self.database)): self.clear()
         if user: self.user=user
         if passwd: self.passwd=passwd
         if database: self.database=database
 
-        try: import pymysql as MySQLdb
-        except ImportError: import MySQLdb #py2#
-        conn = MySQLdb.connect(host = "localhost",
-                               user = self.user,
-                               passwd = self.passwd,
-                               db = self.database)
-        sql = conn.cursor(MySQLdb.cursors.DictCursor)
+        try: import MyFLdb
+        except ImportError: from . import MyFLdb
+        conn = None
+        while conn is None:
+            with self.lock:
+                if not self.pool: break
+                conn = self.pool.pop()
+            try: conn.ping(True) #reconnects if the server closed the connection
+            except Exception: conn = None
+        if conn is None: conn,sql = MyFLdb.login(user=self.user,passwd=self.passwd,database=self.database)
+        else: sql = conn.cursor()
+        with self.lock: self.lent[conn] = (self.user,self.passwd,self.database)
         return (conn,sql)
+    def release(self,conn):
+        """
+        Takes back a connection given out by this Login, keeping it for reuse if the pool is not full
+        and it was given out with the current credentials (otherwise it is closed).
+        Returns False if conn was not given out by this Login.
+        """
+        with self.lock:
+            if conn not in self.lent: return False
+            credentials = self.lent.pop(conn)
+            if len(self.pool) < self.poolSize and credentials == (self.user,self.passwd,self.database):
+                self.pool.append(conn)
+                return True
+        conn.close()
+        return True
+    def clear(self):
+        """
+        Closes the idle connections of the pool
+        Connections that are given out are closed when they are given back (see release).
+        """
+        with self.lock: pool,self.pool = self.pool,[]
+        for conn in pool: conn.close()
+    def session(self):
+        """
+        Returns a context manager for a transaction on a pooled connection, e.g.:
+            with login.session() as sql: sql.execute(...)
+        The transaction is committed if the block finishes, rolled back if it raises.
+        """
+        from contextlib import contextmanager
+        @contextmanager
+        def transaction():
+            conn,sql = self()
+            try: yield sql
+            except:
+                conn.rollback()
+                sql.close()
+                self.release(conn)
+                raise
+            logout(conn,sql)
+        return transaction()
     def testConnection(self):
         try:
             conn,sql = self()
@@ -73,25 +129,209 @@ login = Login()
 
 def logout(conn,sql):
     """
-    Logout from the database connection
+    Logout from the database connection.
+    Connections of login are given back to its pool, others are closed.
     """
     sql.close()
     conn.commit()
-    conn.close()
+    if not login.release(conn): conn.close()
+
+#Profiling
+class Profiler:
+    """
+    Records the wall and CPU time of analysis stages (in seconds), and counters (see Analysis profile option).
+    Stages are timed with stage or iterate. Read processing functions are timed by replacing them with
+    timed versions while the profiler is instrumenting (see instrument), so when not profiling
+    (NullProfiler) they are not changed at all.
+    """
+    instrumented = (('Read','assignLocus'),('Read','primerOut'),('Read','flankOut'),('Read','getFlankIndex'),
+                    ('Alignment','__init__'),('Locus','clusterUniqueReads'))
+    def __init__(self):
+        self.stages = {} #stage => [calls,wall time,cpu time]
+        self.counters = {}
+        self.originals = []
+
+    def stage(self,name):
+        """
+        Returns a context manager that times a stage, e.g.:
+            with profiler.stage('processReads'): ...
+        """
+        from contextlib import contextmanager
+        import time
+        @contextmanager
+        def timing():
+            wall,cpu = time.perf_counter(),time.process_time()
+            try: yield
+            finally: self.addTime(name,time.perf_counter()-wall,time.process_time()-cpu)
+        return timing()
+
+    def iterate(self,name,iterable):
+        """
+        Iterates over iterable, timing the production of its items as stage name (e.g. for parsing a file)
+        """
+        import time
+        iterator = iter(iterable)
+        while True:
+            wall,cpu = time.perf_counter(),time.process_time()
+            try: item = next(iterator)
+            except StopIteration: return
+            finally: self.addTime(name,time.perf_counter()-wall,time.process_time()-cpu)
+            yield item
+
+    def addTime(self,name,wall,cpu,calls=1):
+        try: timing = self.stages[name]
+        except KeyError: timing = self.stages[name] = [0,0.,0.]
+        timing[0]+=calls
+        timing[1]+=wall
+        timing[2]+=cpu
+
+    def count(self,name,amount=1):
+        self.counters[name] = self.counters.get(name,0)+amount
+
+    def instrument(self):
+        """
+        Replaces the functions in instrumented by timed versions, until restore is called.
+        Alignments are also counted per mode, e.g. 'Alignment primer-search' counts the primerOut alignment fallbacks.
+        """
+        import time
+        def timed(function,name,countMode):
+            def timedFunction(*args,**kwargs):
+                if countMode: self.count('Alignment '+(args[3] if len(args) > 3 else kwargs.get('mode','global')))
+                wall,cpu = time.perf_counter(),time.process_time()
+                try: return function(*args,**kwargs)
+                finally: self.addTime(name,time.perf_counter()-wall,time.process_time()-cpu)
+            return timedFunction
+        for className,attribute in self.instrumented:
+            owner = globals()[className]
+            original = owner.__dict__[attribute]
+            name = className if attribute == '__init__' else className+'.'+attribute
+            if isinstance(original,staticmethod):
+                setattr(owner,attribute,staticmethod(timed(original.__func__,name,False)))
+            else: setattr(owner,attribute,timed(original,name,owner is Alignment))
+            self.originals.append((owner,attribute,original))
+
+    def restore(self):
+        """
+        Puts back the functions replaced by instrument
+        """
+        while self.originals:
+            owner,attribute,original = self.originals.pop()
+            setattr(owner,attribute,original)
+
+    def popStats(self):
+        """
+        Returns the recorded stages and counters, and starts recording anew (see merge)
+        """
+        stats = {'stages':self.stages,'counters':self.counters}
+        self.stages,self.counters = {},{}
+        return stats
+
+    def merge(self,stats):
+        """
+        Adds stats from another profiler (e.g. of a worker process, see popStats)
+        """
+        for name,(calls,wall,cpu) in stats['stages'].items(): self.addTime(name,wall,cpu,calls=calls)
+        for name,amount in stats['counters'].items(): self.count(name,amount)
+
+    def getXML(self):
+        """
+        Returns the profile element for the report
+        """
+        import xml.etree.ElementTree as ET
+        profile = ET.Element('profile')
+        profile.text = '\n\t'
+        profile.tail = '\n'
+        for name in self.stages:
+            stage = ET.SubElement(profile,'stage')
+            stage.set('name',name)
+            stage.set('calls',str(self.stages[name][0]))
+            stage.set('wall',format(self.stages[name][1],'.3f'))
+            stage.set('cpu',format(self.stages[name][2],'.3f'))
+            stage.tail = '\n\t'
+        for name in sorted(self.counters):
+            counter = ET.SubElement(profile,'counter')
+            counter.set('name',name)
+            counter.set('value',str(self.counters[name]))
+            counter.tail = '\n\t'
+        if len(profile): profile[-1].tail = '\n'
+        return profile
+
+    @staticmethod
+    def readReport(fileName):
+        """
+        Returns the profile of an XML report as a dict {'stages':{name:(calls,wall,cpu)},'counters':{name:value}},
+        or None if the analysis was not profiled
+        """
+        import xml.etree.ElementTree as ET
+        for event,element in ET.iterparse(fileName):
+            if element.tag == 'profile':
+                return {'stages':{stage.get('name'):(int(stage.get('calls')),float(stage.get('wall')),
+                                                     float(stage.get('cpu'))) for stage in element.iter('stage')},
+                        'counters':{counter.get('name'):int(counter.get('value')) 
+                                    for counter in element.iter('counter')}}
+            elif element.tag == 'locus': element.clear()
+
+class NullProfiler(Profiler):
+    """
+    Profiler used when not profiling: records nothing and does not instrument any function.
+    """
+    def __init__(self):
+        pass
+    def stage(self,name):
+        from contextlib import nullcontext
+        return nullcontext()
+    def iterate(self,name,iterable):
+        return iterable
+    def addTime(self,name,wall,cpu,calls=1):
+        pass
+    def count(self,name,amount=1):
+        pass
+    def instrument(self):
+        pass
+    def restore(self):
+        pass
+    def merge(self,stats):
+        pass
 
 #Multiprocessing
-import subprocess
-def ipcluster(do='start',process=None,numberOfEngines=4):
-    if do=='start':
-        #return subprocess.Popen('ipcluster start -n '+str(numberOfEngines),shell=True)
-        return [subprocess.Popen('ipcontroller')]+[subprocess.Popen('ipengine') for i in range(numberOfEngines)]
-    elif do=='stop':
-        #subprocess.call('ipcluster stop',shell=True)
-        #process.poll()
-        [(p.send_signal(subprocess.signal.SIGINT),p.poll()) for p in process]
-    elif do=='restart':
-        ipcluster('stop',process=process)
-        return ipcluster('start',numberOfEngines=numberOfEngines)
+def initReadWorker(locusDict,settings,profile=False):
+    """
+    Initializer for the worker processes of an Analysis (see Analysis.setupParallelProcessing).
+    Keeps the compiled locusDict (LocusIndex) and the Read.process settings for processReadChunk,
+    so they are only sent once to each worker.
+    If profile, the worker times its read processing (see Profiler.instrument).
+    """
+    processReadChunk.locusDict = locusDict
+    processReadChunk.settings = settings
+    processReadChunk.profiler = Profiler() if profile else None
+    if profile: processReadChunk.profiler.instrument()
+
+def processReadChunk(chunk):
+    """
+    Processes a chunk of distinct raw reads in a worker process.
+    Expects a list of (sequence,quality length) and returns for each read a tuple
+    (locus,processed sequence,processed range(quality length),qualLog), see Read.process
+    If the worker is profiling, the profiler stats of the chunk are returned with the list.
+    """
+    outcomes = []
+    for seq,qualLength in chunk:
+        read = Read((None,seq,None,''))
+        read.qual = range(qualLength)
+        read.process(processReadChunk.locusDict,**processReadChunk.settings)
+        outcomes.append((read.locus,read.seq,read.qual,read.qualLog))
+    if processReadChunk.profiler: return outcomes,processReadChunk.profiler.popStats()
+    return outcomes
+
+def analyzeLocus(locus,knownAlleles,settings):
+    """
+    Analyzes a locus in a worker process (see Locus.analyze), with settings the keyword arguments for analyze.
+    knownAlleles are the known alleles of the locus (see Locus.getKnownAlleles), so no database is needed.
+    Returns the analysis results of the locus (see Locus.getAnalysisResults), without its reads,
+    with the profiler stats of the worker if it is profiling.
+    """
+    locus.analyze(knownAlleles=knownAlleles,**settings)
+    if processReadChunk.profiler: return locus.getAnalysisResults(),processReadChunk.profiler.popStats()
+    return locus.getAnalysisResults()
 
 #General DNA functions        
 class LocusConflictError(Exception):
@@ -103,6 +343,8 @@ class LocusConflictError(Exception):
         self.message = message
     def __str__(self):
         return repr(self.value)
+    def __reduce__(self): #value and message are not in args, so they would be lost when pickled
+        return (LocusConflictError,(self.value,self.message))
 
 def getSeq(seqID,sql=None):
     """
@@ -133,7 +375,47 @@ def compress(dna):
     """
     Compresses all homopolymers in a DNA sequence to their base (including 'N' homopolymers)
     """
-    return ''.join([dna[na] for na in range(len(dna)) if dna[na]!=dna[na-1] or na == 0])
+    import itertools,operator
+    return ''.join(itertools.compress(dna,map(operator.ne,dna,' '+dna)))
+
+def runLengthEncode(dna):
+    """
+    Returns the compressed DNA sequence (see compress), and for each of its bases the position in dna
+    where its homopolymer starts, to map compressed positions back to positions in dna
+    """
+    import itertools,operator
+    firstOfRun = list(map(operator.ne,dna,' '+dna))
+    return ''.join(itertools.compress(dna,firstOfRun)),list(itertools.compress(range(len(dna)),firstOfRun))
+
+def editDistance(dna1,dna2,maxDistance=None):
+    """
+    Returns the edit distance (number of substitutions, insertions and deletions) between two DNA strings,
+    calculated bit-parallel (Myers/Hyyrö): the column of differences for all positions of dna1 is kept
+    in python integers as bit vectors, and updated at once for each base of dna2.
+    If maxDistance is given, calculation stops as soon as the distance is known to be larger,
+    and maxDistance+1 is returned.
+    """
+    if maxDistance is not None and abs(len(dna1)-len(dna2)) > maxDistance: return maxDistance+1
+    if not dna1: return len(dna2)
+    mask = (1 << len(dna1)) - 1
+    last = 1 << (len(dna1)-1)
+    peq = {} #bit vectors of the positions of each base in dna1
+    for i,b in enumerate(dna1): peq[b] = peq.get(b,0) | (1 << i)
+    pv,mv,distance = mask,0,len(dna1) #vertical +1/-1 deltas, distance dna1 to current prefix of dna2
+    for j,b in enumerate(dna2):
+        eq = peq.get(b,0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last: distance+=1
+        elif mh & last: distance-=1
+        if maxDistance is not None and distance - (len(dna2)-j-1) > maxDistance: return maxDistance+1
+        ph = ((ph << 1) | 1) & mask #global: the first row increases by 1 for each base
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return distance if maxDistance is None or distance <= maxDistance else maxDistance+1
 
 def fastaReader(fd):
     """
@@ -158,7 +440,8 @@ def fastaReader(fd):
 class Alignment:
     """
     Wrapper for alignments.
-    Currently implemented in python, but needs to be optimized.
+    The score matrix is filled per anti-diagonal with numpy array operations (engine 'numpy'),
+    the original cell by cell python implementation is kept as reference (engine 'python').
     Special for forensic STR loci => a STR-size locus specific stutter gap score
     """
     import numpy as np
@@ -173,7 +456,9 @@ class Alignment:
     gapExtension = None
     stutterPenalty = -10
     scoresToBreadcrumbs = {0:4,1:2,2:1,3:6,4:3}
-    def __init__(self,dna1,dna2,mode='global',stutter=False,gapPenalty=None,gapExtension=None):
+    engine = 'numpy' #'numpy' or 'python' (reference implementation)
+    def __init__(self,dna1,dna2,mode='global',stutter=False,gapPenalty=None,gapExtension=None,engine=None,
+                 maxDifferences=None):
         """
         Performs a global alignment according to Needleman-Wunsch algorithm, favouring stutter gaps if desired
 
@@ -189,12 +474,23 @@ class Alignment:
 
         It is not advide to use the gapExtension argument together with the stutter argument.
         stutter is in itself a specific form of gapExtension
+
+        If engine == 'numpy': all cells of an anti-diagonal are calculated at once (default, see Alignment.engine)
+        If engine == 'python': the matrix is filled cell by cell. Both engines give the same alignment,
+            the python engine is kept as a reference to check the numpy engine against.
+
+        If maxDifferences is given (only for mode 'global'), the alignment is only of interest if it has
+            maxDifferences differences or less (see getDifferences). The matrix is then first filled within a band
+            around the diagonal, wide enough for all those alignments (see fillBand). When it is certain
+            the alignment has more differences, filling stops early and alnment is set to None
+            (getDifferences returns inf). Otherwise the alignment is the same as without maxDifferences.
         """
         np = self.np
         self.dna1 = dna1
         self.dna2 = dna2
         if gapPenalty: self.gapPenalty = gapPenalty
         if gapExtension: self.gapExtension = gapExtension
+        if engine: self.engine = engine
         #F matrix => i0xx = scores, i1xx = breadcrumbs (0=None;1=->;2=-->;4=L;3=v;6=V)
         F_m = np.zeros((2,len(dna1)+1,len(dna2)+1))
         self.F_m = F_m #for debugging
@@ -216,35 +512,13 @@ class Alignment:
                                                                        *self.gapPenalty) , 1
             for j in range(1,len(dna2)+1): F_m[0,0,j],F_m[1,0,j] = 0 , 3
         #Fill
-        for i in range(1,len(dna1)+1):
-            #pdb.set_trace()
-            for j in range(1,len(dna2)+1):
-                if mode=='flank-index': #calculate scores to make them incremental in respect to flank position
-                    scores = [F_m[0,i-1,j-1] + (np.sqrt(10) if i > 10 else np.sqrt(i))*
-                              self.similarity_m[self.bases_dict_i[dna1[i-1]],self.bases_dict_i[dna2[j-1]]], #match: L
-                              None, #stutter-delete: not useful for flank-index
-                              F_m[0,i-1,j] + (np.sqrt(10) if i > 10 else np.sqrt(i))*self.gapPenalty, #delete: ->
-                              None,#stutter-insert: not useful for flank-index
-                              F_m[0,i,j-1] + (np.sqrt(10) if i > 10 else np.sqrt(i))*self.gapPenalty #insert: v
-                              ]               
-                else: #for global and primer-search mode
-                    scores = [F_m[0,i-1,j-1] + 
-                              self.similarity_m[self.bases_dict_i[dna1[i-1]],self.bases_dict_i[dna2[j-1]]],
-                                  #match: L
-                              None if not stutter or stutter > i else F_m[0,i-stutter,j] + self.stutterPenalty,
-                                  #stutter-delete: -->
-                              F_m[0,i-1,j] + (self.gapPenalty if not (self.gapExtension and F_m[1,i-1,j] != '->') else self.gapExtension),
-                                  #delete: ->
-                              None if not stutter or stutter > j else F_m[0,i,j-stutter] + self.stutterPenalty,
-                                  #stutter-insert: V
-                              F_m[0,i,j-1] + (self.gapPenalty if not (self.gapExtension and F_m[1,i-1,j] != 'v') else self.gapExtension)
-                                  #insert: v
-                              ] #stutters come before single gaps as they are preferred                
-                    
-                try: maxScore = max(scores)
-                except TypeError: maxScore = max(filter(lambda x: x is not None,scores))
-                maxCrumb = self.scoresToBreadcrumbs[scores.index(maxScore)]
-                F_m[0,i,j],F_m[1,i,j] = maxScore,maxCrumb
+        banded = self.fillBand(maxDifferences) if maxDifferences is not None and mode=='global' else None
+        if banded is False: #more than maxDifferences differences
+            self.alnment,self.score = None,None
+            return
+        elif banded is None: #no band or undecided => full matrix
+            if self.engine == 'python': self.fillCells(mode)
+            else: self.fillAntiDiagonals(mode)
         if mode=='flank-index':
             self.flankOutIndex = F_m[0,len(dna1),:].tolist().index(F_m[0,len(dna1),:].max()) - 1
                 #debug# plus or minus 1 #depends on downstream use
@@ -282,11 +556,204 @@ class Alignment:
             else: break
         self.alnment = alnment[::-1]
         self.score = F_m[0,-1,-1]
+
+    def fillCells(self,mode):
+        """
+        Reference engine: fills F_m cell by cell.
+        Expects the first row and column of F_m to be filled.
+        """
+        np = self.np
+        F_m,dna1,dna2,stutter = self.F_m,self.dna1,self.dna2,self.stutter
+        for i in range(1,len(dna1)+1):
+            #pdb.set_trace()
+            for j in range(1,len(dna2)+1):
+                if mode=='flank-index': #calculate scores to make them incremental in respect to flank position
+                    scores = [F_m[0,i-1,j-1] + (np.sqrt(10) if i > 10 else np.sqrt(i))*
+                              self.similarity_m[self.bases_dict_i[dna1[i-1]],self.bases_dict_i[dna2[j-1]]], #match: L
+                              None, #stutter-delete: not useful for flank-index
+                              F_m[0,i-1,j] + (np.sqrt(10) if i > 10 else np.sqrt(i))*self.gapPenalty, #delete: ->
+                              None,#stutter-insert: not useful for flank-index
+                              F_m[0,i,j-1] + (np.sqrt(10) if i > 10 else np.sqrt(i))*self.gapPenalty #insert: v
+                              ]               
+                else: #for global and primer-search mode
+                    scores = [F_m[0,i-1,j-1] + 
+                              self.similarity_m[self.bases_dict_i[dna1[i-1]],self.bases_dict_i[dna2[j-1]]],
+                                  #match: L
+                              None if not stutter or stutter > i else F_m[0,i-stutter,j] + self.stutterPenalty,
+                                  #stutter-delete: -->
+                              F_m[0,i-1,j] + (self.gapPenalty if not (self.gapExtension and F_m[1,i-1,j] != '->') else self.gapExtension),
+                                  #delete: ->
+                              None if not stutter or stutter > j else F_m[0,i,j-stutter] + self.stutterPenalty,
+                                  #stutter-insert: V
+                              F_m[0,i,j-1] + (self.gapPenalty if not (self.gapExtension and F_m[1,i-1,j] != 'v') else self.gapExtension)
+                                  #insert: v
+                              ] #stutters come before single gaps as they are preferred                
+                    
+                try: maxScore = max(scores)
+                except TypeError: maxScore = max(filter(lambda x: x is not None,scores))
+                maxCrumb = self.scoresToBreadcrumbs[scores.index(maxScore)]
+                F_m[0,i,j],F_m[1,i,j] = maxScore,maxCrumb
+
+    def fillAntiDiagonals(self,mode):
+        """
+        Numpy engine: fills F_m one anti-diagonal (i+j constant) at a time.
+        All cells of an anti-diagonal only depend on previous anti-diagonals, so their scores can be calculated
+        as array operations. The scores are stored skewed during the fill (G[i+j,i] == F_m[0,i,j]), so that
+        every dependency of an anti-diagonal is a contiguous slice of an earlier one.
+        Breadcrumbs are derived afterwards for the full matrix at once, breaking ties as the reference engine:
+        the first move in scoresToBreadcrumbs order wins.
+        Expects the first row and column of F_m to be filled.
+        """
+        np = self.np
+        F_m,dna1,dna2,stutter = self.F_m,self.dna1,self.dna2,self.stutter
+        n,m = len(dna1),len(dna2)
+        if mode=='flank-index':
+            weights = np.sqrt(np.minimum(np.arange(n+1),10)) #incremental weights in respect to flank position
+            gapScores = weights*self.gapPenalty
+            stutter = False #stutter moves are not useful for flank-index
+        else: gapScores = np.full(n+1,self.gapPenalty if not self.gapExtension else self.gapExtension,dtype=float)
+        #Match scores for all cells, F_m layout (S) and skewed layout (SG)
+        bases1 = np.array([self.bases_dict_i[b] for b in dna1],dtype=np.intp)
+        bases2 = np.array([self.bases_dict_i[b] for b in dna2],dtype=np.intp)
+        S = np.asarray(self.similarity_m)[bases1[:,None],bases2[None,:]]
+        if mode=='flank-index': S = weights[1:,None]*S
+        i,j = np.ogrid[1:n+1,1:m+1]
+        SG = np.zeros((n+m+1,n+1))
+        SG[i+j,i] = S
+        #Skewed scores, cells outside F_m remain -inf
+        G = np.full((n+m+1,n+1),-np.inf)
+        G[np.arange(n+1),np.arange(n+1)] = F_m[0,:,0]
+        G[np.arange(m+1),0] = F_m[0,0,:]
+        candidate = np.empty(n)
+        for d in range(2,n+m+1):
+            i0,i1 = max(1,d-m),min(n,d-1) #cells (i,d-i) with i0 <= i <= i1
+            if i0 > i1: continue
+            best,score = G[d,i0:i1+1],candidate[:i1-i0+1]
+            np.add(G[d-2,i0-1:i1],SG[d,i0:i1+1],out=best) #match: L
+            np.maximum(best,np.add(G[d-1,i0-1:i1],gapScores[i0:i1+1],out=score),out=best) #delete: ->
+            np.maximum(best,np.add(G[d-1,i0:i1+1],gapScores[i0:i1+1],out=score),out=best) #insert: v
+            if stutter:
+                if i1 >= stutter: #stutter-delete: -->
+                    si0 = max(i0,stutter)
+                    np.maximum(best[si0-i0:],G[d-stutter,si0-stutter:i1-stutter+1]+self.stutterPenalty,
+                               out=best[si0-i0:])
+                if d-i0 >= stutter: #stutter-insert: V
+                    si1 = min(i1,d-stutter)
+                    np.maximum(best[:si1-i0+1],G[d-stutter,i0:si1+1]+self.stutterPenalty,out=best[:si1-i0+1])
+        i,j = np.ogrid[:n+1,:m+1]
+        F_m[0] = G[i+j,i]
+        #Breadcrumbs: recalculate all moves with the final scores and take the first best one
+        F = F_m[0]
+        scores = np.full((5,n,m),-np.inf)
+        scores[0] = F[:-1,:-1] + S #match: L
+        scores[2] = F[:-1,1:] + gapScores[1:,None] #delete: ->
+        scores[4] = F[1:,:-1] + gapScores[1:,None] #insert: v
+        if stutter and stutter <= n: scores[1,stutter-1:,:] = F[:n-stutter+1,1:] + self.stutterPenalty #stutter-delete: -->
+        if stutter and stutter <= m: scores[3,:,stutter-1:] = F[1:,:m-stutter+1] + self.stutterPenalty #stutter-insert: V
+        crumbs = np.array([self.scoresToBreadcrumbs[s] for s in range(5)])
+        F_m[1,1:,1:] = crumbs[scores.argmax(axis=0)]
         
+    def fillBand(self,maxDifferences):
+        """
+        Banded engine for global alignments that only matter with maxDifferences differences or less.
+        An alignment with at most maxDifferences differences has at most maxDifferences*stutter (or
+        maxDifferences without stutter) gaps in either sequence, so its path stays within that band around
+        the diagonal. Only the cells within the band are filled, row by row (B[i,j-i+w] == F_m[0,i,j]):
+        every row only depends on previous rows and the band cells before it in the same row.
+
+        Returns False if the alignment has more than maxDifferences differences:
+            when the sequence lengths differ too much or when, while filling, no path within the band can still
+            reach the minimal score of any alignment with maxDifferences differences.
+        Returns True if F_m has been filled within the band (cells outside have score -inf):
+            when the best score within the band is higher than any path leaving the band could score.
+            All optimal paths are then within the band, and the traceback is the same as for a full matrix.
+        Returns None if undecided, the full matrix then needs to be filled.
+        F_m is only changed when True is returned.
+        """
+        np = self.np
+        F_m,dna1,dna2,stutter = self.F_m,self.dna1,self.dna2,self.stutter
+        n,m = len(dna1),len(dna2)
+        repeat = stutter if stutter else 1
+        w = maxDifferences*repeat #band: -w <= j-i <= w
+        if abs(n-m) > w: return False
+        similarity = np.asarray(self.similarity_m)
+        maxSim,minSim = similarity.max(),similarity.min()
+        gapScore = self.gapPenalty if not self.gapExtension else self.gapExtension
+        gapChar = [self.gapPenalty,gapScore] + ([self.stutterPenalty/repeat] if stutter else []) #score per gap
+        gapMax,gapMin = max(gapChar),min(gapChar)
+        if gapMax > 0 or maxSim <= 0: return None #bounds only hold when gaps are penalized
+        bases1 = np.array([self.bases_dict_i[b] for b in dna1],dtype=np.intp)
+        bases2 = np.array([self.bases_dict_i[b] for b in dna2],dtype=np.intp)
+        #Lowest score for an alignment with maxDifferences differences,
+        #   each difference (mismatch or gap of up to repeat size) lowers the score of dna1 aligned to itself
+        minScore = (similarity[bases1,bases1].sum() -
+                    maxDifferences*max(maxSim-minSim,repeat*(maxSim-gapMin)))
+        #Highest score for a path leaving the band, it needs more than w insertions (or deletions),
+        #   and as many deletions (insertions) as needed to return to the end of both sequences
+        outScore = max(maxSim*(m-w-1) + gapMax*(2*(w+1)+n-m) if m > w else -np.inf,
+                       maxSim*(n-w-1) + gapMax*(2*(w+1)+m-n) if n > w else -np.inf)
+        #Band matrices, columns past the band stay -inf for moves coming from outside the band
+        width = 2*w+1
+        i = np.arange(n+1)[:,None]
+        j = i + np.arange(-w,w+1)
+        inBand = (j >= 0) & (j <= m)
+        B = np.full((n+1,width+repeat),-np.inf)
+        S = np.full((n+1,width),-np.inf) #match scores
+        inner = inBand & (i > 0) & (j > 0)
+        S[inner] = similarity[np.broadcast_to(bases1[i-1],j.shape)[inner],bases2[j[inner]-1]]
+        R = maxSim*np.minimum(n-i,m-j) + gapMax*np.abs((n-i)-(m-j)) #highest score still to gain from a cell
+        B[0,w:w+min(w,m)+1] = F_m[0,0,:w+1]
+        #Filling with python floats, numpy calls on rows as short as a band cost more than they save
+        Bl,Sl,Rmax = B.tolist(),S.tolist(),R.max(axis=1).tolist()
+        gapScore,stutterPenalty = float(gapScore),float(self.stutterPenalty)
+        reach = [max(Bl[0])+Rmax[0]] #highest reachable score over the paths through each row
+        for i in range(1,n+1):
+            prev,match,row = Bl[i-1],Sl[i],Bl[i]
+            stutterPrev = Bl[i-stutter] if stutter and i >= stutter else None
+            t0,t1 = max(0,w-i),min(width-1,m-i+w) #band cells within F_m
+            if t0 == w-i: #first column
+                row[t0] = float(F_m[0,i,0])
+                t0+=1
+            for t in range(t0,t1+1):
+                score = prev[t] + match[t] #match: L
+                if prev[t+1]+gapScore > score: score = prev[t+1]+gapScore #delete: ->
+                if stutterPrev and stutterPrev[t+stutter]+stutterPenalty > score:
+                    score = stutterPrev[t+stutter]+stutterPenalty #stutter-delete: -->
+                if row[t-1]+gapScore > score: score = row[t-1]+gapScore #insert: v
+                if stutter and t >= stutter and row[t-stutter]+stutterPenalty > score:
+                    score = row[t-stutter]+stutterPenalty #stutter-insert: V
+                row[t] = score
+            reach.append(max(row)+Rmax[i])
+            if len(reach) >= repeat and max(reach[-repeat:]) < minScore: return False
+        B = np.array(Bl)
+        if not B[n,m-n+w] > outScore: return None
+        #Unpack the band and set its breadcrumbs, as in fillAntiDiagonals
+        i,t = np.nonzero(inBand)
+        j = i+t-w
+        F_m[0] = -np.inf
+        F_m[0,i,j] = B[i,t]
+        F = F_m[0]
+        inner = (i > 0) & (j > 0)
+        i,j,t = i[inner],j[inner],t[inner]
+        scores = np.full((5,len(i)),-np.inf)
+        scores[0] = F[i-1,j-1] + S[i,t] #match: L
+        scores[2] = F[i-1,j] + gapScore #delete: ->
+        scores[4] = F[i,j-1] + gapScore #insert: v
+        if stutter:
+            s = i >= stutter
+            scores[1,s] = F[i[s]-stutter,j[s]] + self.stutterPenalty #stutter-delete: -->
+            s = j >= stutter
+            scores[3,s] = F[i[s],j[s]-stutter] + self.stutterPenalty #stutter-insert: V
+        crumbs = np.array([self.scoresToBreadcrumbs[s] for s in range(5)])
+        F_m[1,i,j] = crumbs[scores.argmax(axis=0)]
+        return True
+
     def getDifferences(self):
         """
         Returns number of differences (one stutter counts for 1 difference)
+        If a banded alignment stopped early, it has more than maxDifferences differences => returns inf
         """
+        if self.alnment is None: return float('inf')
         if not self.stutter:
             return sum([len(set(a)) == 2 for a in self.alnment])
         else:
@@ -531,10 +998,9 @@ def makeEntry(sequences,seqCounts,locusName,labID='NA',passphrase='NA',technolog
         
     #First table that needs to be updated is BASEseqs:
     #   take all seqID's for the sequences and primers
-    seqIDs=[]
     if forwardP and reverseP: sequences+=[forwardP,reverseP]
-    for seq in sequences:
-        seqIDs.append(getSeqID(seq,sql))
+    seqIDs=getSeqIDs(sequences,sql)
+    seqIDs=[seqIDs[seq] for seq in sequences]
     if forwardP and reverseP:
         reverseP, forwardP = seqIDs.pop(), seqIDs.pop()
         sequences.pop(),sequences.pop()
@@ -614,34 +1080,80 @@ def makeLocusEntry(forwardP,reverseP,locusName,locusType,refNumber=None,
         primersetID = sql.fetchone()['primersetID']
     
     #BASEqual
-    if not technology and not filterLevel: qualID = None
-    else:
-        sql.execute("SELECT qualID FROM BASEqual WHERE technology <=> %s AND filterLevel <=> %s",
-                    (technology,filterLevel))
-        if not sql.rowcount:
-            sql.execute("INSERT INTO BASEqual (technology,filterLevel) VALUES (%s,%s)",(technology,filterLevel))
-            sql.execute("SELECT qualID FROM BASEqual WHERE technology <=> %s AND filterLevel <=> %s",
-                        (technology,filterLevel))
-            #             => use null-safe equality operator '<=>' to test for equality considering also NULL values
-        qualID = sql.fetchone()['qualID']
-        #sql.execute("SELECT LAST_INSERT_ID()")
-        #qualID=sql.fetchone()['LAST_INSERT_ID()']
+    qualID = getQualID(technology,filterLevel,sql)
             
     if conn: logout(conn,sql)        
     return primersetID,qualID
 
+def getQualID(technology,filterLevel,sql):
+    """
+    Returns the qualID in BASEqual for technology and filterLevel, adding it if not yet present.
+    Returns None if neither is given.
+    """
+    if not technology and not filterLevel: return None
+    sql.execute("SELECT qualID FROM BASEqual WHERE technology <=> %s AND filterLevel <=> %s",
+                (technology,filterLevel))
+    if not sql.rowcount:
+        sql.execute("INSERT INTO BASEqual (technology,filterLevel) VALUES (%s,%s)",(technology,filterLevel))
+        sql.execute("SELECT qualID FROM BASEqual WHERE technology <=> %s AND filterLevel <=> %s",
+                    (technology,filterLevel))
+        #             => use null-safe equality operator '<=>' to test for equality considering also NULL values
+    return sql.fetchone()['qualID']
+    #sql.execute("SELECT LAST_INSERT_ID()")
+    #qualID=sql.fetchone()['LAST_INSERT_ID()']
+
+def getSeqHash(seq):
+    """
+    Returns the digest of seq as stored in BASEseqs.seqHash: SHA1 of the upper case sequence,
+    as the database compares sequences case insensitive
+    """
+    import hashlib
+    return hashlib.sha1(seq.upper().encode()).digest()
+
 def getSeqID(seq,sql=None):
     if not seq: return #Empty sequences return None
     if not sql: conn,sql = login()
     else: conn=None
         
-    sql.execute ("SELECT seqID FROM BASEseqs WHERE sequence = %s", (seq,))
+    seqHash = getSeqHash(seq)
+    sql.execute ("SELECT seqID FROM BASEseqs WHERE seqHash = %s", (seqHash,))
     if sql.rowcount == 0: 
-        sql.execute ("INSERT INTO BASEseqs (sequence) VALUES (%s)", (seq,))
-        sql.execute ("SELECT seqID FROM BASEseqs WHERE sequence = %s", (seq,))
+        sql.execute ("INSERT INTO BASEseqs (sequence,seqHash) VALUES (%s,%s)", (seq,seqHash))
+        seqID = sql.lastrowid
+    else: seqID = sql.fetchone()['seqID']
 
     if conn: logout(conn,sql)
-    return sql.fetchone()['seqID']
+    return seqID
+
+def getSeqIDs(sequences,sql=None,chunkSize=1000):
+    """
+    Returns a dict with the seqID for each of the sequences (None for empty sequences).
+    Sequences not yet in BASEseqs are inserted. 
+    Lookups are done per chunkSize sequences in one query, inserts with one executemany.
+    """
+    if not sql: conn,sql = login()
+    else: conn=None
+
+    seqHashes = {seq:getSeqHash(seq) for seq in sequences if seq}
+    def lookup(hashes):
+        hashes,found = list(hashes),{}
+        for i in range(0,len(hashes),chunkSize):
+            chunk = hashes[i:i+chunkSize]
+            sql.execute("SELECT seqID,seqHash FROM BASEseqs WHERE seqHash IN ("+','.join(['%s']*len(chunk))+")",
+                        chunk)
+            found.update({bytes(s['seqHash']):s['seqID'] for s in sql.fetchall()})
+        return found
+    seqIDs = lookup(set(seqHashes.values()))
+    newSeqs = {}
+    for seq in seqHashes:
+        if seqHashes[seq] not in seqIDs and seqHashes[seq] not in newSeqs: newSeqs[seqHashes[seq]] = seq
+    if newSeqs:
+        sql.executemany("INSERT INTO BASEseqs (sequence,seqHash) VALUES (%s,%s)",
+                        [(newSeqs[seqHash],seqHash) for seqHash in newSeqs])
+        seqIDs.update(lookup(newSeqs))
+
+    if conn: logout(conn,sql)
+    return {seq:(seqIDs[seqHashes[seq]] if seq else None) for seq in sequences}
 
 #Functions for adding users/laboratories
 def addLab(labID,passphrase):
@@ -665,7 +1177,7 @@ makeRandomPassphrase.symbols={chr(a+48) for a in range(75) if chr(a+48) not in m
 
 
 #Functions for external connectivity to the database
-def makeEntries(csvFilename):
+def makeEntries(csvFilename,bulk=True):
     """
     Takes a csv file and inputs each line into the database.
     The csv should have the following format (header is optional)
@@ -681,7 +1193,9 @@ def makeEntries(csvFilename):
     FGA,GGCTGCAGGGCATAACATTA...
     ===========================================
     For a full working example, see the documentation file: alleles_example.csv
+    If bulk, all lines are added in one transaction (see makeBulkEntries), else with makeEntry per line.
     """
+    entries = []
     for line in open(csvFilename):
         if line.strip().startswith('#'): continue
         try: locusName,validatedInfo,sequence = line.strip().split(',')
@@ -689,9 +1203,69 @@ def makeEntries(csvFilename):
             locusName,sequence = line.strip().split(',')
             validatedInfo = None
         sequence = sequence.upper()
-        makeEntry(sequence,0,locusName,validatedInfo='a:'+validatedInfo if validatedInfo else 'a',
-                  manualRevision=True)
-    
+        entries.append((sequence,locusName,'a:'+validatedInfo if validatedInfo else 'a'))
+    if bulk: makeBulkEntries(entries,manualRevision=True)
+    else:
+        for sequence,locusName,validatedInfo in entries:
+            makeEntry(sequence,0,locusName,validatedInfo=validatedInfo,manualRevision=True)
+
+def makeBulkEntries(entries,labID='NA',passphrase='NA',technology='Illumina',filterLevel=None,
+                    manualRevision=False,population='NA',chunkSize=100):
+    """
+    Adds entries, a list of (sequence,locusName,validatedInfo) tuples, to the database as makeEntry would do
+    for each sequence separately (with seqCount 0 and without primers), but with one connection and in one
+    transaction: if an entry fails, none are added.
+    validatedInfo is 'a[:X[:R#repeat]]' or 'NA' (see makeEntry).
+    Sequences and loci are resolved with set-based queries, BASEtrack is filled with multi-row inserts of chunkSize
+    entries and BASEstat with executemany.
+    Returns the entryIDs.
+    """
+    with login.session() as sql:
+        #Check authentification of submitting institution
+        sql.execute("SELECT passphrase FROM laboratories WHERE labID = %s", (labID,))
+        if sql.rowcount == 0: raise Exception("Lab identifier not known, register first")
+        elif sql.fetchone()['passphrase'] != passphrase: raise Exception("Passphrase for "+labID+" not correct!")
+
+        #BASEseqs
+        seqIDs = getSeqIDs([sequence for sequence,locusName,validatedInfo in entries],sql)
+
+        #BASEnames, new loci get the locusType of their first entry (locus names are compared case insensitive)
+        newLoci = {}
+        for sequence,locusName,validatedInfo in entries:
+            if locusName.upper() in newLoci: continue
+            newLoci[locusName.upper()] = (locusName,int(validatedInfo[validatedInfo.index(':R')+2:]) 
+                                          if ':R' in validatedInfo else None)
+        if newLoci:
+            sql.execute("SELECT locusName FROM BASEnames WHERE locusName IN ("+','.join(['%s']*len(newLoci))+")",
+                        [newLoci[locus][0] for locus in newLoci])
+            for locus in sql.fetchall(): newLoci.pop(locus['locusName'].upper(),None)
+        if newLoci:
+            sql.executemany("""INSERT INTO BASEnames (locusName,locusType,ref_alleleNumber,ref_seqID,mask_seqID) 
+                            VALUES (%s,%s,NULL,NULL,NULL)""",list(newLoci.values()))
+
+        #BASEqual
+        qualID = getQualID(technology,filterLevel,sql)
+
+        #BASEtrack, a multi-row insert gets consecutive AUTO_INCREMENT entryIDs starting from its lastrowid
+        #(LAST_INSERT_ID() gives the first entryID of the statement)
+        entryIDs = []
+        for i in range(0,len(entries),chunkSize):
+            chunk = entries[i:i+chunkSize]
+            sql.execute("""
+            INSERT INTO BASEtrack (locusName, qualID, labID, validated, manualRevision, 
+            nrSeqs, nrReads,population) VALUES """+','.join(['(%s,%s,%s,%s,%s,%s,%s,%s)']*len(chunk)),
+                        [value for sequence,locusName,validatedInfo in chunk for value in
+                         (locusName,qualID,labID,bool(validatedInfo),manualRevision,1,0,population)])
+            entryIDs+=range(sql.lastrowid,sql.lastrowid+len(chunk))
+
+        #BASEstat
+        sql.executemany("""INSERT INTO BASEstat (entryID, seqID, primersetID,
+        validated, alleleValidation, seqCount)
+        VALUES (%s,%s,%s,%s,%s,%s)""",
+                        [(entryID,seqIDs[sequence],None,0 if ('a:' in validatedInfo or validatedInfo == 'a') else -1,
+                          validatedInfo[2:] if 'a:' in validatedInfo and validatedInfo != 'a:' else None,0)
+                         for entryID,(sequence,locusName,validatedInfo) in zip(entryIDs,entries)])
+    return entryIDs
     
 #    import xml.etree.ElementTree as ET
 #    entries = ET.Element('entries')
@@ -741,37 +1315,49 @@ def processLociNames():
                        WHERE locusName = %s AND BASEstat.validated = 0""", (name,))
         locAlleles={(s['seq'],s['alleleValidation']) for s in sql.fetchall()}
         
-        #At this point all alleles for a locus are gathered and relevant information needs to be extracted:
-         #Reference allele and primers
-        if kitFileVersion < 2.0: #Old loci config file processing
-            reference_allele,(primerF,primerR) = getRefAllel(primersets,locAlleles)
-        else: #Config file 2.0 and later processing
-            sql.execute("SELECT getSeq(ref_seqID) FROM BASEnames WHERE locusName = %s", (name,))
-            reference_allele = sql.fetchone()['getSeq(ref_seqID)']
-            if len(primersets) != 1:
-                raise NotImplementedError("There should not be more than one primerset per locus for version 2 configurations")
-            primerF,primerR = primersets.pop()
-        primerR = complement(primerR) #Revert primerR back to complementary strand
-          
-         #Locustype
-        sql.execute("""SELECT locusType FROM BASEnames WHERE locusName = %s""", (name,))
-        locusType = sql.fetchone()['locusType']
-        if kitFileVersion < 2.0 and locusType != 0 and ':R' in reference_allele[1]:
-            reference_allele=(reference_allele[0],reference_allele[1][:reference_allele[1].index(':R')])
-        elif locusType != 0:
-            sql.execute("""SELECT ref_alleleNumber FROM BASEnames WHERE locusName = %s""", (name,))
-            reference_allele=(reference_allele,sql.fetchone()['ref_alleleNumber'])
-                
-         #Initial flanking regions
-        flank_forwardP,flank_reverseP = getLocusFlanks(locAlleles,primerF,primerR)
-         #Calculate ref_length
-        ref_length = len(reference_allele[0]) - len(primerF) - len(primerR) - len(flank_forwardP) - len(flank_reverseP)
+        #At this point all alleles for a locus are gathered and relevant information needs to be extracted
+        sql.execute("""SELECT locusType,getSeq(ref_seqID) AS refseq,ref_alleleNumber FROM BASEnames 
+                       WHERE locusName = %s""", (name,))
+        base = sql.fetchone()
         #Insert into LOCInames
         sql.execute("""INSERT INTO LOCInames (locusName,locusType,refseq,ref_forwardP,ref_reverseP,
-        flank_forwardP,flank_reverseP,ref_length,ref_alleleNumber) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
-                    ,(name,locusType,reference_allele[0],primerF,primerR,flank_forwardP,flank_reverseP,
-                      ref_length,reference_allele[1]))        
+        flank_forwardP,flank_reverseP,ref_length,ref_alleleNumber) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+                    getLocusNamesRow(name,base['locusType'],primersets,locAlleles,kitFileVersion,
+                                     refseq=base['refseq'],ref_alleleNumber=base['ref_alleleNumber']))
     logout(conn,sql)
+
+def getLocusNamesRow(name,locusType,primersets,locAlleles,kitFileVersion,refseq=None,ref_alleleNumber=None):
+    """
+    Extracts the LOCInames information for locus name from its base information:
+        primersets => set of (forward primer,complement of reverse primer)
+        locAlleles => set of (validated allele sequence,alleleValidation)
+        refseq,ref_alleleNumber => reference information in BASEnames (config file 2.0 and later)
+    Returns the LOCInames row (locusName,locusType,refseq,ref_forwardP,ref_reverseP,flank_forwardP,flank_reverseP,
+        ref_length,ref_alleleNumber)
+    primersets and locAlleles can be changed in the process.
+    """
+     #Reference allele and primers
+    if kitFileVersion < 2.0: #Old loci config file processing
+        reference_allele,(primerF,primerR) = getRefAllel(primersets,locAlleles)
+    else: #Config file 2.0 and later processing
+        reference_allele = refseq
+        if len(primersets) != 1:
+            raise NotImplementedError("There should not be more than one primerset per locus for version 2 configurations")
+        primerF,primerR = primersets.pop()
+    primerR = complement(primerR) #Revert primerR back to complementary strand
+      
+     #Locustype
+    if kitFileVersion < 2.0 and locusType != 0 and ':R' in reference_allele[1]:
+        reference_allele=(reference_allele[0],reference_allele[1][:reference_allele[1].index(':R')])
+    elif locusType != 0:
+        reference_allele=(reference_allele,ref_alleleNumber)
+            
+     #Initial flanking regions
+    flank_forwardP,flank_reverseP = getLocusFlanks(locAlleles,primerF,primerR)
+     #Calculate ref_length
+    ref_length = len(reference_allele[0]) - len(primerF) - len(primerR) - len(flank_forwardP) - len(flank_reverseP)
+    return (name,locusType,reference_allele[0],primerF,primerR,flank_forwardP,flank_reverseP,
+            ref_length,reference_allele[1])
     
 def getRefAllel(primersets,locAlleles):
     """
@@ -901,6 +1487,95 @@ def processLociAlleles(flush=True):
                             (alleleNomen,locusName,allele))
     logout(conn,sql)
 
+def getLocusAllelesRows(locus,locAlleles,kitFileVersion):
+    """
+    Returns the LOCIalleles rows (locusName,alleleNumber,alleleNomen,alleleSeq) for the validated alleles 
+    locAlleles (set of (sequence,alleleValidation)) of locus (dict with LOCInames' columns), 
+    as processLociAlleles(flush=True) inserts them.
+    """
+    rows = {} #alleleSeq (upper case, as the database compares sequences case insensitive) => row
+    for allele,alleleNomen in locAlleles:
+        allele = flankOutAllele(locus,allele)
+        alleleNumber = calculateAlleleNumber(allele,locus)
+        if allele.upper() not in rows:
+            rows[allele.upper()] = [locus['locusName'],alleleNumber,None,allele]
+            #Set version in alleleNomen for STR alleles with same number
+            if kitFileVersion < 2.0 and locus['locusType'] != 0:
+                alleleCount = (0 if alleleNumber is None else #alleleNumber is stored as DOUBLE(4,1)
+                               len([r for r in rows.values() if r[1] is not None and 
+                                    round(float(r[1]),1) == round(float(alleleNumber),1)]))
+                rows[allele.upper()][2]='['+chr(ord('a')+alleleCount-1)+']' 
+                    #todo# only intended to work up to 26 same alleleNumber types
+        #If not STR locus
+        if kitFileVersion >= 2.0 or (not alleleNumber and alleleNomen):
+            rows[allele.upper()][2] = alleleNomen
+    return [tuple(row) for row in rows.values()]
+
+def processLoci(onlyChanged=True):
+    """
+    Set-based alternative for processLociNames followed by processLociAlleles: 
+    the base tables are read with three joined queries, flanks and allele numbers are calculated in Python,
+    and LOCInames and LOCIalleles are written in bulk, all in one transaction.
+    If onlyChanged, only loci whose base information (BASEnames, BASEprimersets and validated alleles) changed
+    since the last run with the same MyFLq version are processed again. The digests of the base information
+    and the version are kept in LOCIdigests.
+    Returns the names of the processed loci.
+    """
+    import hashlib
+    with login.session() as sql:
+        #Base information
+        sql.execute("""SELECT locusName,locusType,ref_seqID,sequence AS refseq,ref_alleleNumber FROM BASEnames
+                       LEFT JOIN BASEseqs ON ref_seqID = seqID""")
+        baseNames = {s['locusName']:s for s in sql.fetchall()}
+        kitFileVersion = 2.0 if any(s['ref_seqID'] is not None for s in baseNames.values()) else 1.0
+        primersets = {name:set() for name in baseNames}
+        sql.execute("""SELECT locusName,forwards.sequence AS fP,reverses.sequence AS rP FROM BASEprimersets
+                       JOIN BASEseqs AS forwards ON forwardP = forwards.seqID
+                       JOIN BASEseqs AS reverses ON reverseP = reverses.seqID""")
+        for s in sql.fetchall(): primersets[s['locusName']].add((s['fP'],complement(s['rP'])))
+        locAlleles = {name:set() for name in baseNames}
+        sql.execute("""SELECT locusName,sequence AS seq,alleleValidation FROM BASEtrack
+                       JOIN BASEstat USING (entryID) JOIN BASEseqs USING (seqID)
+                       WHERE BASEstat.validated = 0""")
+        for s in sql.fetchall(): locAlleles[s['locusName']].add((s['seq'],s['alleleValidation']))
+
+        #Loci to process
+        digests = {name:hashlib.sha1(repr((version,kitFileVersion,sorted(baseNames[name].items()),
+                                           sorted(map(repr,primersets[name])),
+                                           sorted(map(repr,locAlleles[name])))).encode()).digest()
+                   for name in baseNames}
+        sql.execute("SELECT locusName,digest FROM LOCIdigests JOIN LOCInames USING (locusName)")
+        previous = {s['locusName']:bytes(s['digest']) for s in sql.fetchall()}
+        changed = sorted(name for name in baseNames if not onlyChanged or previous.get(name) != digests[name])
+        if onlyChanged:
+            sql.execute("SELECT locusName FROM LOCInames")
+            obsolete = [s['locusName'] for s in sql.fetchall() if s['locusName'] not in baseNames]
+            for table in ('LOCInames','LOCIalleles','LOCIdigests'):
+                for names in (changed,obsolete):
+                    if names: sql.execute("DELETE FROM "+table+" WHERE locusName IN ("+','.join(['%s']*len(names))+")",
+                                          names)
+        else:
+            for table in ('LOCInames','LOCIalleles','LOCIdigests'): sql.execute("DELETE FROM "+table+" WHERE TRUE")
+        if not changed: return changed
+
+        #LOCInames
+        sql.executemany("""INSERT INTO LOCInames (locusName,locusType,refseq,ref_forwardP,ref_reverseP,
+        flank_forwardP,flank_reverseP,ref_length,ref_alleleNumber) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+                        [getLocusNamesRow(name,baseNames[name]['locusType'],primersets[name],set(locAlleles[name]),
+                                          kitFileVersion,refseq=baseNames[name]['refseq'],
+                                          ref_alleleNumber=baseNames[name]['ref_alleleNumber']) for name in changed])
+
+        #LOCIalleles, with the LOCInames rows as stored
+        sql.execute("SELECT * FROM LOCInames WHERE locusName IN ("+','.join(['%s']*len(changed))+")",changed)
+        alleleRows = []
+        for locus in sql.fetchall(): 
+            alleleRows+=getLocusAllelesRows(locus,locAlleles[locus['locusName']],kitFileVersion)
+        sql.executemany("INSERT INTO LOCIalleles (locusName,alleleNumber,alleleNomen,alleleSeq) VALUES (%s,%s,%s,%s)",
+                        alleleRows)
+        sql.executemany("INSERT INTO LOCIdigests (locusName,digest) VALUES (%s,%s)",
+                        [(name,digests[name]) for name in changed])
+    return changed
+
 #Flankout allele
 def flankOutAllele(locus,allele):
     """
@@ -975,8 +1650,156 @@ def calculateAlleleNumber(regionOfInterest,locus):
 # #Most of the functions and methods in this section are intended to be run only once on a dataset of reads.
 # #If you want to reanalyze the same dataset differently, you have to restart from the beginning.
 
+#Primer search
+class PrimerAutomaton:
+    """
+    Aho-Corasick automaton for all primers of a locusDict: forward primer, reverse primer complement,
+    forward primer complement and reverse primer, for each locus.
+    Built once for an analysis, it finds all primer occurrences in a read with a single pass over the read.
+    """
+    def __init__(self,locusDict):
+        from collections import deque
+        self.loci = list(locusDict)
+        self.patterns = [] #(locus index, slot in count tuple, primer)
+        for li,locus in enumerate(self.loci):
+            forwardP,reverseP = locusDict[locus]['ref_forwardP'],locusDict[locus]['ref_reverseP']
+            for slot,primer in enumerate((forwardP,complement(reverseP),complement(forwardP),reverseP)):
+                self.patterns.append((li,slot,primer))
+        #Trie
+        goto,output = [{}],[[]]
+        for pi,(li,slot,primer) in enumerate(self.patterns):
+            state = 0
+            for base in primer:
+                if base not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][base] = len(goto)-1
+                state = goto[state][base]
+            if primer: output[state].append(pi)
+        #Failure links turned into a full transition table (breadth first, so shorter states are ready first)
+        alphabet = {base for g in goto for base in g}
+        fail,delta = [0]*len(goto),[None]*len(goto)
+        queue = deque([0])
+        while queue:
+            state = queue.popleft()
+            delta[state] = {base:(goto[state][base] if base in goto[state] else
+                                  (delta[fail[state]][base] if state else 0)) for base in alphabet}
+            if state: output[state] = output[state] + output[fail[state]]
+            for base,nextState in goto[state].items():
+                fail[nextState] = delta[fail[state]][base] if state else 0
+                queue.append(nextState)
+        self.delta = delta
+        self.output = {state:tuple((pi,len(self.patterns[pi][2])) for pi in o) for state,o in enumerate(output) if o}
+        self.emptyPatterns = [pi for pi,(li,slot,primer) in enumerate(self.patterns) if not primer]
+
+    def countPrimers(self,seq):
+        """
+        Returns a list of (locus,(countF,countR,countFc,countRc)) for the loci with primers in seq,
+        in locusDict order. Counts are non-overlapping, as with str.count.
+        """
+        delta,output = self.delta,self.output
+        found = {} #pattern index => [count, end of last counted occurrence]
+        state = 0
+        for end,base in enumerate(seq):
+            state = delta[state].get(base,0)
+            if state in output:
+                for pi,length in output[state]:
+                    try:
+                        if end-length+1 >= found[pi][1]: found[pi] = [found[pi][0]+1,end+1]
+                    except KeyError: found[pi] = [1,end+1]
+        for pi in self.emptyPatterns: found[pi] = [len(seq)+1,None]
+        counts = {}
+        for pi in found:
+            li,slot,primer = self.patterns[pi]
+            if li not in counts: counts[li] = [0,0,0,0]
+            counts[li][slot] = found[pi][0]
+        return [(self.loci[li],tuple(counts[li])) for li in sorted(counts)]
+
+#Compiled locusDict
+class LocusIndex(dict):
+    """
+    A locusDict (locusName => locus info) compiled for processing reads. It is built once for an analysis,
+    after Analysis.prepLocusDict, as that changes the flanks. Lookups by locusName still return the locus info,
+    next to it the index holds what would otherwise be recalculated for every read:
+        complements => locusName => complements of 'ref_forwardP','ref_reverseP','flank_forwardP','flank_reverseP'
+        flanks => locusName => {'forward':(compressed flank,flank end homopolymer length),'reverse':(...)}
+        flankKmers => flank => k-mer index of the flank, for the flanks and compressed flanks of all loci
+                      (see indexFlank)
+        kmers => locusName => k-mer sets for extraMethod (see Read.assignLocus), None without extraMethod
+        primerAutomaton => PrimerAutomaton for all primers
+    Instances can be pickled, to pass them on to other processes.
+    """
+    def __init__(self,locusDict,extraMethod=None):
+        dict.__init__(self,locusDict)
+        self.extraMethod = extraMethod
+        self.complements = {locus:{key:complement(self[locus][key]) if self[locus][key] else self[locus][key]
+                                   for key in ('ref_forwardP','ref_reverseP','flank_forwardP','flank_reverseP')}
+                            for locus in self}
+        self.flanks = {locus:{'forward':LocusIndex.compressFlank(self[locus]['flank_forwardP']),
+                              'reverse':LocusIndex.compressFlank(self[locus]['flank_reverseP'])}
+                       for locus in self}
+        self.flankKmers = {flank:LocusIndex.indexFlank(flank) for locus in self 
+                           for flank in (self[locus]['flank_forwardP'],self[locus]['flank_reverseP'],
+                                         self.flanks[locus]['forward'][0],self.flanks[locus]['reverse'][0])
+                           if flank}
+        self.kmers = ({locus:LocusIndex.getKmerSets(self[locus],extraMethod) for locus in self}
+                      if extraMethod else None)
+        self.primerAutomaton = PrimerAutomaton(self)
+
+    @staticmethod
+    def compressFlank(flank):
+        """
+        Returns the compressed flank and its end homopolymer length, as used by Read.getFlankIndex with useCompress
+        """
+        if not flank: return (flank,None)
+        flankEndHPL = -1 # starts with -1 as not to correct for single base 'homopolymer'
+        for i in range(len(flank)-1,-1,-1):
+            if flank[-1] != flank[i]: break
+            flankEndHPL+=1
+        return (compress(flank),flankEndHPL)
+
+    @staticmethod
+    def indexFlank(flank):
+        """
+        Returns the k-mer index of a flank, as used by Read.getFlankIndex: for each flank position a bytearray,
+        that has at index k whether the k-mer ending at that position (flank[position-k+1:position+1])
+        can overlap itself in a sequence (has a border: a proper prefix that is also a suffix).
+        The borders of all k-mers starting at the same position are found with the KMP failure function.
+        """
+        selfOverlapping = [bytearray(position+2) for position in range(len(flank))]
+        for start in range(len(flank)):
+            kmer,failure,border = flank[start:],[0,0],0
+            for i in range(1,len(kmer)):
+                while border and kmer[i] != kmer[border]: border = failure[border]
+                if kmer[i] == kmer[border]: border+=1
+                failure.append(border)
+                if border: selfOverlapping[start+i][i+1] = 1
+        return selfOverlapping
+
+    @staticmethod
+    def getKmerSets(locusInfo,extraMethod):
+        """
+        Returns the k-mer sets of a locus for k-mer locus assignment (extraMethod, see Read.assignLocus)
+            ('k-mer',x) => primer k-mers: 'forward','reverse_complement','forward_complement','reverse'
+            ('refseq-k-mer',x) => reference sequence k-mers: 'forward','reverse'
+        """
+        kmerSize = extraMethod[1]
+        if extraMethod[0]=='k-mer':
+            kIDs={'forward':{locusInfo['ref_forwardP'][i:i+kmerSize]
+                             for i in range(len(locusInfo['ref_forwardP'])-kmerSize+1)},
+                  'reverse_complement':{locusInfo['ref_reverseP'][i:i+kmerSize]
+                                        for i in range(len(locusInfo['ref_reverseP'])-kmerSize+1)}}
+            kIDs['forward_complement']={complement(l) for l in kIDs['forward']}
+            kIDs['reverse']={complement(l) for l in kIDs['reverse_complement']}
+        elif extraMethod[0]=='refseq-k-mer':
+            kIDs={'forward':{locusInfo['refseq'][i:i+kmerSize] for i in range(len(locusInfo['refseq'])-kmerSize+1)}}
+            kIDs['reverse']={complement(k) for k in kIDs['forward']}
+        return kIDs
+
 #General Fastq reads
 class Read:
+    count = 1 #number of identical raw reads the instance stands for (see Analysis.processReads)
+    flankScoreSums = [] #row i => prefix sums of the k-mer scores int((i*ii)**0.5) (see getFlankIndex)
     def __init__(self,fastqEntry):
         """
         Expects a list of length 4 with the typical lines of 1 Fastq entry (def-line1,seq,def-line2,qual)
@@ -997,19 +1820,28 @@ class Read:
     def __len__(self):
         return len(self.seq)
     
-    def assignLocus(self,locusDict,extraMethod=None):
+    def assignLocus(self,locusDict,extraMethod=None,primerAutomaton=None):
         """
         Determines to which locus the read belongs.
         Limited by the loci present in locusDict.
         Possibilities for extraMethod:
             => ('k-mer',x) with x the size of the k-mer used for identifying loci primers
             => ('refseq-k-mer',x)
+        If primerAutomaton (PrimerAutomaton for locusDict), primers are counted for all loci at once,
+            otherwise each locus' primers are counted separately.
+        If locusDict is a LocusIndex, its primerAutomaton and k-mer sets are used.
         """
-        for locus in locusDict:
-            countF=self.seq.count(locusDict[locus]['ref_forwardP'])
-            countR=self.seq.count(complement(locusDict[locus]['ref_reverseP']))
-            countFc=self.seq.count(complement(locusDict[locus]['ref_forwardP']))
-            countRc=self.seq.count(locusDict[locus]['ref_reverseP'])
+        if isinstance(locusDict,LocusIndex) and not primerAutomaton: primerAutomaton = locusDict.primerAutomaton
+        seq = self.seq
+        if primerAutomaton: primerCounts = primerAutomaton.countPrimers(seq) #only loci with primers in read
+        else: primerCounts = [(locus,None) for locus in locusDict]
+        for locus,counts in primerCounts:
+            if counts and self.seq is seq: countF,countR,countFc,countRc = counts
+            else: #Counted on the read as it is now, it could have been complemented for a previous locus
+                countF=self.seq.count(locusDict[locus]['ref_forwardP'])
+                countR=self.seq.count(complement(locusDict[locus]['ref_reverseP']))
+                countFc=self.seq.count(complement(locusDict[locus]['ref_forwardP']))
+                countRc=self.seq.count(locusDict[locus]['ref_reverseP'])
             #todo# check indices => forward primer logically has to come before reverse in the sequence
             if (countF+countR+countFc+countRc) > 2 or max(countF,countR,countFc,countRc) > 1:
                 if 'ambiguousLocus' in self.qualLog:
@@ -1034,40 +1866,31 @@ class Read:
             kmerSize = extraMethod[1]
             kID = {self.seq[i:i+kmerSize] for i in range(len(self.seq)-kmerSize+1)}
             
-            #Add loci primer kID's if necessary, including reverse strand orientation
-            if extraMethod[0]=='k-mer' and not 'primer-kIDs' in locusDict[list(locusDict.keys())[0]]:
-                for locus in locusDict.keys():
-                    locusDict[locus]['primer-kIDs']={'forward':{locusDict[locus]['ref_forwardP'][i:i+kmerSize]
-                                        for i in range(len(locusDict[locus]['ref_forwardP'])-kmerSize+1)},
-                                     'reverse_complement':{locusDict[locus]['ref_reverseP'][i:i+kmerSize] 
-                                        for i in range(len(locusDict[locus]['ref_reverseP'])-kmerSize+1)}}
-                    locusDict[locus]['primer-kIDs']['forward_complement']={complement(l) 
-                                                                for l in locusDict[locus]['primer-kIDs']['forward']}
-                    locusDict[locus]['primer-kIDs']['reverse']={complement(l) 
-                                                        for l in locusDict[locus]['primer-kIDs']['reverse_complement']}
-            elif extraMethod[0]=='refseq-k-mer' and not 'refseq-kIDs' in locusDict[list(locusDict.keys())[0]]:
-                for locus in locusDict.keys():
-                    locusDict[locus]['refseq-kIDs']={'forward':{locusDict[locus]['refseq'][i:i+kmerSize] 
-                                                        for i in range(len(locusDict[locus]['refseq'])-kmerSize+1)}}
-                    locusDict[locus]['refseq-kIDs']['reverse']={complement(k) 
-                                                                for k in locusDict[locus]['refseq-kIDs']['forward']}
+            #Loci primer (or refseq) kID's, including reverse strand orientation
+            if isinstance(locusDict,LocusIndex) and locusDict.extraMethod == extraMethod: kIDs = locusDict.kmers
+            else: #Add to locusDict if necessary
+                kIDsKey = 'primer-kIDs' if extraMethod[0]=='k-mer' else 'refseq-kIDs'
+                if not kIDsKey in locusDict[list(locusDict.keys())[0]]:
+                    for locus in locusDict.keys():
+                        locusDict[locus][kIDsKey] = LocusIndex.getKmerSets(locusDict[locus],extraMethod)
+                kIDs = {locus:locusDict[locus][kIDsKey] for locus in locusDict}
             #pdb.set_trace()
             #Calculate loci scores
             if extraMethod[0]=='k-mer': lociScores = {locus: #=> per locus tuple score for forward and reverse strand
-                          (len(locusDict[locus]['primer-kIDs']['forward'] & kID) - 
-                           len(locusDict[locus]['primer-kIDs']['forward'] - kID) +
-                           len(locusDict[locus]['primer-kIDs']['reverse'] & kID) - 
-                           len(locusDict[locus]['primer-kIDs']['reverse'] - kID),
-                           len(locusDict[locus]['primer-kIDs']['forward_complement'] & kID) - 
-                           len(locusDict[locus]['primer-kIDs']['forward_complement'] - kID) +
-                           len(locusDict[locus]['primer-kIDs']['reverse_complement'] & kID) - 
-                           len(locusDict[locus]['primer-kIDs']['reverse_complement'] - kID))
+                          (len(kIDs[locus]['forward'] & kID) - 
+                           len(kIDs[locus]['forward'] - kID) +
+                           len(kIDs[locus]['reverse'] & kID) - 
+                           len(kIDs[locus]['reverse'] - kID),
+                           len(kIDs[locus]['forward_complement'] & kID) - 
+                           len(kIDs[locus]['forward_complement'] - kID) +
+                           len(kIDs[locus]['reverse_complement'] & kID) - 
+                           len(kIDs[locus]['reverse_complement'] - kID))
                           for locus in locusDict}
             elif extraMethod[0]=='refseq-k-mer': lociScores = {locus:
-                          (len(locusDict[locus]['refseq-kIDs']['forward'] & kID) - 
-                           len(locusDict[locus]['refseq-kIDs']['forward'] - kID),
-                           len(locusDict[locus]['refseq-kIDs']['reverse'] & kID) - 
-                           len(locusDict[locus]['refseq-kIDs']['reverse'] - kID))
+                          (len(kIDs[locus]['forward'] & kID) - 
+                           len(kIDs[locus]['forward'] - kID),
+                           len(kIDs[locus]['reverse'] & kID) - 
+                           len(kIDs[locus]['reverse'] - kID))
                           for locus in locusDict}
             maximumScore = sorted(lociScores.values(),key=lambda x:max(x))[-1]
             if [s for l in lociScores for s in lociScores[l]].count(max(maximumScore)) != 1: 
@@ -1098,11 +1921,13 @@ class Read:
         except KeyError:
             if not self.locus: return #In case of not assigned reads
             else: raise
-        try: reverse_i = self.seq.index(complement(locusDict[self.locus]['ref_reverseP']))
+        reverseP_c = (locusDict.complements[self.locus]['ref_reverseP'] if isinstance(locusDict,LocusIndex) else
+                      complement(locusDict[self.locus]['ref_reverseP']))
+        try: reverse_i = self.seq.index(reverseP_c)
         except ValueError:
             #For reverse primer both primer and sequence are reversed to find position analogously to forward primer 
             #(closest to the center)
-            aln = Alignment(complement(locusDict[self.locus]['ref_reverseP'])[::-1],self.seq[::-1],mode='primer-search')
+            aln = Alignment(reverseP_c[::-1],self.seq[::-1],mode='primer-search')
             reverse_i = len(self.seq)-len([a[1] for a in aln.alnment if a[1]!='-'])
         if keepDump: self.qualLog['dumpedEnds']={'forwardP':{'seq':self.seq[:forward_i],'qual':self.qual[:forward_i]}
                                         ,'reverseP':{'seq':self.seq[reverse_i:],'qual':self.qual[reverse_i:]}}
@@ -1127,11 +1952,16 @@ class Read:
         if autoPrimerOut: self.primerOut(locusDict,keepDump=keepDump)
         #Cut flanks
         #pdb.set_trace()
+        compressedF,compressedR = ((locusDict.flanks[self.locus]['forward'],locusDict.flanks[self.locus]['reverse'])
+                                   if isinstance(locusDict,LocusIndex) else ((None,None),(None,None)))
+        flankKmers = locusDict.flankKmers if isinstance(locusDict,LocusIndex) else None
         try:
             indexF,qualF = Read.getFlankIndex(self.seq,locusDict[self.locus]['flank_forwardP'],'forward',
-                                              useCompress=useCompress,withAlignment=withAlignment)
+                                              useCompress=useCompress,withAlignment=withAlignment,
+                                              compressedFlank=compressedF,flankKmers=flankKmers)
             indexR,qualR = Read.getFlankIndex(self.seq,locusDict[self.locus]['flank_reverseP'],'reverse',
-                                              useCompress=useCompress,withAlignment=withAlignment)
+                                              useCompress=useCompress,withAlignment=withAlignment,
+                                              compressedFlank=compressedR,flankKmers=flankKmers)
             self.qualLog['cleanFlanks'] = (qualF,qualR) 
             if keepDump: self.qualLog['dumpedEnds'].update({
                             'flankF':{'seq':self.seq[:indexF],'qual':self.qual[:indexF]},
@@ -1149,6 +1979,32 @@ class Read:
             self.seq='[-]'
         #if 'N' in self.seq or 'n' in self.seq: self.locus = False #todo# better strategy for bad reads
     
+    def process(self,locusDict,extraMethod=None,useCompress=False,withAlignment=False):
+        """
+        Assigns the read to a locus and flanks it out, as Analysis.processReads does for each distinct read.
+        Reads that can not be flanked out are unassigned.
+        Returns self
+        """
+        self.assignLocus(locusDict,extraMethod=extraMethod)
+        #For small reads, were the primers are larger than the read it self an exception will be returned
+        #those reads should be marked as unsuitable
+        try: self.flankOut(locusDict,useCompress=useCompress,withAlignment=withAlignment)
+        except:
+            self.locus = False
+        return self
+
+    @staticmethod
+    def mapQual(mapping,qual):
+        """
+        Returns the part of quality string qual that corresponds to mapping, the processed version of
+        range(len(qual)). If mapping is a LocusConflictError, a new one is returned with mapped message.
+        """
+        if isinstance(mapping,LocusConflictError):
+            if type(mapping.message) != tuple: return LocusConflictError(mapping.value,mapping.message)
+            return LocusConflictError(mapping.value,(mapping.message[0],Read.mapQual(mapping.message[1],qual)))
+        if mapping.step == 1: return qual[mapping.start:mapping.stop]
+        return qual[mapping.start:mapping.stop if mapping.stop >= 0 else None:mapping.step]
+
     @staticmethod
     def getReads(fqFilename,randomSubset=None):
         """
@@ -1159,30 +2015,68 @@ class Read:
             (seq line and quality line the same, so unusable for quality analysis)
         If randomSubset (float 0 < x < 1), a number approximating randomSubset*reads of reads is returned
         If it is desired that the exact same subset is generated => e.g.: from random import seed; seed(1000)
+        The file is read in batches, see getReadBatches
+        """
+        for seqs,quals in Read.getReadBatches(fqFilename,randomSubset):
+            for seq,qual in zip(seqs,quals): yield Read((None,seq,None,qual))
+
+    @staticmethod
+    def getReadBatches(fqFilename,randomSubset=None,blockSize=2**22):
+        """
+        Reads a fastq file (plain, gzip or bgzip compressed) in binary blocks of blockSize bytes, and yields 
+        batches of reads as a tuple of two lists: sequences and quality strings (stripped, as by Read).
+        Only the sequence and quality lines of a block are kept, no Read instances are made.
+        If fqFilename.endswith('fasta'): a one-lined fasta is read line by line (see fastaReader),
+            its batches have the sequences as quality strings.
+        randomSubset as for getReads, the same random seed gives the same subset
         """
         if randomSubset: from random import random
-        legacy = True if fqFilename.endswith(('fasta','fasta.gz')) else False
-        #Open gz compressed file
         if fqFilename.endswith('.gz'):
             import gzip
-            fq=gzip.open(fqFilename, mode='rt')
-        #Open normal file
-        else: fq=open(fqFilename)
-        #Fasta wrapper to generate one-lined fasta
-        if legacy: fq = fastaReader(fq)
-
-        fqcount=4 # == size of fq entry
-        for line in fq:
-            if (fqcount%4)==0: read=[line]
-            else: read.append(line)
-            if (fqcount%4)==3:
-                if not randomSubset or (random() < randomSubset): yield Read(read)
-            fqcount+=1
-            if legacy and (fqcount%4)==2:
-                read.append(read[0])
-                read.append(read[1])
-                if not randomSubset or (random() < randomSubset): yield Read(read)
-                fqcount=4
+            fq=gzip.open(fqFilename, mode='rb') #multi-member gzip, so also bgzip
+        else: fq=open(fqFilename, mode='rb')
+        try:
+            if fqFilename.endswith(('fasta','fasta.gz')):
+                import io
+                lines = [] #fasta entries in the same 4 line structure as fastq
+                for line in fastaReader(io.TextIOWrapper(fq)):
+                    lines.append(line)
+                    if len(lines) % 2 == 0: lines+=lines[-2:]
+                    if len(lines) >= 4*2**14:
+                        yield Read.makeBatch(lines,random if randomSubset else None,randomSubset)
+                        lines = []
+                if lines: yield Read.makeBatch(lines,random if randomSubset else None,randomSubset)
+                return
+            lines,rest = [],b''
+            while True:
+                block = fq.read(blockSize)
+                if not block: #last line does not need to end with a newline
+                    if rest: lines.append(rest.decode())
+                    if len(lines) >= 4: yield Read.makeBatch(lines[:len(lines)//4*4],random if randomSubset else None,
+                                                             randomSubset)
+                    return
+                block = rest+block
+                lastLine = block.rfind(b'\n')+1
+                block,rest = block[:lastLine],block[lastLine:]
+                if not block: continue
+                lines+=block.decode().split('\n')[:-1]
+                complete = len(lines)//4*4
+                if complete:
+                    yield Read.makeBatch(lines[:complete],random if randomSubset else None,randomSubset)
+                    lines = lines[complete:]
+        finally: fq.close()
+
+    @staticmethod
+    def makeBatch(lines,random=None,randomSubset=None):
+        """
+        Returns the batch (sequences,quality strings) for a list of fastq lines.
+        If random, each read is only kept if random() < randomSubset
+        """
+        seqs,quals = list(map(str.strip,lines[1::4])),list(map(str.strip,lines[3::4]))
+        if random:
+            keep = [random() < randomSubset for s in seqs]
+            seqs,quals = [s for s,k in zip(seqs,keep) if k],[q for q,k in zip(quals,keep) if k]
+        return seqs,quals
         
     @staticmethod
     def selfAssignLocus(reads,locusDict,extraMethod=None):
@@ -1195,7 +2089,8 @@ class Read:
         return [read.assignLocus(locusDict,extraMethod=extraMethod) for read in reads]
         
     @staticmethod
-    def getFlankIndex(seq,flank,orientation,useCompress=False,withAlignment=False):
+    def getFlankIndex(seq,flank,orientation,useCompress=False,withAlignment=False,compressedFlank=(None,None),
+                      flankKmers=None):
         """
         Expects: sequence, flank sequence, and orientation of flank (forward or reverse)
         The sequence itself always has to be given in forward orientation.
@@ -1204,6 +2099,17 @@ class Read:
         Assumes the starting position of the sequence and flank are the same (in forward orientation)
         If useCompress, the homopolymer compression is applied to avoid common homopolymer errors
         If withAlignment, the Alignment class is used with its flank index functionality
+        compressedFlank can provide the precalculated (compressed flank,flank end homopolymer length)
+            (see LocusIndex.compressFlank)
+        flankKmers can provide the precalculated k-mer indexes of flanks (see LocusIndex.flankKmers)
+
+        Without alignment, the flank k-mers are searched in the sequence: for each flank position (from the end),
+        the k-mers ending there are located in the sequence (growing k, while found), and for each the
+        (non-overlapping) occurrence closest to the flank position gives a candidate index. 
+        The candidate with the best score wins.
+        Only for k-mers that can overlap themselves (see LocusIndex.indexFlank) all occurrences are walked,
+        for the others the closest occurrence before and after the flank position suffice. Once a k-mer is unique
+        in the sequence, the longer k-mers of its match give the same candidate and are counted at once.
         """
         if not flank: #If no flank, return 0 as index, and None for quality
             return (0 if orientation != 'reverse' else len(seq),None)
@@ -1215,16 +2121,14 @@ class Read:
             else: return (len(seq)-len(flank)-1,'clean')
         if useCompress:
             uncompressedSeq=seq
-            seq=compress(seq)
+            seq,runStarts=runLengthEncode(seq)
             #Determine homopolymer length at end flank (Heuristic solution)
-            flankEndHPL = -1 # starts with -1 as not to correct for single base 'homopolymer'
-            for i in range(len(flank)-1,-1,-1):
-                if flank[-1] != flank[i]: break
-                flankEndHPL+=1
-            flank=compress(flank)
+            if compressedFlank[0] is None: compressedFlank = LocusIndex.compressFlank(flank)
+            flank,flankEndHPL = compressedFlank
             if seq.startswith(flank):
-                for windex in range(len(flank),len(uncompressedSeq)):
-                    if compress(uncompressedSeq[:windex]) == flank: break            
+                #Flank ends in the first base of the homopolymer of its last base (at most at the last base)
+                if len(flank) == len(uncompressedSeq): raise LocusConflictError('Nothing after compressed flank')
+                windex = min(runStarts[len(flank)-1]+1,len(uncompressedSeq)-1)
                 if orientation: return (windex+flankEndHPL,'clean_compressed')
                 else: return (len(uncompressedSeq)-(windex+flankEndHPL)-1,'clean_compressed')
         
@@ -1235,33 +2139,63 @@ class Read:
             windex = Alignment(flank,seq[:len(flank)+10],'flank-index').flankOutIndex
             if windex > len(flank)+5: windex = Alignment(flank,seq[:len(flank)+10],'flank-index').flankOutIndex
         else: #k-mer flank index finding algorithm
+            selfOverlapping = flankKmers.get(flank) if flankKmers else None
+            if selfOverlapping is None: selfOverlapping = LocusIndex.indexFlank(flank)
+            #Candidate indexes: for each flank position, runs of [index,number of consecutive k-mers giving it]
             stats=[]
             for flanki in range(len(flank),0,-1):
-                #pdb.set_trace()
                 stats.append([])
-                for flankii in range(flanki-1,-1,-1):
-                    findClosestI = seq.split(flank[flankii:flanki])
-                    if len(findClosestI)==1: break #Did not find k-mer
-                    closestI = -1
-                    for fI in findClosestI:
-                        if abs(closestI + (len(fI)+1) + (flanki-flankii-1) - (flanki-1) ) <= abs(closestI - (flanki-1)):
-                            closestI += (len(fI)+1) + (flanki-flankii-1)
-                        else: break
-                    stats[-1].append(closestI+(len(flank)-flanki))
-            #Score stats
+                k = 1
+                while k <= flanki: #k-mer flank[flanki-k:flanki]
+                    kmer = flank[flanki-k:flanki]
+                    first = seq.find(kmer)
+                    if first == -1: break #Did not find k-mer
+                    kmers = 1
+                    if first == seq.rfind(kmer): #Unique
+                        closestI = first+k-1
+                        if abs(closestI-(flanki-1)) > abs(-1-(flanki-1)): closestI = -1
+                        elif abs(len(seq)+k-1-(flanki-1)) <= abs(closestI-(flanki-1)): closestI = len(seq)+k-1
+                        if closestI != len(seq)+k-1: #Same candidate for the longer k-mers ending at the same position
+                            while (k+kmers <= flanki and first-kmers >= 0 and 
+                                   seq[first-kmers] == flank[flanki-k-kmers]): kmers+=1
+                    elif selfOverlapping[flanki-1][k]:
+                        #Walk over the non-overlapping occurrences (as str.split finds them) to the one closest to flanki-1
+                        closestI,seqi = -1,first
+                        while seqi != -1:
+                            if abs(seqi+k-1-(flanki-1)) > abs(closestI-(flanki-1)): break
+                            closestI = seqi+k-1
+                            seqi = seq.find(kmer,seqi+k)
+                        else: #Beyond the last occurrence, the walk ends at len(seq)+k-1
+                            if abs(len(seq)+k-1-(flanki-1)) <= abs(closestI-(flanki-1)): closestI = len(seq)+k-1
+                    else: #Closest occurrence ending before or at flanki-1, or after it (or else len(seq)+k-1)
+                        before,after = seq.rfind(kmer,0,flanki),seq.find(kmer,flanki-k+1)
+                        before = before+k-1 if before != -1 else -1
+                        after = after+k-1 if after != -1 else len(seq)+k-1
+                        closestI = after if after-(flanki-1) <= (flanki-1)-before else before
+                    if stats[-1] and stats[-1][-1][0] == closestI+(len(flank)-flanki): stats[-1][-1][1]+=kmers
+                    else: stats[-1].append([closestI+(len(flank)-flanki),kmers])
+                    k+=kmers
+            #Score stats: the ii-th k-mer of flank position i scores int((i*ii)**0.5)
+            if len(Read.flankScoreSums) < len(flank):
+                import itertools
+                Read.flankScoreSums = [[0]+list(itertools.accumulate(int((i*ii)**(0.5)) for ii in range(len(flank))))
+                                       for i in range(len(flank))]
             indexScores={}
             for i in range(len(stats)):
-                for ii in range(len(stats[i])):
-                    if stats[i][ii] not in indexScores: indexScores[stats[i][ii]]=0
-                    indexScores[stats[i][ii]]+= int((i*ii)**(0.5))    
+                ii = 0
+                for index,kmers in stats[i]:
+                    if index not in indexScores: indexScores[index]=0
+                    indexScores[index]+= Read.flankScoreSums[i][ii+kmers]-Read.flankScoreSums[i][ii]
+                    ii+=kmers
             #Winning index
             #pdb.set_trace()
             windex=sorted(indexScores,key=lambda x:indexScores[x],reverse=True)[0]
             
         if useCompress:
-            compressedFlank=seq[:windex+1]
-            for windex in range(windex,len(uncompressedSeq)):
-                if compressedFlank == compress(uncompressedSeq[:windex+1]): break
+            #Back to the uncompressed sequence: first base of the homopolymer at windex
+            #(or of the last homopolymer, if windex is beyond the compressed sequence)
+            if 0 <= windex < len(seq): windex = runStarts[windex]
+            elif len(seq) <= windex < len(uncompressedSeq): windex = max(windex,runStarts[-1])
             windex+=flankEndHPL
             seq=uncompressedSeq
             
@@ -1304,12 +2238,193 @@ class ConsensusRead:
             except KeyError: readsDict[len(r.seq)]=[r]
         return readsDict
 
+#Read batches
+class ReadBatch:
+    """
+    Compact, columnar storage of processed reads, one row per read.
+    The columns are arrays:
+        seqIds => index of the read sequence; each distinct sequence is stored once, 
+                  in the contiguous buffer sequences (see getSeq)
+        locusIds => index in loci of the read locus
+        strands => 1 if the read was on the original strand, else 0
+        flankCodes => the flank qualities and withinFlanks of the read qualLog (see flankQualities)
+        counts => number of identical raw reads the row stands for (see Read.count)
+    Quality strings are only stored if withQualities, also in a contiguous buffer.
+    Other qualLog information (e.g. ambiguousLocus) is kept per row in extras.
+    Indexing or iterating gives Read instances, made on the fly.
+    Batches made with select share the sequence buffer and loci, a batch copies them before it is appended to.
+    """
+    __slots__ = ('sequences','offsets','seqIndex','seqIds','loci','locusIndex','locusIds','strands','flankCodes',
+                 'counts','qualities','qualOffsets','extras','shared')
+    #flankCode = 4*forward+reverse quality index (16 if no cleanFlanks) + 32 if withinFlanks
+    flankQualities = (None,'clean','clean_compressed','unclean')
+    
+    def __init__(self,reads=(),withQualities=False):
+        from array import array
+        self.sequences,self.offsets,self.seqIndex = bytearray(),array('Q',[0]),{}
+        self.loci,self.locusIndex = [None,False],{None:0,False:1}
+        self.seqIds,self.locusIds,self.counts = array('I'),array('H'),array('I')
+        self.strands,self.flankCodes = array('B'),array('B')
+        self.qualities,self.qualOffsets = (bytearray(),array('Q',[0])) if withQualities else (None,None)
+        self.extras = {}
+        self.shared = False #sequence buffer and loci shared with other batches (see select)
+        for read in reads: self.append(read)
+    def __len__(self):
+        return len(self.seqIds)
+    def __iter__(self):
+        for row in range(len(self)): yield self[row]
+    def __repr__(self):
+        return 'ReadBatch of '+str(len(self))+' rows'
+
+    def __getitem__(self,row):
+        """
+        Returns row as a Read instance, negative rows count from the end
+        """
+        if row < 0: row+=len(self)
+        if not 0 <= row < len(self): raise IndexError('ReadBatch row out of range')
+        read = Read.__new__(Read)
+        read.seq = self.getSeq(self.seqIds[row])
+        read.locus = self.loci[self.locusIds[row]]
+        read.count = self.counts[row]
+        extras = self.extras.get(row,{})
+        if 'qual' in extras: read.qual = extras['qual']
+        elif self.qualities is None: read.qual = None
+        else: read.qual = self.qualities[self.qualOffsets[row]:self.qualOffsets[row+1]].decode()
+        read.qualLog = {'originalStrand':bool(self.strands[row]),'withinFlanks':self.flankCodes[row] >= 32}
+        if self.flankCodes[row] % 32 < 16:
+            read.qualLog['cleanFlanks'] = (self.flankQualities[self.flankCodes[row]%32//4],
+                                           self.flankQualities[self.flankCodes[row]%4])
+        for key in extras:
+            if key == 'qual': continue
+            read.qualLog[key] = list(extras[key]) if type(extras[key]) == list else extras[key]
+        return read
+
+    def getSeq(self,seqId):
+        """
+        Returns the sequence with index seqId
+        """
+        return self.sequences[self.offsets[seqId]:self.offsets[seqId+1]].decode()
+
+    def getSeqId(self,seq):
+        """
+        Returns the index of sequence seq, adding it to the sequence buffer if new
+        """
+        try: return self.seqIndex[seq]
+        except KeyError:
+            self.sequences+=seq.encode()
+            self.offsets.append(len(self.sequences))
+            self.seqIndex[seq] = len(self.offsets)-2
+            return self.seqIndex[seq]
+
+    def append(self,read,qual=None):
+        """
+        Adds a processed Read as a new row. 
+        If the batch stores qualities, qual can be given to store instead of read.qual
+        """
+        if self.shared: self.unshare()
+        row = len(self)
+        self.seqIds.append(self.getSeqId(read.seq))
+        try: self.locusIds.append(self.locusIndex[read.locus])
+        except KeyError:
+            self.locusIndex[read.locus] = len(self.loci)
+            self.loci.append(read.locus)
+            self.locusIds.append(self.locusIndex[read.locus])
+        self.counts.append(read.count)
+        self.strands.append(1 if read.qualLog['originalStrand'] else 0)
+        flankCode = 32 if read.qualLog['withinFlanks'] else 0
+        if 'cleanFlanks' in read.qualLog:
+            flankCode+= (4*self.flankQualities.index(read.qualLog['cleanFlanks'][0])+
+                         self.flankQualities.index(read.qualLog['cleanFlanks'][1]))
+        else: flankCode+=16
+        self.flankCodes.append(flankCode)
+        extras = {key:read.qualLog[key] for key in read.qualLog
+                  if key not in ('originalStrand','withinFlanks','cleanFlanks')}
+        if self.qualities is not None:
+            if qual is None: qual = read.qual
+            if type(qual) == str: self.qualities+=qual.encode()
+            else: extras['qual'] = qual
+            self.qualOffsets.append(len(self.qualities))
+        if extras: self.extras[row] = extras
+
+    def unshare(self):
+        """
+        Copies the sequence buffer and loci shared with other batches (see select), so they can be changed
+        """
+        self.sequences,self.offsets,self.seqIndex = bytearray(self.sequences),self.offsets[:],dict(self.seqIndex)
+        self.loci,self.locusIndex = list(self.loci),dict(self.locusIndex)
+        self.shared = False
+
+    def select(self,rows,compact=False):
+        """
+        Returns a new ReadBatch with the given rows (sharing the sequence buffer and loci,
+        which are copied before either batch is appended to, see unshare)
+        If compact, the new batch gets its own sequence buffer, with only the sequences of its rows
+        (e.g. to send it to another process).
+        """
+        from array import array
+        batch = ReadBatch.__new__(ReadBatch)
+        if compact:
+            batch.sequences,batch.offsets,batch.seqIndex = bytearray(),array('Q',[0]),{}
+            seqIds = array('I',[batch.getSeqId(self.getSeq(self.seqIds[row])) for row in rows])
+        else: batch.sequences,batch.offsets,batch.seqIndex = self.sequences,self.offsets,self.seqIndex
+        batch.loci,batch.locusIndex = self.loci,self.locusIndex
+        self.shared = batch.shared = True
+        for column in ('seqIds','locusIds','counts','strands','flankCodes'):
+            if compact and column == 'seqIds':
+                batch.seqIds = seqIds
+                continue
+            values = getattr(self,column)
+            setattr(batch,column,array(values.typecode,[values[row] for row in rows]))
+        if self.qualities is None: batch.qualities = batch.qualOffsets = None
+        else:
+            batch.qualities,batch.qualOffsets = bytearray(),array('Q',[0])
+            for row in rows:
+                batch.qualities+=self.qualities[self.qualOffsets[row]:self.qualOffsets[row+1]]
+                batch.qualOffsets.append(len(batch.qualities))
+        batch.extras = {i:self.extras[row] for i,row in enumerate(rows) if row in self.extras}
+        return batch
+
+    def expand(self,rows,qualities=None):
+        """
+        Returns a new ReadBatch with a row for each row index in rows, standing for a single read. 
+        If qualities is given (iterable with a quality string for each row index),
+        the new batch stores them.
+        """
+        from array import array
+        batch = self.select(rows)
+        batch.counts = array('I',[1])*len(rows)
+        if qualities is not None:
+            batch.qualities,batch.qualOffsets = bytearray(),array('Q',[0])
+            for i,qual in enumerate(qualities):
+                if type(qual) == str: batch.qualities+=qual.encode()
+                else: batch.extras[i] = dict(batch.extras.get(i,{}),qual=qual)
+                batch.qualOffsets.append(len(batch.qualities))
+        return batch
+
+    def splitLoci(self):
+        """
+        Returns a dict with a ReadBatch of the rows of each locus
+        """
+        rows = {}
+        for row,locusId in enumerate(self.locusIds):
+            try: rows[locusId].append(row)
+            except KeyError: rows[locusId] = [row]
+        return {self.loci[locusId]:self.select(rows[locusId]) for locusId in rows}
+
+    def getReadCount(self):
+        """
+        Returns the number of reads the rows stand for
+        """
+        return sum(self.counts)
+
+
 
 #Loci
 class Locus:
+    kitSnapshotVersion = 1 #format version of the kit snapshot files (see exportKitSnapshot)
     def __init__(self,locusName,readsList=None,locusDict=None,threshold=0,stutterBuffer=False,maxCluster=50):
         """
-        Extracts from a list of reads those reads that claim to belong to the locus.
+        Extracts from a list of reads (or ReadBatch) those reads that claim to belong to the locus.
         The Locus instance than offers methods for extracting alleles in the set of reads,
         calculate their abundances within the set, and perform quality checks.
         If stutterBuffer, flanks of reads are shortened by stutterBuffer x repeatsize of locus;
@@ -1322,15 +2437,35 @@ class Locus:
         if stutterBuffer and self.info['locusType']:
             self.stutterBuffer = stutterBuffer
         else: self.stutterBuffer=False #stutterBuffer standard False
-        if readsList: self.reads = [read for read in readsList if read.locus == locusName]
+        if isinstance(readsList,ReadBatch):
+            self.reads = readsList.select([row for row,locusId in enumerate(readsList.locusIds)
+                                           if readsList.loci[locusId] == locusName])
+        elif readsList: self.reads = [read for read in readsList if read.locus == locusName]
         else: self.reads = []
         self.threshold = threshold
         self.maxCluster = maxCluster
     def __str__(self):
         return self.name
     def __repr__(self):
-        return str(len(self.reads))+' reads in '+self.name
+        return str(self.getReadCount())+' reads in '+self.name
+
+    def getReadCount(self,badReads=False):
+        """
+        Returns the number of reads of the locus (or of its badReads if badReads),
+        a read standing for identical reads (see Analysis.processReads) is counted for all of them
+        """
+        reads = self.badReads if badReads else self.reads
+        if isinstance(reads,ReadBatch): return reads.getReadCount()
+        return sum([read.count for read in reads])
         
+    analysisResults = ('uniqueReads','uniqueForwards','uniqueAbundances','qualFlanks','knownAlleles','uniqueSorted',
+                       'uniqueClusterInfo','xml','candidates') #attributes set by analyze
+    def getAnalysisResults(self):
+        """
+        Returns the attributes set by analyze (see analysisResults) as a dict, without the reads of the locus
+        """
+        return {attribute:getattr(self,attribute) for attribute in self.analysisResults if hasattr(self,attribute)}
+
     def filterBadReads(self):
         """
         The list of reads for a locus can contain bad reads not useful for further analysis.
@@ -1338,6 +2473,11 @@ class Locus:
         #todo# for the moment only negative reads are being filtered, other quality checks could also be made
         #todo# before introducing k-mer assignment this was not necessary for negative length flanked out reads
         """
+        if isinstance(self.reads,ReadBatch):
+            negative = self.reads.seqIndex.get('[-]')
+            self.badReads = self.reads.select([row for row,seqId in enumerate(self.reads.seqIds) if seqId == negative])
+            self.reads = self.reads.select([row for row,seqId in enumerate(self.reads.seqIds) if seqId != negative])
+            return
         self.badReads = [r for r in self.reads if r.seq == '[-]']
         self.reads = [r for r in self.reads if r.seq != '[-]']
     
@@ -1352,6 +2492,7 @@ class Locus:
         #todo#stutterBuffer should just safe the stutters in qualLog,
                 and then when writing xml out, they (consensus) should be reappended to uniqueSeq
         """
+        if isinstance(self.reads,ReadBatch): self.reads = list(self.reads)
         for read in self.reads:
             if read.seq in ('[-]','[RL]'): continue
             if not read.seq.startswith(self.info['removed_from_flank_forwardP']):
@@ -1371,13 +2512,26 @@ class Locus:
         """
         self.uniqueReads = {}
         self.uniqueForwards = {}
+        if isinstance(self.reads,ReadBatch):
+            uniqueReads,uniqueForwards = {},{} #per sequence index
+            for seqId,count,strand in zip(self.reads.seqIds,self.reads.counts,self.reads.strands):
+                try:
+                    uniqueReads[seqId]+=count
+                    if strand: uniqueForwards[seqId]+=count
+                except KeyError:
+                    uniqueReads[seqId]=count
+                    uniqueForwards[seqId] = count if strand else 0
+            for seqId in uniqueReads:
+                seq = self.reads.getSeq(seqId)
+                self.uniqueReads[seq],self.uniqueForwards[seq] = uniqueReads[seqId],uniqueForwards[seqId]
+            return
         for read in self.reads:
             try:
-                self.uniqueReads[read.seq]+=1
-                if read.qualLog['originalStrand']: self.uniqueForwards[read.seq]+=1
+                self.uniqueReads[read.seq]+=read.count
+                if read.qualLog['originalStrand']: self.uniqueForwards[read.seq]+=read.count
             except KeyError:
-                self.uniqueReads[read.seq]=1
-                self.uniqueForwards[read.seq] = 1 if read.qualLog['originalStrand'] else 0
+                self.uniqueReads[read.seq]=read.count
+                self.uniqueForwards[read.seq] = read.count if read.qualLog['originalStrand'] else 0
     
     def setReadAbundances(self,thresholdLoop=True):
         """
@@ -1385,6 +2539,7 @@ class Locus:
             (read abundance has to be greater than threshold)
         If uniqueReads has been determined without flanking out, abundancies will be calculated as such.
         If thresholdLoop: lowest abundant uniques are removed first, until no uniques are under the threshold
+            (see getThresholdCutoff)
         """
         #pdb.set_trace()
         threshold = self.threshold
@@ -1394,17 +2549,47 @@ class Locus:
             filteredReads={read:self.uniqueReads[read] for read in self.uniqueReads 
                                     if self.uniqueReads[read]/totalReads > threshold}
         else:
-            uniqueCounts=sorted(set(self.uniqueReads.values()),reverse=True)
-            for minimumReadsForThreshold in uniqueCounts:
-                filteredReads=[v for v in self.uniqueReads.values() if v >= minimumReadsForThreshold]
-                totalReads = float(sum(filteredReads))
-                if float(min(filteredReads))/totalReads <= threshold:
-                    minimumReadsForThreshold = uniqueCounts[uniqueCounts.index(minimumReadsForThreshold)-1]
-                    break
+            minimumReadsForThreshold = Locus.getThresholdCutoff(Locus.getCountProfile(self.uniqueReads.values()),
+                                                                threshold)
             filteredReads={read:self.uniqueReads[read] for read in self.uniqueReads 
                                     if self.uniqueReads[read] >= minimumReadsForThreshold}   
         totalFiltered=float(sum(filteredReads.values()))
         self.uniqueAbundances = {read:filteredReads[read]/totalFiltered for read in filteredReads}
+
+    @staticmethod
+    def getCountProfile(counts):
+        """
+        Returns the count profile of the read counts of a set of uniques, to determine threshold cut-offs:
+        a list of (count, total reads of the uniques with at least that count), in descending order of count.
+        E.g. profile = Locus.getCountProfile(locus.uniqueReads.values()), after which 
+            Locus.getThresholdCutoff(profile,threshold) can be swept over thresholds.
+        """
+        uniqueCounts = {}
+        for count in counts: uniqueCounts[count] = uniqueCounts.get(count,0)+count
+        profile,totalReads = [],0
+        for count in sorted(uniqueCounts,reverse=True):
+            totalReads+=uniqueCounts[count]
+            profile.append((count,totalReads))
+        return profile
+
+    @staticmethod
+    def getThresholdCutoff(profile,threshold):
+        """
+        Returns the minimum count a unique needs to pass threshold, when the lowest abundant uniques are removed 
+        first, until no uniques are under the threshold. profile is a count profile (see getCountProfile).
+        The abundance of the least abundant unique left only decreases when more uniques are kept, 
+        so the cut-off is found with a binary search.
+        If even the most abundant unique is under the threshold, all uniques are kept.
+        Returns None if profile is empty.
+        """
+        if not profile: return None
+        low,high = 0,len(profile) #first profile index where least abundant/total <= threshold
+        while low < high:
+            middle = (low+high)//2
+            if float(profile[middle][0])/float(profile[middle][1]) <= threshold: high = middle
+            else: low = middle+1
+        if low in (0,len(profile)): return profile[-1][0]
+        return profile[low-1][0]
    
     def getReadAbundances(self):
         """
@@ -1423,50 +2608,78 @@ class Locus:
         If perFlank, then the valuekeys are the original read quality tuples.
         """
         #pdb.set_trace()
-        if perFlank:
+        if isinstance(self.reads,ReadBatch):
+            self.qualFlanks={ur:{'clean':0,'clean_compressed':0,'unclean':0,None:0} for ur in self.uniqueReads}
+            flankCounts = {} #(sequence index,flankCode) => reads
+            for seqId,flankCode,count in zip(self.reads.seqIds,self.reads.flankCodes,self.reads.counts):
+                try: flankCounts[(seqId,flankCode%32)]+=count
+                except KeyError: flankCounts[(seqId,flankCode%32)]=count
+            for (seqId,flankCode),count in flankCounts.items():
+                if flankCode >= 16: raise KeyError('cleanFlanks') #as for a Read without flank qualities
+                qualities = (ReadBatch.flankQualities[flankCode//4],ReadBatch.flankQualities[flankCode%4])
+                qualFlanks = self.qualFlanks[self.reads.getSeq(seqId)]
+                if perFlank: qualFlanks[qualities] = qualFlanks.get(qualities,0)+count
+                else:
+                    for q in qualities: qualFlanks[q]+=count
+        elif perFlank:
             self.qualFlanks={ur:{'clean':0,'clean_compressed':0,'unclean':0,None:0} for ur in self.uniqueReads}
             for r in self.reads:
                 if r.qualLog['cleanFlanks'] not in self.qualFlanks[r.seq]:
                     self.qualFlanks[r.seq][r.qualLog['cleanFlanks']] = 0
-                self.qualFlanks[r.seq][r.qualLog['cleanFlanks']] += 1
+                self.qualFlanks[r.seq][r.qualLog['cleanFlanks']] += r.count
         else:
             self.qualFlanks={ur:{'clean':0,'clean_compressed':0,'unclean':0,None:0} for ur in self.uniqueReads}
             for r in self.reads:
-                for q in r.qualLog['cleanFlanks']: self.qualFlanks[r.seq][q]+=1
+                for q in r.qualLog['cleanFlanks']: self.qualFlanks[r.seq][q]+=r.count
         #Transform to % per uniqueRead
         self.qualFlanks={k1:{k2:format(100.*float(self.qualFlanks[k1][k2])/float(sum(self.qualFlanks[k1].values())),
                                        '.1f')+'%' for k2 in self.qualFlanks[k1]} for k1 in self.qualFlanks}
-    def compareKnownAlleles(self,sql=None):
+    def compareKnownAlleles(self,sql=None,knownAlleles=None):
         """
         Looks up if a region of interest is present in the database.
         Stores results in self.knownAlleles
+        knownAlleles can be given as loaded by Locus.getKnownAlleles (e.g. once for all loci of an Analysis), 
+        else the known alleles of the locus are loaded with sql
         """
+        if knownAlleles is None: knownAlleles = Locus.getKnownAlleles([self.name],sql)
         self.knownAlleles = {}
-        #if not sql: conn,sql = login()
-        #else: conn = None
         for uR in self.uniqueReads:
             if uR == '[RL]': uRsql = '' #Necessary as database does not contain '[RL]' but empty strings for RL-alleles
             else: uRsql = uR
-            #if self.stutterBuffer: #should no longer be necessary with Analysis stutter and flankOut temp db tables
-            #    if (len(uR) < len(self.info['removed_from_flank_forwardP']) + 
-            #        len(self.info['removed_from_flank_reverseP'])): uRsql = '[-]'
-                #CHECK# next lines need to change with new temporary LOCIalleles table implementation
-                #sql.execute('SELECT alleleNumber,alleleNomen FROM LOCIalleles WHERE locusName = %s \
-                #             AND CONCAT(%s,alleleSeq,%s) = %s', (self.name,self.info['removed_from_flank_forwardP'],
-                #            complement(self.info['removed_from_flank_reverseP']),uRsql))
-            #else: 
-            sql.execute('SELECT alleleNumber,alleleNomen FROM LOCIalleles WHERE locusName = %s AND alleleSeq = %s',
-                        (self.name,uRsql))
-            if sql.rowcount == 1:
-                annotation = sql.fetchone()
-                if annotation['alleleNumber']:
-                    alleleNumber=str(annotation['alleleNumber'])
-                    if alleleNumber.endswith('.0'): alleleNumber=alleleNumber[:-2]
-                    self.knownAlleles[uR]=(alleleNumber,annotation['alleleNomen']) #number,subtype
-                else: self.knownAlleles[uR]=str(annotation['alleleNomen'])
-            elif sql.rowcount == 0: self.knownAlleles[uR]='NA'
-            else: raise LocusConflictError('Too many alleles')
-        #if conn: logout(conn,sql)
+            annotation = knownAlleles.get((self.name,uRsql.upper()),'NA')
+            if isinstance(annotation,LocusConflictError): raise annotation
+            self.knownAlleles[uR] = annotation
+
+    @staticmethod
+    def getKnownAlleles(lociNames,sql=None,alleles=None):
+        """
+        Loads the known alleles of lociNames from LOCIalleles in one query,
+        or takes them from alleles, rows with the same keys (e.g. from a kit snapshot, see Analysis.getSnapshotAlleles).
+        Returns a dict with keys (locusName,alleleSeq.upper()), as the database compares sequences case insensitive,
+        and values the annotation: (alleleNumber,alleleNomen) for numbered alleles, else alleleNomen.
+        Within an Analysis that prepared its locusDict (see Analysis.prepLocusDict), LOCIalleles is the temporary
+        table, so alleleSeq includes the removed_from_flank ends.
+        Sequences present more than once for a locus have a LocusConflictError as annotation.
+        """
+        knownAlleles = {}
+        if not lociNames: return knownAlleles
+        if alleles is None:
+            sql.execute('SELECT locusName,alleleSeq,alleleNumber,alleleNomen FROM LOCIalleles WHERE locusName IN ('+
+                        ','.join(['%s']*len(lociNames))+')',tuple(lociNames))
+            alleles = sql.fetchall()
+        lociNames = set(lociNames)
+        for annotation in alleles:
+            if annotation['locusName'] not in lociNames: continue
+            key = (annotation['locusName'],annotation['alleleSeq'].upper())
+            if key in knownAlleles:
+                knownAlleles[key] = LocusConflictError('Too many alleles')
+                continue
+            if annotation['alleleNumber']:
+                alleleNumber=str(annotation['alleleNumber'])
+                if alleleNumber.endswith('.0'): alleleNumber=alleleNumber[:-2]
+                knownAlleles[key]=(alleleNumber,annotation['alleleNomen']) #number,subtype
+            else: knownAlleles[key]=str(annotation['alleleNomen'])
+        return knownAlleles
     
     def getUniqueSorted(self,reverse=False):
         """
@@ -1499,6 +2712,7 @@ class Locus:
             raise Exception('More than '+str(self.maxCluster)+' sequences to cluster')
         uniqueSorted = self.getUniqueSorted()
         uniqueLength = len(uniqueSorted)
+        maxEdits = maxDifferences*(self.info['locusType'] if self.info['locusType'] else 1)
         for uRi in range(uniqueLength):
             uR = uniqueSorted[uRi]
             for uRmatchi in range(uRi+1,uniqueLength):
@@ -1509,8 +2723,10 @@ class Locus:
 
                 if  uRmatch == '[-]' or (len(uRmatch)==len(uR) and sum([len(set((a,b))) == 2 
                                           for a,b in zip(uR,uRmatch)]) > maxDifferences): continue
+                #A difference can hold up to locusType edits, so more edits than that can never be clustered
+                if editDistance(uR,uRmatch,maxEdits) > maxEdits: continue
                 #Align to calculate differences
-                alignment = Alignment(uR,uRmatch,stutter=self.info['locusType'])
+                alignment = Alignment(uR,uRmatch,stutter=self.info['locusType'],maxDifferences=maxDifferences)
                 differences = alignment.getDifferences()
                 if differences <= maxDifferences:
                     try: self.uniqueClusterInfo[uR][1][differences].append((
@@ -1553,10 +2769,11 @@ class Locus:
         cluster.tail = '\n\t'
         return cluster
     
-    def analyze(self,badReadsFilter=False,clusterInfo=True,sql=None,verbose=False):
+    def analyze(self,badReadsFilter=False,clusterInfo=True,sql=None,verbose=False,knownAlleles=None):
         """
         Performs all necessary analysis steps for a locus
-        and saves the result in self.xml
+        and saves the result in self.xml, and in self.candidates as a dict per alleleCandidate (see ReportWriter)
+        knownAlleles => see compareKnownAlleles
         """
         import xml.etree.ElementTree as ET
         
@@ -1567,17 +2784,18 @@ class Locus:
         self.setUniqueReads()
         filteredReads = self.getReadAbundances()
         self.calculateFlankStats()
-        self.compareKnownAlleles(sql=sql)
+        self.compareKnownAlleles(sql=sql,knownAlleles=knownAlleles)
         #Make xml for locus
         self.xml = ET.Element('locus')
         self.xml.set('name',self.name)
-        self.xml.set('reads',str(len(self.reads)))
-        if badReadsFilter: self.xml.set('badReads',str(len(self.badReads)))
+        self.xml.set('reads',str(self.getReadCount()))
+        if badReadsFilter: self.xml.set('badReads',str(self.getReadCount(badReads=True)))
         self.xml.set('uniqueReads',str(len(self.uniqueReads)))
         self.xml.set('uniqueFiltered',str(len(filteredReads)))
         self.xml.set('readsFiltered',str(sum([self.uniqueReads[fR] for fR in filteredReads])))
         self.xml.text = '\n\t'
         self.xml.tail = '\n'
+        self.candidates = []
         for pR in self.getUniqueSorted(): #returns sorted list of filtered uniqueReads
             allele = ET.SubElement(self.xml,'alleleCandidate')
             allele.set('abundance',format(filteredReads[pR]*100.,'.2f')+'%')
@@ -1585,12 +2803,17 @@ class Locus:
                 allele.set('db-name',self.knownAlleles[pR][0])
                 allele.set('db-subtype',self.knownAlleles[pR][1])
             else: allele.set('db-name',self.knownAlleles[pR])
+            candidate = {'locus':self.name,'roi':pR,'reads':self.uniqueReads[pR],'abundance':filteredReads[pR],
+                         'dbName':allele.get('db-name'),'dbSubtype':allele.get('db-subtype'),
+                         'directionDistrib':self.uniqueForwards[pR]/self.uniqueReads[pR],'cluster':None}
+            self.candidates.append(candidate)
 
             #Allele candidate length info
             if pR == '[-]': alleleSize = '-1'
             elif not self.info['locusType']: alleleSize = str(len(pR))
             else: alleleSize = calculateAlleleNumber(pR if pR != '[RL]' else '',self.info)
             allele.set('size',alleleSize)
+            candidate['size'] = alleleSize
             #end allele candidate length info
             allele.set('direction-distrib',format(100.*self.uniqueForwards[pR]/self.uniqueReads[pR],'.2f')+'%')
             allele.text='\n\t\t'
@@ -1602,11 +2825,18 @@ class Locus:
             alleleSub.set('clean',self.qualFlanks[pR]['clean'])
             alleleSub.set('unclean',self.qualFlanks[pR]['unclean'])
             alleleSub.set('clean_compressed',self.qualFlanks[pR]['clean_compressed'])
+            candidate['qualityFlanks'] = {quality:self.qualFlanks[pR][quality] 
+                                          for quality in ('clean','unclean','clean_compressed')}
             if not clusterInfo: alleleSub.tail = '\n\t'
             else:
                 alleleSub.tail = '\n\t\t'
                 if len(filteredReads) < self.maxCluster: #Maximum sequences to cluster
-                    try: allele.append(self.getClusterXMLForUnique(pR))
+                    try:
+                        allele.append(self.getClusterXMLForUnique(pR))
+                        index,differences = self.uniqueClusterInfo[pR]
+                        candidate['cluster'] = {'index':index,'edges':[[c,relative[0],relative[1]] 
+                                                                       for c in sorted(differences)
+                                                                       for relative in differences[c]]}
                     except KeyError: print('Missing key (',pR,') in cluster-info') 
                 else:
                     cluster = ET.SubElement(allele,'cluster-info')
@@ -1637,13 +2867,15 @@ class Locus:
             if locus.name == locusName: return locus
 
     @staticmethod
-    def getLocusDict(kitName=None,primerBuffer=False,sql=None):
+    def getLocusDict(kitName=None,primerBuffer=False,sql=None,snapshot=None):
         """
         Reads the MySQL table with locus relevant information, and returns it as a dict accessible by locusName
+        If a kit snapshot is given (see loadKitSnapshot), the loci are taken from it instead.
         """
         #if not sql: conn,sql=login()
         #else: conn = None
-        if not kitName:
+        if snapshot: locusDict={locus['locusName']:dict(locus) for locus in snapshot['loci']}
+        elif not kitName:
             sql.execute("SELECT * FROM LOCInames")
             locusDict={locus['locusName']:locus for locus in sql.fetchall()}
         else:
@@ -1659,6 +2891,43 @@ class Locus:
                 locusDict[l]['ref_reverseP']=locusDict[l]['ref_reverseP'][primerBuffer:]
         return locusDict   
 
+    @staticmethod
+    def exportKitSnapshot(filename,kitName=None,sql=None):
+        """
+        Writes a snapshot of kitName (or of all loci if no kitName) to filename: 
+        its LOCInames rows and LOCIalleles rows, as gzipped JSON.
+        An Analysis given the snapshot as kitSnapshot, does not need the database.
+        Returns the snapshot.
+        """
+        import json,gzip
+        if not sql: conn,sql = login()
+        else: conn=None
+        locusDict = Locus.getLocusDict(kitName=kitName,sql=sql)
+        snapshot = {'format':'MyFLq kit snapshot','snapshotVersion':Locus.kitSnapshotVersion,'versionMyFLq':version,
+                    'kitName':kitName,'loci':[locusDict[locus] for locus in sorted(locusDict)],'alleles':[]}
+        if locusDict:
+            sql.execute('SELECT locusName,alleleNumber,alleleNomen,alleleSeq FROM LOCIalleles WHERE locusName IN ('+
+                        ','.join(['%s']*len(locusDict))+') ORDER BY locusName,alleleSeq,alleleNumber,alleleNomen',
+                        sorted(locusDict))
+            snapshot['alleles'] = [[allele['locusName'],allele['alleleNumber'],allele['alleleNomen'],allele['alleleSeq']]
+                                   for allele in sql.fetchall()]
+        if conn: logout(conn,sql)
+        with gzip.GzipFile(filename,'wb',mtime=0) as snapshotFile: #mtime=0 => same kit gives the same file
+            snapshotFile.write(json.dumps(snapshot,separators=(',',':')).encode())
+        return snapshot
+
+    @staticmethod
+    def loadKitSnapshot(filename):
+        """
+        Loads a kit snapshot written by exportKitSnapshot.
+        Raises an Exception if the file is not a snapshot this version of MyFLq can read.
+        """
+        import json,gzip
+        with gzip.open(filename,'rt') as snapshotFile: snapshot = json.load(snapshotFile)
+        if snapshot.get('format') != 'MyFLq kit snapshot' or snapshot.get('snapshotVersion') > Locus.kitSnapshotVersion:
+            raise Exception(filename+' is not a kit snapshot for MyFLq version '+version)
+        return snapshot
+
     @staticmethod
     def makeLocusDict(inputType=None,submit=False,kitName=None):
         """
@@ -1761,9 +3030,11 @@ class Analysis:
     #All parameters in the docstring need to be followed by '=>' on a line of their own, 
     #and if the default value (None/False) is different from expected type when used, the line should end with [type]
     #for automatic processing of commandline options
+    chunkSize = 1000 #distinct reads per chunk for parallel processing
     def __init__(self,fqFilename,sampleName='',kitName='Illumina',maintainAllReads=True,negativeReadsFilter=True,
                  kMerAssign=False,primerBuffer=0,flankOut=False,stutterBuffer=1,useCompress=True,withAlignment=False,
-                 threshold=0.005,clusterInfo=True,randomSubset=None,processNow=True,parallelProcessing=0,verbose=False):
+                 threshold=0.005,clusterInfo=True,randomSubset=None,processNow=True,parallelProcessing=0,verbose=False,
+                 kitSnapshot=None,cacheDir=None,cacheSize=1024,profile=False,maintainQualities=False):
         """
         Sets up an analysis of loci for a specific kit
             fqFilename => Fastq file on which to perform the analysis
@@ -1792,6 +3063,11 @@ class Analysis:
             processNow => bool, default True: processing is started during Analysis object setup
             parallelProcessing => False for single process, int for number of processes to use (ideally <= #cpu's)
             verbose => bool, default False: show progress
+            kitSnapshot => kit snapshot file (see Locus.exportKitSnapshot) used instead of the database, kitName is taken from the snapshot [str]
+            cacheDir => directory to cache the processed reads, reused when the same fastq is analyzed with the same kit and read processing parameters (see getCacheKey) [str]
+            cacheSize => maximum size in MB of cacheDir, the least recently used cache files are removed when it is exceeded (0 for no limit) (see saveCache)
+            profile => bool, default False: time the analysis stages and count the read outcomes, which are added to the report (see Profiler)
+            maintainQualities => if maintainAllReads, also keep the quality string of each read (processed reads are then not cached)
         """
         #Save analysis characteristics
         self.fqFilename = fqFilename
@@ -1810,16 +3086,45 @@ class Analysis:
         self.randomSubset = randomSubset
         self.parallelProcessing = parallelProcessing
         self.verbose = verbose
+        self.kitSnapshot = kitSnapshot
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize
+        self.profile = profile
+        self.maintainQualities = maintainQualities
         
         #Prepare analysis
         self.prepAnalysis()
 
         #Processing file containing reads
-        if processNow:
-            try: self.processFQ()
-            finally:
-                if self.parallelProcessing: ipcluster('stop',self.ipcluster_process)
+        if processNow: self.process()
+
+    def process(self,reportWriter=None):
+        """
+        Processes the fastq file (see processFQ), and afterwards stops the worker processes and closes the analysis.
+        reportWriter => ReportWriter to which each locus is written as soon as it is analyzed,
+            if processing fails the partial report is removed (see ReportWriter.abort)
+        """
+        self.profiler.instrument()
+        try: self.processFQ(reportWriter=reportWriter)
+        except:
+            if reportWriter: reportWriter.abort()
+            raise
+        finally:
+            self.profiler.restore()
+            if self.parallelProcessing: self.executor.shutdown()
+            self.close()
             
+    def close(self):
+        """
+        Gives the sql connection of the analysis back to the pool of login (see logout),
+        after dropping the temporary tables made by prepLocusDict.
+        Is done after processing when Analysis is made with processNow.
+        """
+        if not getattr(self,'conn',None): return
+        self.sql.execute("DROP TEMPORARY TABLE IF EXISTS changedAlleleEnds, LOCIalleles")
+        logout(self.conn,self.sql)
+        self.conn = self.sql = None
+
     # def __del__(self):
     #     """
     #     Disconnects the sql attribute upon deletion of the Analysis instance
@@ -1835,109 +3140,274 @@ class Analysis:
         """
         #Check if Analysis atributes need to be changed
         for kw in kwargs: self.__dict__[kw] = kwargs[kw]
+        self.profiler = Profiler() if self.profile else NullProfiler()
         
-        #Make sql connection for analysis (connection remains open until Analysis object is deleted)
-        self.conn,self.sql = login()
+        #Make sql connection for analysis (connection remains open until Analysis.close)
+        #With a kit snapshot, the database is not used
+        self.close()
+        if self.kitSnapshot:
+            self.snapshot = Locus.loadKitSnapshot(self.kitSnapshot)
+            self.kitName = self.snapshot['kitName']
+            self.conn = self.sql = None
+        else:
+            self.snapshot = None
+            self.conn,self.sql = login()
         
         #Prepare locusDict for analysis
-        self.locusDict = Locus.getLocusDict(kitName=self.kitName,primerBuffer=self.primerBuffer,sql=self.sql)
+        with self.profiler.stage('getLocusDict'):
+            self.locusDict = Locus.getLocusDict(kitName=self.kitName,primerBuffer=self.primerBuffer,sql=self.sql,
+                                                snapshot=self.snapshot)
+        if self.cacheDir:
+            import hashlib
+            self.kitDigest = hashlib.sha1(repr(sorted((locus,sorted(self.locusDict[locus].items()))
+                                                      for locus in self.locusDict)).encode()).hexdigest()
         self.preppedLocusDict = False
-        if self.stutterBuffer or not self.flankOut: self.prepLocusDict()
+        if self.stutterBuffer or not self.flankOut:
+            with self.profiler.stage('prepLocusDict'): self.prepLocusDict()
+        self.locusDict = LocusIndex(self.locusDict,extraMethod=self.kMerAssign)
         
         #Set up parallel processing if required
         if self.parallelProcessing == 'InsideEngine': return
         elif self.parallelProcessing: self.setupParallelProcessing()        
     
-    def processFQ(self):
+    def processFQ(self,reportWriter=None):
         """
         Processes the reads of a fastqfile with forensic loci.
         Returns the loci after performing all necessary analysis methods.
+        If a reportWriter is given, each locus is written to it when analyzed, and the report is finished at the end.
+        With a cacheDir, the processed reads are taken from the cache if available, else they are cached.
+        If parallelProcessing, the loci are analyzed by the worker processes (see analyzeLocus),
+        and taken back in sorted order.
         """
-        reads = self.processReads()
+        with self.profiler.stage('processReads'):
+            cacheKey = self.getCacheKey() if self.cacheDir else None
+            reads = self.loadCache(cacheKey) if cacheKey else None
+            if reads is None:
+                reads = ReadBatch(self.processReads())
+                if cacheKey: self.saveCache(cacheKey,reads)
+            elif self.verbose: print('Processed reads loaded from cache',cacheKey)
+        if self.profile: self.countReads(reads)
         
         #Make objects for the loci (not containing reads)
         self.loci = {locusName:Locus(locusName,None,self.locusDict,threshold=self.threshold,
                                      stutterBuffer=self.stutterBuffer) for locusName in self.locusDict}
-        for read in reads:
-            try: self.loci[read.locus].reads.append(read)
+        for locusName,locusReads in reads.splitLoci().items():
+            try: self.loci[locusName].reads = locusReads
             except KeyError:
-                if read.locus: raise
+                if locusName: raise
         
         #REMOVE LINE# if self.flankOut: #With new prepLocusDict should now work also for no flankOut situation
-        for locus in sorted(self.loci): self.loci[locus].analyze(badReadsFilter=(self.negativeReadsFilter or
-                                                                 bool(self.kMerAssign)), clusterInfo=self.clusterInfo,
-                                                                 sql=self.sql,verbose=self.verbose)
-        if self.maintainAllReads: self.reads = reads
+        with self.profiler.stage('getKnownAlleles'):
+            if self.snapshot: knownAlleles = Locus.getKnownAlleles(sorted(self.loci),alleles=self.getSnapshotAlleles())
+            else: knownAlleles = Locus.getKnownAlleles(sorted(self.loci),self.sql)
+        settings = {'badReadsFilter':(self.negativeReadsFilter or bool(self.kMerAssign)),
+                    'clusterInfo':self.clusterInfo,'verbose':self.verbose}
+        analyses = {} #parallel processing: locus => future of its analysis by a worker
+        if self.parallelProcessing:
+            #One task per locus, the loci with most distinct reads first, as they take longest to cluster
+            for locus in sorted(self.loci,key=lambda l: len(self.loci[l].reads),reverse=True):
+                locusAlleles = {key:knownAlleles[key] for key in knownAlleles if key[0] == locus}
+                #Only the sequences of the locus are sent, not the shared sequence buffer of all reads
+                task = Locus(locus,None,self.locusDict,threshold=self.threshold,stutterBuffer=self.stutterBuffer)
+                reads = self.loci[locus].reads
+                task.reads = reads.select(range(len(reads)),compact=True) if isinstance(reads,ReadBatch) else reads
+                analyses[locus] = self.executor.submit(analyzeLocus,task,locusAlleles,settings)
+        for locus in sorted(self.loci):
+            with self.profiler.stage('Locus.analyze'):
+                if locus in analyses:
+                    results = analyses.pop(locus).result()
+                    if self.profile:
+                        results,stats = results
+                        self.profiler.merge(stats)
+                    self.loci[locus].__dict__.update(results)
+                    if settings['badReadsFilter']: self.loci[locus].filterBadReads() #as analyze did in the worker
+                else: self.loci[locus].analyze(sql=self.sql,knownAlleles=knownAlleles,**settings)
+            if reportWriter:
+                with self.profiler.stage('report'): reportWriter.writeLocus(self.loci[locus])
+        if reportWriter: reportWriter.close()
+
+    def countReads(self,reads):
+        """
+        Counts the processed reads per outcome for the profiler (distinct reads count for all their identical reads):
+        assigned to a locus, ambiguous, assigned by k-mer, negative length after flanking out,
+        and the quality of each flank that was flanked out (clean, clean_compressed or unclean).
+        """
+        count = self.profiler.count
+        for read in reads:
+            count('reads',read.count)
+            count('distinct reads')
+            if read.locus: count('assigned',read.count)
+            if 'ambiguousLocus' in read.qualLog: count('ambiguous',read.count)
+            if read.qualLog.get('k-mer assignment'): count('k-mer assigned',read.count)
+            if read.seq == '[-]': count('negative length',read.count)
+            if read.locus and 'cleanFlanks' in read.qualLog:
+                for end,quality in zip(('forward','reverse'),read.qualLog['cleanFlanks']):
+                    if quality: count('flank {} {}'.format(end,quality),read.count)
 
     def processReads(self):
         """
         Makes an iterable of Read instances. Calls their assignLocus method.
+        Identical raw reads are only processed once, the first Read with that sequence stands for all of them
+        (its count attribute holds their number). Returns these representative reads.
+        If parallelProcessing, the distinct reads are processed in chunks by the worker processes. At most
+        2 chunks per worker are pending, beyond that the results of the oldest chunk are collected first.
+        If maintainAllReads, self.reads is set to a ReadBatch with all reads (in fastq order),
+        with their own quality strings if maintainQualities.
         """
-        reads = Read.getReads(self.fqFilename,self.randomSubset)
-        #Subset reads for debugging
-        #from itertools import islice
-        #reads = islice(reads,100000)
-        #gubed
-        
-        if self.parallelProcessing:
-            return dview.map_sync(lambda x: analysis.processRead_px(x),reads)
-        else: #Single process
-            reads = [read.assignLocus(self.locusDict,extraMethod=self.kMerAssign) for read in reads]
-            for read in reads:
-                #For small reads, were the primers are larger than the read it self an exception will be returned
-                #those reads should be marked as unsuitable
-                #TODO# Implement this also for parallel processing
-                try: read.flankOut(self.locusDict,useCompress=self.useCompress,withAlignment=self.withAlignment)
-                except:
-                    read.locus = False
-            return reads
-
-    def processRead_px(self,read):
-        """
-        Processes a read in a parallel computing context
-        """
-        read.assignLocus(self.locusDict,extraMethod=self.kMerAssign)
-        read.flankOut(self.locusDict,useCompress=self.useCompress,withAlignment=self.withAlignment)
-        return read
-    
+        from array import array
+        from collections import deque
+        settings = {'extraMethod':self.kMerAssign,'useCompress':self.useCompress,'withAlignment':self.withAlignment}
+        distinct = {} #raw sequence => [representative read, processed range(len(qual))]
+        order = array('I') if self.maintainAllReads else None #index of the distinct sequence of each read
+        rawQuals = [] if self.maintainAllReads and self.maintainQualities else None
+        chunk,chunks = [],deque() #parallel processing: distinct reads to send, and (reads,future) pending
+        def collect():
+            chunk,future = chunks.popleft()
+            outcomes = future.result()
+            if self.profile:
+                outcomes,stats = outcomes
+                self.profiler.merge(stats)
+            for read,(locus,seq,mapping,qualLog) in zip(chunk,outcomes):
+                distinct[read.seq][1] = mapping
+                read.locus,read.seq,read.qualLog = locus,seq,qualLog
+                read.qual = Read.mapQual(mapping,read.qual)
+        for seqs,quals in self.profiler.iterate('FASTQ parsing',Read.getReadBatches(self.fqFilename,self.randomSubset)):
+            for seq,qual in zip(seqs,quals):
+                try: representative = distinct[seq]
+                except KeyError:
+                    read = Read((None,seq,None,qual))
+                    representative = distinct[seq] = [read,None,len(distinct)]
+                    if order is not None: order.append(representative[2])
+                    if rawQuals is not None: rawQuals.append(qual)
+                    if self.parallelProcessing:
+                        chunk.append(read)
+                        if len(chunk) == self.chunkSize:
+                            chunks.append((chunk,self.executor.submit(processReadChunk,
+                                                                      [(r.seq,len(r.qual)) for r in chunk])))
+                            chunk = []
+                            if len(chunks) > 2*int(self.parallelProcessing): collect()
+                    else:
+                        read.qual = range(len(qual)) #to follow the processing of qual
+                        read.process(self.locusDict,**settings)
+                        representative[1],read.qual = read.qual,Read.mapQual(read.qual,qual)
+                    continue
+                representative[0].count+=1
+                if order is not None: order.append(representative[2])
+                if rawQuals is not None: rawQuals.append(qual)
+        if chunk: chunks.append((chunk,self.executor.submit(processReadChunk,[(r.seq,len(r.qual)) for r in chunk])))
+        while chunks: collect()
+        if order is not None:
+            mappings = [representative[1] for representative in distinct.values()]
+            self.reads = ReadBatch(representative[0] for representative in distinct.values()).expand(
+                order,None if rawQuals is None else (Read.mapQual(mappings[i],qual) for i,qual in zip(order,rawQuals)))
+            if self.cacheDir: self.readOrder = order #see saveCache
+        return [representative[0] for representative in distinct.values()]
+
+    def getCacheKey(self):
+        """
+        Returns the key for the cache of processed reads: a sha256 digest of the fastq file content, the kit
+        (the locusDict as loaded, and Locus.kitSnapshotVersion), the MyFLq version, and the parameters used for
+        assigning and flanking out reads. Analysis parameters as threshold or clusterInfo are not part of the key.
+        Returns None if the processed reads cannot be cached (with randomSubset or maintainQualities).
+        """
+        import hashlib
+        if self.randomSubset or (self.maintainAllReads and self.maintainQualities): return None
+        fqDigest = hashlib.sha256()
+        with open(self.fqFilename,'rb') as fq:
+            for block in iter(lambda: fq.read(2**20),b''): fqDigest.update(block)
+        key = (fqDigest.hexdigest(),Locus.kitSnapshotVersion,self.kitDigest,version,self.primerBuffer,
+               self.kMerAssign,self.flankOut,self.stutterBuffer,self.useCompress,self.withAlignment)
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def checkCacheDir(self):
+        """
+        Makes cacheDir if it does not exist yet. Returns True if it is a directory (not a symlink)
+        owned by the user running the analysis, and only accessible to that user.
+        Otherwise other users could read the cached reads, or plant cache files that are unpickled by loadCache,
+        so a warning is given and False is returned.
+        """
+        import os,stat
+        from warnings import warn
+        os.makedirs(self.cacheDir,mode=0o700,exist_ok=True)
+        cacheDirStat = os.lstat(self.cacheDir)
+        if (stat.S_ISDIR(cacheDirStat.st_mode) and cacheDirStat.st_uid == os.getuid() and
+            not cacheDirStat.st_mode & 0o077): return True
+        warn('cacheDir {} is not a directory owned by and only accessible to the current user, '
+             'the cache is not used (chmod 700 to use it)'.format(self.cacheDir))
+        return False
+
+    def loadCache(self,cacheKey):
+        """
+        Returns the cached processed reads (as processFQ makes them) for cacheKey, or None if not cached
+        or if cacheDir is not private (see checkCacheDir).
+        If maintainAllReads, self.reads is set from the cache.
+        The modification time of a used cache file is updated, so it is evicted last (see saveCache).
+        """
+        import os,pickle
+        if not self.checkCacheDir(): return None
+        cacheFile = os.path.join(self.cacheDir,cacheKey+'.pickle')
+        try:
+            with open(cacheFile,'rb') as cache: reads,order = pickle.load(cache)
+            os.utime(cacheFile)
+        except (OSError,EOFError,pickle.UnpicklingError): return None
+        if self.maintainAllReads:
+            if order is None: return None #Cached without the read order
+            self.reads = reads.expand(order)
+        return reads
+
+    def saveCache(self,cacheKey,reads):
+        """
+        Caches the processed reads for cacheKey, with the read order of self.reads if maintainAllReads.
+        The cache file is written under a temporary name and then renamed, so concurrent analyses
+        never read a partial file. Nothing is cached if the cache directory is not only accessible to the user
+        running the analysis (see checkCacheDir), as cache files hold the sample's reads.
+        Afterwards, the cache is evicted to cacheSize (see evictCache).
+        """
+        import os,pickle,tempfile
+        order = self.__dict__.pop('readOrder',None)
+        if not self.checkCacheDir(): return
+        cache = tempfile.NamedTemporaryFile(dir=self.cacheDir,suffix='.tmp',delete=False)
+        try:
+            with cache: pickle.dump((reads,order),cache,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache.name,os.path.join(self.cacheDir,cacheKey+'.pickle'))
+        except:
+            os.remove(cache.name)
+            raise
+        if self.cacheSize: self.evictCache(keep=cacheKey)
+
+    def evictCache(self,keep=None):
+        """
+        Removes the cache files with the oldest modification time (least recently used, see loadCache),
+        until the cache files in cacheDir take at most cacheSize MB. The cache file for cacheKey keep is not removed.
+        """
+        import os
+        cacheFiles = []
+        for entry in os.scandir(self.cacheDir):
+            if not entry.name.endswith('.pickle') or entry.name == '{}.pickle'.format(keep): continue
+            try: cacheFiles.append((entry.stat().st_mtime,entry.stat().st_size,entry.path))
+            except FileNotFoundError: continue #Removed by a concurrent analysis
+        try: size = os.path.getsize(os.path.join(self.cacheDir,'{}.pickle'.format(keep))) if keep else 0
+        except FileNotFoundError: size = 0
+        size+= sum(fileSize for mtime,fileSize,path in cacheFiles)
+        for mtime,fileSize,path in sorted(cacheFiles):
+            if size <= self.cacheSize*2**20: break
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            size-=fileSize
+            if self.verbose: print('Removed from cache',os.path.basename(path))
+
     def setupParallelProcessing(self):
         """
-        Prepares ipengines for parallel processing
+        Starts the worker processes for parallel processing (parallelProcessing workers).
+        Each worker gets the compiled locusDict once, when it starts, and then processes chunks of
+        chunkSize distinct reads (see processReadChunk). Afterwards the workers analyze the loci (see analyzeLocus).
         """
-        #Starting ipcluster
-        self.ipcluster_process = ipcluster(numberOfEngines=self.parallelProcessing)
-        #to restart => self.ipcluster_process = ipcluster('restart',self.ipcluster_process)
-        
-        import time
-        from itertools import count
-        time.sleep(1)
-        from IPython.parallel import Client,Reference
-        try: client = Client()
-        except FileNotFoundError:
-            time.sleep(1)
-            client = Client()
-        count = count()
-        while len(client.ids) < self.parallelProcessing:
-            time.sleep(1)
-            if next(count) == 10: raise Exception('Not all ipengines registered within 10 seconds')
-        
-        global dview,lview
-        dview = client[:]
-        lview = client.load_balanced_view()
-        
-        #Prepping engines
-        #debug
-        #!ipython nbconvert --to python MyFLq.ipynb #TO REMOVE IN PRODUCTION VERSION
-        #gubed
-        dview.execute('from MyFLq import complement,Read,Analysis')
-        dview.execute("analysis=Analysis(fqFilename=None,kitName='"+self.kitName
-                      +"',maintainAllReads=False,negativeReadsFilter="+str(self.negativeReadsFilter)
-                      +",kMerAssign="+str(self.kMerAssign)+",primerBuffer="+str(self.primerBuffer)
-                      +",flankOut="+str(self.flankOut)+",stutterBuffer="+str(self.stutterBuffer)
-                      +",useCompress="+str(self.useCompress)+",withAlignment="+str(self.withAlignment)
-                      +",threshold=None,clusterInfo=None,processNow=False,parallelProcessing='InsideEngine')")
-        #dview.push({'locusDict':self.locusDict}) #Engines now retrieve their own locusDict with same parameters
-        #self.analysis_px = Reference('analysis') #only seems to work with dview.apply and not with dview.map
+        from concurrent.futures import ProcessPoolExecutor
+        self.executor = ProcessPoolExecutor(max_workers=self.parallelProcessing,initializer=initReadWorker,
+                                            initargs=(self.locusDict,{'extraMethod':self.kMerAssign,
+                                                                      'useCompress':self.useCompress,
+                                                                      'withAlignment':self.withAlignment},
+                                                      self.profile))
 
     def prepLocusDict(self):
         """
@@ -1981,6 +3451,7 @@ class Analysis:
         
         #Making temporary database table 
         if self.parallelProcessing == 'InsideEngine': return #Not necessary for Engines (currently!!)
+        if not self.sql: return #Kit snapshot, see getSnapshotAlleles
         self.sql.execute("""
         CREATE TEMPORARY TABLE changedAlleleEnds (
         `locusName` CHAR(40) NOT NULL UNIQUE KEY COMMENT 'identification of the locus',
@@ -2003,60 +3474,38 @@ class Analysis:
             FROM LOCIalleles JOIN changedAlleleEnds USING (locusName)
         """)
 
+    def getSnapshotAlleles(self):
+        """
+        Returns the LOCIalleles rows of the kit snapshot.
+        If the locusDict was prepped (see prepLocusDict), the alleles are changed as in the temporary LOCIalleles table:
+        only alleles of the loci in locusDict, with the removed_from_flank ends added to the allele sequence.
+        """
+        alleles = []
+        for locusName,alleleNumber,alleleNomen,alleleSeq in self.snapshot['alleles']:
+            if self.preppedLocusDict:
+                if locusName not in self.locusDict: continue
+                alleleSeq = (self.locusDict[locusName]['removed_from_flank_forwardP']+alleleSeq+
+                             complement(self.locusDict[locusName]['removed_from_flank_reverseP']))
+            alleles.append({'locusName':locusName,'alleleNumber':alleleNumber,'alleleNomen':alleleNomen,
+                            'alleleSeq':alleleSeq})
+        return alleles
+
     #Make report
-    def makeReport(self,fileName=False,stylesheet=False,appendLocusDict=True):
+    def makeReport(self,fileName=False,stylesheet=False,appendLocusDict=True,jsonLines=None):
         """
         Expects a set of analyzed loci.
         Prints out, or saves to file fileName the XML results
         if stylesheet: css stylesheet is linked to XML results
             can be True, in which case a results.css will be expected in the same directory
             can also be an url (relative or absolute)
+        if jsonLines: the allele candidates are also saved to file jsonLines, one JSON object per line
+            (see ReportWriter.loadResults)
+        To write the report while the loci are analyzed, see ReportWriter.
         """
-        import xml.etree.ElementTree as ET
-        import time, os
-        if stylesheet and (type(stylesheet) is bool): stylesheet = 'results.css'
-
-        #Set root with important analysis characteristics as attributes
-        results = ET.Element('results')
-        results.set('versionMyFLq',version)
-        results.set('timestamp',format(time.time(),'.0f'))
-        results.text = '\n'
-        for locus in sorted(self.loci):
-            results.append(self.loci[locus].xml)
-        results.set('sample',os.path.basename(self.sampleName if self.sampleName else self.fqFilename))
-        results.set('thresholdUsed',str(self.threshold))
-        results.set('flankedOut',str(self.flankOut))
-        if self.flankOut:
-            results.set('homomerCorrection',str(self.useCompress))
-            if self.stutterBuffer: results.set('stutterBuffer',str(self.stutterBuffer))
-        
-        #Append locusDict
-        if appendLocusDict:
-            locusDict = ET.SubElement(results,'lociDatabaseState')
-            locusDict.set('info','this was the state of the locus information used for the present analysis')
-            locusDict.text = locusDict.tail = '\n'
-            for locus in sorted(self.locusDict):
-                locusxml = ET.SubElement(locusDict,'locusInfo')
-                locusxml.set('name',locus)
-                locusxml.text = locusxml.tail = '\n'
-                for info in sorted(self.locusDict[locus]):
-                    infoxml = ET.SubElement(locusxml,info)
-                    infoxml.text = str(self.locusDict[locus][info])
-                    infoxml.tail = '\n'
-        
-        #Display
-        if not fileName: print(ET.tostring(results).decode("utf-8"))
-        elif not stylesheet: ET.ElementTree(results).write(fileName, encoding = "UTF-8", xml_declaration = True)
-        else:
-            file=open(fileName,'wt')
-            file.write(ET.tostring(ET.ProcessingInstruction(
-                                    'xml','version="1.0" encoding="UTF-8"')).decode("utf-8")+'\n')
-            #file.write(ET.tostring(ET.ProcessingInstruction(
-            #                        'xml-stylesheet','type="text/css" href="'+stylesheet+'"')).decode("utf-8")+'\n') #with simple css (deprecated)
-            file.write(ET.tostring(ET.ProcessingInstruction(
-                                    'xml-stylesheet','type="text/xsl" href="'+stylesheet+'"')).decode("utf-8")+'\n')
-            file.write(ET.tostring(results).decode("utf-8"))
-            file.close()
+        reportWriter = ReportWriter(self,fileName=fileName,stylesheet=stylesheet,appendLocusDict=appendLocusDict,
+                                    jsonLines=jsonLines,keepResults=True)
+        for locus in sorted(self.loci): reportWriter.writeLocus(self.loci[locus])
+        reportWriter.close()
             
     def makeVisualProfile(self,filename=None,inSubplots=True,saveInList=False):
         """
@@ -2087,17 +3536,17 @@ class Analysis:
             #Initiate plot
             subplots.append({})
             subplots[-1]['locusCount'] = locusCount
-            subplots[-1]['title'] = locus + ' #{}'.format(len(self.loci[locus].reads))
+            subplots[-1]['title'] = locus + ' #{}'.format(self.loci[locus].getReadCount())
                         
             locus = self.loci[locus]
             
             #Caclculate bars
             bars=[] #List with subdicts {'abundance':, 'name':, 'length':}
-            for allele in locus.xml:
-                dbName=AlleleType(allele.get('db-name'),allele.get('db-subtype')[1:-1] 
-                                  if allele.get('db-subtype') else None,
+            for allele in locus.candidates:
+                dbName=AlleleType(allele['dbName'],allele['dbSubtype'][1:-1] 
+                                  if allele['dbSubtype'] else None,
                                   locusType='STR' if locus.info['locusType'] else 'SNP')
-                alleleSize=allele.find('regionOfInterest').text
+                alleleSize=allele['roi']
                 if alleleSize == '[RL]': alleleSize = ''
                 if alleleSize == '[-]': alleleSize = -1.
                 elif not locus.info['locusType']: alleleSize = len(alleleSize)
@@ -2105,7 +3554,7 @@ class Analysis:
                     alleleSize = float(calculateAlleleNumber(alleleSize,locus.info))
 
                 bars.insert(0,{})
-                bars[0]['abundance'] = float(allele.get('abundance'))
+                bars[0]['abundance'] = float(format(allele['abundance']*100.,'.2f')+'%') #as in the report
                 bars[0]['name'] = '' if dbName.alleleType == 'NA' else dbName.alleleType
                 bars[0]['length'] = alleleSize
           
@@ -2239,6 +3688,161 @@ class Analysis:
 #                          bottom=sp['rects_ue'][3],zs=z_i,color='r')
 # plt.show()
 
+class ReportWriter:
+    resultsColumns = ('locus','roi','reads','abundance','size','dbName','dbSubtype','directionDistrib',
+                      'qualityFlanks','cluster')
+    def __init__(self,analysis,fileName=False,stylesheet=False,appendLocusDict=True,jsonLines=None,keepResults=False):
+        """
+        Writes the XML results of analysis (see Analysis.makeReport for the arguments) one locus at a time,
+        so the report is never held in memory as a whole, e.g.:
+            analysis = Analysis(fqFilename,processNow=False)
+            analysis.process(reportWriter=ReportWriter(analysis,fileName='results.xml'))
+        The results element is started here, loci are written with writeLocus, and close ends the report.
+        The output is the same as makeReport gives after the analysis.
+        Unless keepResults, the xml and candidates of each locus are released once written
+        (keep them to make a visual profile afterwards, see Analysis.makeVisualProfile).
+        
+        If jsonLines, the results are also written to that file as JSON Lines: first the report attributes,
+        then a line per allele candidate with the resultsColumns (locus.candidates, see Locus.analyze):
+            abundance and directionDistrib are fractions, size and qualityFlanks as in the XML,
+            dbSubtype is null for alleles without subtype, and cluster is null without cluster-info, 
+            else {"index":...,"edges":[[differences,index,transcode],...]}.
+        """
+        import xml.etree.ElementTree as ET
+        import time, os, sys, json
+        if stylesheet and (type(stylesheet) is bool): stylesheet = 'results.css'
+        self.analysis = analysis
+        self.fileName = fileName
+        self.appendLocusDict = appendLocusDict
+        self.keepResults = keepResults
+        self.jsonLinesName = jsonLines
+        
+        #Same encoding as the serialization makeReport uses for each output
+        if not fileName:
+            self.file = sys.stdout
+            self.encoding = 'us-ascii'
+        elif not stylesheet:
+            self.file = open(fileName,'wt',encoding='UTF-8',errors='xmlcharrefreplace')
+            self.file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+            self.encoding = 'unicode'
+        else:
+            self.file = open(fileName,'wt')
+            self.file.write(ET.tostring(ET.ProcessingInstruction(
+                                        'xml','version="1.0" encoding="UTF-8"')).decode("utf-8")+'\n')
+            self.file.write(ET.tostring(ET.ProcessingInstruction(
+                                        'xml-stylesheet','type="text/xsl" href="'+stylesheet+'"')).decode("utf-8")+'\n')
+            self.encoding = 'us-ascii'
+
+        #Set root with important analysis characteristics as attributes
+        results = ET.Element('results')
+        results.set('versionMyFLq',version)
+        results.set('timestamp',format(time.time(),'.0f'))
+        results.text = '\n'
+        results.set('sample',os.path.basename(analysis.sampleName if analysis.sampleName else analysis.fqFilename))
+        results.set('thresholdUsed',str(analysis.threshold))
+        results.set('flankedOut',str(analysis.flankOut))
+        if analysis.flankOut:
+            results.set('homomerCorrection',str(analysis.useCompress))
+            if analysis.stutterBuffer: results.set('stutterBuffer',str(analysis.stutterBuffer))
+        self.writeStart(results)
+        
+        #JSON Lines results
+        if jsonLines:
+            self.jsonLines = open(jsonLines,'wt')
+            header = {'format':'MyFLq results','versionMyFLq':version,'timestamp':int(results.get('timestamp')),
+                      'sample':results.get('sample'),'thresholdUsed':analysis.threshold,'flankedOut':analysis.flankOut}
+            if analysis.flankOut:
+                header['homomerCorrection'] = analysis.useCompress
+                if analysis.stutterBuffer: header['stutterBuffer'] = analysis.stutterBuffer
+            self.jsonLines.write(json.dumps(header)+'\n')
+        else: self.jsonLines = None
+
+    def write(self,element):
+        import xml.etree.ElementTree as ET
+        text = ET.tostring(element,encoding=self.encoding)
+        self.file.write(text if self.encoding == 'unicode' else text.decode("utf-8"))
+
+    def writeStart(self,element):
+        """
+        Writes the start tag and text of an element, whose children will be written separately
+        """
+        import xml.etree.ElementTree as ET
+        tail,element.tail = element.tail,None
+        text = ET.tostring(element,encoding=self.encoding)
+        if self.encoding != 'unicode': text = text.decode("utf-8")
+        self.file.write(text[:-len('</'+element.tag+'>')])
+        element.tail = tail
+
+    def writeLocus(self,locus):
+        """
+        Writes the xml of an analyzed locus
+        Unless keepResults, the xml and candidates of the locus are released afterwards
+        """
+        import json
+        self.write(locus.xml)
+        self.file.flush()
+        if self.jsonLines:
+            for candidate in locus.candidates:
+                self.jsonLines.write(json.dumps({column:candidate[column] for column in self.resultsColumns})+'\n')
+            self.jsonLines.flush()
+        if not self.keepResults: del locus.xml,locus.candidates
+
+    def close(self):
+        """
+        Appends the profile if the analysis was profiled and the locusDict if required, and ends the report
+        """
+        import xml.etree.ElementTree as ET
+        if getattr(self.analysis,'profile',False): self.write(self.analysis.profiler.getXML())
+        if self.appendLocusDict:
+            locusDict = ET.Element('lociDatabaseState')
+            locusDict.set('info','this was the state of the locus information used for the present analysis')
+            locusDict.text = locusDict.tail = '\n'
+            self.writeStart(locusDict)
+            for locus in sorted(self.analysis.locusDict):
+                locusxml = ET.Element('locusInfo')
+                locusxml.set('name',locus)
+                locusxml.text = locusxml.tail = '\n'
+                for info in sorted(self.analysis.locusDict[locus]):
+                    infoxml = ET.SubElement(locusxml,info)
+                    infoxml.text = str(self.analysis.locusDict[locus][info])
+                    infoxml.tail = '\n'
+                self.write(locusxml)
+            self.file.write('</lociDatabaseState>'+locusDict.tail)
+        self.file.write('</results>')
+        if self.fileName: self.file.close()
+        else: self.file.write('\n')
+        if self.jsonLines: self.jsonLines.close()
+
+    def abort(self):
+        """
+        Closes the report files, and removes them as they are incomplete (or not wanted, e.g. when there are
+        no valid reads). Can also be called after close.
+        A report printed to stdout is left as is.
+        """
+        import os
+        for output,fileName in ((self.file if self.fileName else None,self.fileName),
+                                (self.jsonLines,self.jsonLinesName)):
+            if not output: continue
+            output.close()
+            try: os.remove(fileName)
+            except FileNotFoundError: pass
+
+    @staticmethod
+    def loadResults(filename):
+        """
+        Loads a JSON Lines results file (see jsonLines) in one read.
+        Returns the report attributes, and the allele candidates as columns: a dict with a list for each resultsColumn.
+        """
+        import json
+        with open(filename) as resultsFile: lines = resultsFile.read().splitlines()
+        header = json.loads(lines[0])
+        if header.get('format') != 'MyFLq results': raise Exception(filename+' is not a MyFLq results file')
+        columns = {column:[] for column in ReportWriter.resultsColumns}
+        for line in lines[1:]:
+            candidate = json.loads(line)
+            for column in columns: columns[column].append(candidate[column])
+        return header,columns
+
 # More elaborate analyses
 #========================
 class DoubleAnalysis:
@@ -2467,10 +4071,12 @@ if __name__ == '__main__':
                                      description='Run a MyFLq analysis or add kit/sequences to the database')
     
     subparsers = parser.add_subparsers(title='Analyze or add kit/sequence',
-                                       description='''To use MyFLq either choose add or analyze.
+                                       description='''To use MyFLq either choose add or analyze,
+                                       or export a kit snapshot for analyses without the database.
                                        To see which further arguments are required with either:
                                        MyFLq.py add -h
                                        MyFLq.py analyze -h
+                                       MyFLq.py export -h
                                        ''',
                                        help='MyFLq sub-commands')
     #Commandline options for adding to the database
@@ -2482,6 +4088,10 @@ if __name__ == '__main__':
                             nargs='?')
     parser_add.add_argument('-a','--alleles',help='Validated alleles to add to the database')
     
+    #Commandline options for exporting a kit snapshot
+    parser_export = subparsers.add_parser('export', help='export help')
+    parser_export.add_argument('snapshot',help='File to write the kit snapshot to (use with analysis --kitSnapshot)')
+    
     
     #Commandline options for performing an analysis
     import inspect,builtins #allows to dynamically ask for options
@@ -2489,7 +4099,7 @@ if __name__ == '__main__':
     doc = {d.split('=>')[0].strip():d.split('=>')[1] 
            for d in inspect.getdoc(Analysis.__init__).split('\n') if '=>' in d}
     parser_analysis = subparsers.add_parser('analysis', help='analysis help')
-    noDynamicOptions = {'self','kitName','kMerAssign','maintainAllReads','processNow'}
+    noDynamicOptions = {'self','kitName','kMerAssign','maintainAllReads','maintainQualities','processNow'}
     for param in sig.parameters: #needs python3.3
         if param in noDynamicOptions: continue 
         if sig.parameters[param].default == inspect._empty: #needs python3.3
@@ -2509,13 +4119,15 @@ if __name__ == '__main__':
                                  help='Make report, optionally provide filename to save xml')
     parser_analysis.add_argument('-s','--stylesheet',const=True,nargs='?',
                                  help='Link report to stylesheet, optionally provide stylesheet url')
+    parser_analysis.add_argument('-j','--jsonLines',
+                                 help='Also save the allele candidates to JSONLINES, as JSON Lines (requires -r)')
     parser_analysis.add_argument('-v','--visualProfile',const=True,nargs='?',
                                  help='Make visual profile, optionally provide filename to save figure')
 
     
     #General commandline options
     parser.add_argument('user', help='User with permission for the database')
-    parser.add_argument('db', help='Database to use')
+    parser.add_argument('db', help='Database to use (or an embedded SQLite database: a file path containing a /, or sqlite:file)')
     parser.add_argument('kit', help='Combination of loci to use')
     parser.add_argument('-p','--password',help='MySQL user password (if not provided, will be asked for)')
     
@@ -2526,14 +4138,22 @@ if __name__ == '__main__':
     #        '--verbose','True','--useCompress','True','--withAlignment','True',#'--parallelProcessing','0',
     #        '/home/christophe/Documents/STR/Illumina/STR_Mixtures/9947ADNAADNAB2800MK562_S3_L001_R1_001.fastq',
     #        'testuser','testdb','Illumina','-p','testuser']) #debug
-    if not args.password:
+    if getattr(args,'jsonLines',None) and not args.report:
+        parser_analysis.error('-j/--jsonLines requires -r/--report')
+    from MyFLdb import isSQLite
+    withoutDB = isSQLite(args.db) or bool(getattr(args,'kitSnapshot',None))
+    if not args.password and not withoutDB:
         import getpass
         try: args.password = getpass.getpass('MySQL password for '+args.user+': ')
         except EOFError: args.password = input('MySQL password for '+args.user+': ')
 
     #Check if user and password match => if user is authorised to make or change MyFLq databases
     login = Login(user=args.user,passwd=args.password,database=args.db)
-    login.testConnection()
+    if not getattr(args,'kitSnapshot',None):
+        login.testConnection()
+        #Databases from previous versions lack BASEseqs.seqHash and LOCIdigests
+        import MyFLdb
+        with login.session() as sql: MyFLdb.upgradeTables(sql)
     
     #Program flow
     if 'add_kit' in args:
@@ -2542,8 +4162,10 @@ if __name__ == '__main__':
             else: Locus.makeLocusDict(('csv',args.add_kit),submit=True,kitName=args.kit)
         if args.alleles:
             makeEntries(args.alleles)
-            processLociNames()      #In the future, when choosing a subset of dataset alleles for analysis
-            processLociAlleles()    #this will have to be rewritten
+            processLoci()           #In the future, when choosing a subset of dataset alleles for analysis
+                                    #this will have to be rewritten
+    elif 'snapshot' in args:
+        Locus.exportKitSnapshot(args.snapshot,kitName=args.kit)
     elif 'fqFilename' in args:
         #Prepare special arguments
         if args.kMerAssign:
@@ -2554,15 +4176,20 @@ if __name__ == '__main__':
         #Start analysis
         #import pdb
         #pdb.set_trace()
-        analysis = Analysis(kitName=args.kit,**kwargs)
+        #A report to file is written while the loci are analyzed
+        analysis = Analysis(kitName=args.kit,processNow=False,**kwargs)
+        if args.report and type(args.report) != bool:
+            reportWriter = ReportWriter(analysis,fileName=args.report,stylesheet=args.stylesheet,
+                                        jsonLines=args.jsonLines,keepResults=bool(args.visualProfile))
+        else: reportWriter = None
+        analysis.process(reportWriter=reportWriter)
         if not sum({len(analysis.loci[locus].uniqueAbundances) for locus in analysis.loci}):
+            if reportWriter: reportWriter.abort() #no report without valid reads
             raise Exception('''There does't seem to be any valid reads in your fastq.
                                Either your fastq sample is not a forensic sample, or you may need to
                                choose a different loci.csv and alleles.csv file.
                             ''')
-        if args.report:
-            if type(args.report) == bool: analysis.makeReport()
-            else: analysis.makeReport(fileName=args.report, stylesheet=args.stylesheet)
+        if args.report and type(args.report) == bool: analysis.makeReport(jsonLines=args.jsonLines)
         if args.visualProfile:
             if type(args.visualProfile) == bool: analysis.makeVisualProfile()
             else: analysis.makeVisualProfile(filename=args.visualProfile)
@@ -7,7 +7,7 @@ def myflqTaskRequest(analysisID):
     from django.conf import settings
     from myflq.models import Analysis,AnalysisResults
     from django.core.files import File
-    import subprocess,time,tempfile
+    import subprocess,time,tempfile,os
 
     #rdb.set_trace() #DEBUG => telnet 127.0.0.1 portnumber
 
@@ -32,11 +32,15 @@ def myflqTaskRequest(analysisID):
                '--clusterInfo' if analysis.clusterInfo else 'REMOVE',
                '--randomSubset' if analysis.randomSubset else 'REMOVE',
                str(analysis.randomSubset) if analysis.randomSubset else 'REMOVE',
+               '--cacheDir', settings.MYFLQ_CACHE_DIR, #reused for resubmitted fastq's
+               '--cacheSize', str(settings.MYFLQ_CACHE_SIZE),
+               '--profile' if settings.MYFLQ_PROFILE else 'REMOVE',
                '-r',tempxml.name,'-s', settings.STATIC_URL+'css/resultMyFLq.xsl','-v',tempfigure.name,
                analysis.fastq.file.name, analysis.configuration.dbusername(), 
                analysis.configuration.fulldbname(), 'default']
     while 'REMOVE' in command: command.remove('REMOVE')
 
+    profile = None
     try:
         subprocess.check_output(command,stderr=subprocess.STDOUT)
         analysisResult = AnalysisResults(analysis=analysis)
@@ -49,11 +53,15 @@ def myflqTaskRequest(analysisID):
         analysis.progress = 'FA'
         analysis.save()
         print('FAILURE:',e.output.decode())
-    import os
+    if settings.MYFLQ_PROFILE and analysis.progress == 'F':
+        from myflq.MyFLq import Profiler
+        try: profile = Profiler.readReport(tempxml.name) #stage timings and read counters
+        except Exception as e: print('Profile could not be read:',e) #the analysis itself succeeded
     os.remove(tempxml.name), os.remove(tempfigure.name)
 
     print('Command:\n',' '.join(command))
-    return 'Executed:\n'+' '.join(command)
+    if profile: print('Profile:',profile)
+    return 'Executed:\n'+' '.join(command)+('\nProfile: '+str(profile) if profile else '')
 
 @shared_task
 def alleleTaskRequest(sequence):
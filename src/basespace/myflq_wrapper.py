@@ -51,11 +51,11 @@ else:
         tmp.close()
     else: alleleFile = '/myflq/alleles/'+alleleOptions[int(inform['select-allele']['Content'])]
 
-#MyFLdb command
+#MyFLdb command, the database is an embedded SQLite file (no MySQL server needed)
+database = '/tmp/myflq.sqlite'
 command = ['python3',
            '/myflq/MyFLdb.py',
-           '-p', 'passall',
-           'admin','onetimedbuse'
+           'admin', database
     ]
 failed = subprocess.call(command)
 if failed: raise Exception('Setting up database failed')
@@ -63,11 +63,10 @@ if failed: raise Exception('Setting up database failed')
 subprocess.check_call([
         'python3',
         '/myflq/MyFLq.py',
-        '-p', 'passall',
         'add', '-k', lociFile,
         '-a', alleleFile,
         'admin',
-        'onetimedbuse', 'default'
+        database, 'default'
         ])
 
 #Prepare fastq
@@ -86,7 +85,6 @@ subprocess.check_call(['mkdir', '-p', outDir])
 #Prepare options for MyFLq
 command = ['python3',
            '/myflq/MyFLq.py',
-           '-p', 'passall',
            'analysis',
            '--negativeReadsFilter', #if 'negativeReadsFilter' in inform, #For now always enabled, no added value/buggy
            '--primerBuffer', str(inform['primerBuffer']['Content']),
@@ -103,7 +101,7 @@ command = ['python3',
            '-v', outDir+'resultMyFLq.png',
            '--parallelProcessing', '0',
            sampleName,
-           'admin', 'onetimedbuse', 'default'
+           'admin', database, 'default'
     ]
 
 while 'REMOVE' in command: command.remove('REMOVE')
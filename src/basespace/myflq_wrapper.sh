@@ -1,19 +1,8 @@
 #!/bin/bash
 
 #This script serves as a wrapper for the MyFLcontainer
-#It starts necessary services, such as MySQL, prior to
 #executing the main analysis program MyFLq.py
-
-#Services
-/usr/bin/supervisord -c /myflq/supervisord.conf
-#/usr/sbin/mysqld &
-
-#Setup MySQL for MyFLq
-sleep 10 #mysqld needs some time to start up (maybe less than 5 seconds is also ok)
-mysql -uroot -proot <<EOF
-GRANT ALL ON *.* TO 'admin'@'localhost' IDENTIFIED BY 'passall' WITH GRANT OPTION;
-FLUSH PRIVILEGES;
-EOF
+#No services are needed, as the wrapper uses an embedded SQLite database
 
 #Start wrapper py
 python3 /myflq/basespace/myflq_wrapper.py $@ #passes any arguments that come from run container
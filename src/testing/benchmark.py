@@ -0,0 +1,235 @@
+#!/bin/env python3
+"""
+Benchmark for MyFLq analyses, that does not need MySQL or Django.
+
+A kit (loci csv, see Locus.makeLocusDict) and its alleles (alleles csv, see makeEntries) are added to
+an embedded SQLite database, and a synthetic fastq is generated from the alleles with configurable
+read number, stutter rate, sequencing errors, primer mismatches and reverse strand fraction.
+The fastq is then analyzed with different Analysis configurations, timing each stage with the
+Analysis profiler (see Profiler), and each Alignment mode is timed on pairs from the generated reads.
+Results are saved as JSON, so they can be compared between versions (see --compare).
+
+Example:
+    python3 benchmark.py --reads 20000 -o benchmark.json
+    python3 benchmark.py --reads 20000 -o benchmark_new.json --compare benchmark.json
+"""
+import os,sys,random,re,time,json
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #src with MyFLq.py and MyFLdb.py
+import MyFLq,MyFLdb
+
+configurations = ( #name => Analysis parameters
+    ('primerOut',{}),
+    ('flankOut',{'flankOut':True}),
+    ('flankOut withAlignment',{'flankOut':True,'withAlignment':True}),
+)
+
+def makeKitDatabase(database,lociFile,allelesFile,kitName='benchmark'):
+    """
+    Makes an embedded SQLite database with the loci of lociFile as kit kitName, and the alleles of allelesFile.
+    MyFLq.login is set to use this database.
+    Returns the locusDict of the kit.
+    """
+    conn,sql = MyFLdb.login(database=database)
+    MyFLdb.makeTables(sql)
+    MyFLdb.makeViews(sql)
+    MyFLdb.makeFunctions(sql)
+    MyFLdb.logout(conn,sql)
+    MyFLq.login(database=database)
+    MyFLq.Locus.makeLocusDict(('csv',lociFile),submit=True,kitName=kitName)
+    MyFLq.makeEntries(allelesFile)
+    MyFLq.processLoci()
+    with MyFLq.login.session() as sql: return MyFLq.Locus.getLocusDict(kitName=kitName,sql=sql)
+
+def readAlleles(allelesFile,locusDict):
+    """
+    Returns the allele sequences (with primers) of allelesFile per locus of locusDict as {locus:[(name,sequence)]}.
+    Loci without alleles get their reference sequence.
+    """
+    alleles = {locus:[] for locus in locusDict}
+    for line in open(allelesFile):
+        if line.strip().startswith('#'): continue
+        line = line.strip().split(',')
+        if line[0] in alleles: alleles[line[0]].append((line[1] if len(line) == 3 else '',line[-1].upper()))
+    for locus in alleles:
+        if not alleles[locus]:
+            alleles[locus] = [(str(locusDict[locus]['ref_alleleNumber']),locusDict[locus]['refseq'])]
+    return alleles
+
+def stutter(sequence,period):
+    """
+    Returns sequence with one repeat unit less in its longest repeat of period (n-1 stutter),
+    or None if sequence has no repeat of period
+    """
+    if not period: return None
+    repeats = [m for m in re.finditer(r'(([ACGT]{'+str(period)+r'})\2+)',sequence)]
+    if not repeats: return None
+    repeat = max(repeats,key=lambda m: len(m.group(1)))
+    return sequence[:repeat.start()]+sequence[repeat.start()+period:]
+
+def makeSample(fqFilename,locusDict,alleles,reads=10000,stutterRate=0.1,errorRate=0.002,primerMismatchRate=0.02,
+               reverseFraction=0.5,seed=1):
+    """
+    Writes a synthetic gzipped fastq with reads amplicons of a random genotype (two alleles for each locus).
+    Each read has stutterRate chance to be an n-1 stutter, primerMismatchRate chance to have a mismatch
+    in one of its primers, and each base has errorRate chance to be a sequencing error (with low quality).
+    A reverseFraction of the reads is on the complementary strand.
+    Returns the genotype as {locus:[allele names]}.
+    """
+    import gzip
+    rng = random.Random(seed)
+    genotype = {locus:[rng.choice(alleles[locus]) for i in range(2)] for locus in sorted(alleles)}
+    amplicons = [(locus,sequence) for locus in sorted(genotype) for name,sequence in genotype[locus]]
+    with gzip.open(fqFilename,'wt') as fq:
+        for i in range(reads):
+            locus,sequence = rng.choice(amplicons)
+            if rng.random() < stutterRate: sequence = stutter(sequence,locusDict[locus]['locusType']) or sequence
+            sequence = list(sequence)
+            if rng.random() < primerMismatchRate:
+                primerLength = len(locusDict[locus]['ref_forwardP' if rng.random() < 0.5 else 'ref_reverseP'])
+                position = rng.randrange(primerLength)
+                if rng.random() < 0.5: position = len(sequence)-1-position
+                sequence[position] = rng.choice([b for b in 'ACGT' if b != sequence[position]])
+            quality = ['I']*len(sequence)
+            for position in range(len(sequence)):
+                if rng.random() < errorRate:
+                    sequence[position] = rng.choice([b for b in 'ACGT' if b != sequence[position]])
+                    quality[position] = '#'
+            sequence,quality = ''.join(sequence),''.join(quality)
+            if rng.random() < reverseFraction: sequence,quality = MyFLq.complement(sequence),quality[::-1]
+            fq.write('@synthetic:{}:{}\n{}\n+\n{}\n'.format(i,locus,sequence,quality))
+    return {locus:[name for name,sequence in genotype[locus]] for locus in genotype}
+
+def benchmarkAnalysis(fqFilename,kitName,parameters,repeat=3,parallelProcessing=0):
+    """
+    Analyzes fqFilename repeat times with parameters and profiling.
+    Returns the median wall and cpu time of the runs and of each stage, and the read counters of the first run.
+    """
+    import io,contextlib,statistics
+    runs = []
+    for i in range(repeat):
+        wall,cpu = time.perf_counter(),time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()): #loci without alleles are reported on stdout
+            analysis = MyFLq.Analysis(fqFilename,kitName=kitName,processNow=False,profile=True,
+                                      parallelProcessing=parallelProcessing,**parameters)
+            analysis.process()
+        runs.append((time.perf_counter()-wall,time.process_time()-cpu,analysis.profiler.popStats()))
+    stages = {}
+    for name in runs[0][2]['stages']:
+        timings = [run[2]['stages'][name] for run in runs if name in run[2]['stages']]
+        stages[name] = {'calls':timings[0][0],'wall':statistics.median(t[1] for t in timings),
+                        'cpu':statistics.median(t[2] for t in timings)}
+    return {'parameters':parameters,'wall':statistics.median(run[0] for run in runs),
+            'cpu':statistics.median(run[1] for run in runs),'runs':[run[0] for run in runs],
+            'stages':stages,'counters':runs[0][2]['counters']}
+
+def benchmarkAlignments(locusDict,alleles,pairs=50,repeat=3,seed=1):
+    """
+    Times each Alignment mode on pairs like the analysis makes them:
+        global => allele with its n-1 stutter (with stutter gaps, see Locus.clusterUniqueReads)
+        primer-search => forward primer with an allele (see Read.primerOut)
+        flank-index => forward flank with the allele after the primer (see Read.getFlankIndex)
+    Returns per mode the number of alignments and their median total wall time (in seconds) over repeat runs.
+    """
+    rng = random.Random(seed)
+    amplicons = [(locus,sequence) for locus in sorted(alleles) for name,sequence in alleles[locus]]
+    amplicons = [rng.choice(amplicons) for i in range(pairs)]
+    modes = {'global':[],'primer-search':[],'flank-index':[]}
+    for locus,sequence in amplicons:
+        info = locusDict[locus]
+        stuttered = stutter(sequence,info['locusType'])
+        if stuttered: modes['global'].append(((sequence,stuttered),{'stutter':info['locusType']}))
+        modes['primer-search'].append(((info['ref_forwardP'],sequence),{}))
+        if info['flank_forwardP']:
+            flank = info['flank_forwardP']
+            modes['flank-index'].append(((flank,sequence[len(info['ref_forwardP']):][:len(flank)+10]),{}))
+    results = {}
+    for mode in modes:
+        timings = []
+        for i in range(repeat):
+            wall = time.perf_counter()
+            for args,kwargs in modes[mode]: MyFLq.Alignment(*args,mode=mode,**kwargs)
+            timings.append(time.perf_counter()-wall)
+        timings.sort()
+        results[mode] = {'alignments':len(modes[mode]),'wall':timings[len(timings)//2],
+                         'engine':MyFLq.Alignment.engine}
+    return results
+
+def compare(results,previous):
+    """
+    Prints the wall times of results next to those of previous results (as saved by this benchmark)
+    """
+    print('{:40} {:>10} {:>10} {:>7}'.format('','previous','current','ratio'))
+    rows = []
+    for configuration in results['analyses']:
+        if configuration not in previous['analyses']: continue
+        old,new = previous['analyses'][configuration],results['analyses'][configuration]
+        rows.append((configuration,old['wall'],new['wall']))
+        for stage in new['stages']:
+            if stage in old['stages']:
+                rows.append(('  '+stage,old['stages'][stage]['wall'],new['stages'][stage]['wall']))
+    for mode in results['alignments']:
+        if mode in previous['alignments']:
+            rows.append(('Alignment '+mode,previous['alignments'][mode]['wall'],results['alignments'][mode]['wall']))
+    for name,old,new in rows:
+        print('{:40} {:10.3f} {:10.3f} {:>7}'.format(name,old,new,format(new/old,'.2f') if old else '-'))
+
+if __name__ == '__main__':
+    import argparse,tempfile,platform
+    testingDir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark MyFLq analyses on a synthetic fastq')
+    parser.add_argument('-k','--loci',default=os.path.join(testingDir,'..','loci','myflsite2_loci.csv'),
+                        help='Loci csv of the kit (see Locus.makeLocusDict)')
+    parser.add_argument('-a','--alleles',default=os.path.join(testingDir,'..','alleles','myflqpaper_alleles.csv'),
+                        help='Alleles csv (see makeEntries), from which the synthetic sample is made')
+    parser.add_argument('-o','--output',default='benchmark.json',help='JSON file to save the results to')
+    parser.add_argument('--compare',help='JSON file with previous results to compare with')
+    parser.add_argument('--reads',type=int,default=10000,help='Number of reads in the synthetic fastq')
+    parser.add_argument('--stutterRate',type=float,default=0.1,help='Fraction of n-1 stutter reads')
+    parser.add_argument('--errorRate',type=float,default=0.002,help='Sequencing error rate per base')
+    parser.add_argument('--primerMismatchRate',type=float,default=0.02,help='Fraction of reads with a primer mismatch')
+    parser.add_argument('--reverseFraction',type=float,default=0.5,help='Fraction of reverse strand reads')
+    parser.add_argument('--seed',type=int,default=1,help='Seed for the synthetic fastq')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of runs of each benchmark (median is reported)')
+    parser.add_argument('--parallelProcessing',type=int,default=0,help='Processes for the analyses (see Analysis)')
+    parser.add_argument('--pairs',type=int,default=50,help='Sequences aligned for each Alignment mode')
+    parser.add_argument('--workdir',help='Directory for the database and fastq (default: temporary)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='myflq_benchmark')
+    os.makedirs(workdir,exist_ok=True)
+    database = os.path.join(workdir,'benchmark.sqlite')
+    fqFilename = os.path.join(workdir,'synthetic.fastq.gz')
+    try:
+        if os.path.exists(database): os.remove(database)
+        locusDict = makeKitDatabase(database,args.loci,args.alleles)
+        alleles = readAlleles(args.alleles,locusDict)
+        genotype = makeSample(fqFilename,locusDict,alleles,reads=args.reads,stutterRate=args.stutterRate,
+                              errorRate=args.errorRate,primerMismatchRate=args.primerMismatchRate,
+                              reverseFraction=args.reverseFraction,seed=args.seed)
+        results = {'format':'MyFLq benchmark','versionMyFLq':MyFLq.version,'timestamp':int(time.time()),
+                   'python':platform.python_version(),'platform':platform.platform(),'cpus':os.cpu_count(),
+                   'settings':{arg:args.__dict__[arg] for arg in ('reads','stutterRate','errorRate',
+                                                                   'primerMismatchRate','reverseFraction','seed',
+                                                                   'repeat','parallelProcessing','pairs')},
+                   'kit':os.path.basename(args.loci),'genotype':genotype,'analyses':{}}
+        for name,parameters in configurations:
+            print('Analysis',name,file=sys.stderr)
+            results['analyses'][name] = benchmarkAnalysis(fqFilename,'benchmark',parameters,repeat=args.repeat,
+                                                          parallelProcessing=args.parallelProcessing)
+        print('Alignments',file=sys.stderr)
+        results['alignments'] = benchmarkAlignments(locusDict,alleles,pairs=args.pairs,repeat=args.repeat,
+                                                    seed=args.seed)
+    finally:
+        if not args.workdir:
+            import shutil
+            shutil.rmtree(workdir)
+    with open(args.output,'w') as output: json.dump(results,output,indent=1,sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous: compare(results,json.load(previous))
+    else:
+        for name in results['analyses']:
+            print('{:40} {:10.3f}'.format(name,results['analyses'][name]['wall']))
+            for stage,timing in results['analyses'][name]['stages'].items():
+                print('{:40} {:10.3f}'.format('  '+stage,timing['wall']))
+        for mode,timing in results['alignments'].items():
+            print('{:40} {:10.3f}'.format('Alignment '+mode,timing['wall']))
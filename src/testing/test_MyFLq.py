@@ -0,0 +1,902 @@
+#!/bin/env python3
+"""
+Tests for MyFLq read processing and alignment, that do not need MySQL or Django.
+
+The faster implementations in MyFLq are checked against reference implementations
+on random and stutter-mutated sequences.
+
+Run from src/testing with: python3 -m unittest test_MyFLq
+"""
+import os,sys,random,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #src with MyFLq.py
+import MyFLq
+
+def randomSeq(rng,length,bases='ACGT'):
+    return ''.join(rng.choice(bases) for i in range(length))
+
+def randomSTR(rng,repeat='TCTA',maxRepeats=10,maxTail=8):
+    """
+    Returns a random STR-like sequence: a stretch of repeats followed by a random tail
+    """
+    return repeat*rng.randint(1,maxRepeats)+randomSeq(rng,rng.randint(0,maxTail))
+
+def mutate(rng,seq,mutations,stutter=0):
+    """
+    Returns seq with mutations random substitutions, single base insertions or deletions,
+    and (if stutter) insertions or deletions of stutter bases
+    """
+    seq = list(seq)
+    for m in range(mutations):
+        kind,position = rng.random(),rng.randrange(len(seq)+1)
+        if kind < 0.3 and seq: seq[min(position,len(seq)-1)] = rng.choice('ACGTN')
+        elif kind < 0.5: seq.insert(position,rng.choice('ACGT'))
+        elif kind < 0.7 and seq: del seq[min(position,len(seq)-1)]
+        elif kind < 0.85 and stutter: seq[position:position] = (seq[position:position+stutter]
+                                                               if position+stutter <= len(seq) else list('TAGA')[:stutter])
+        elif stutter and len(seq) > stutter: del seq[position:position+stutter]
+    return ''.join(seq)
+
+class AlignmentEngineTestCase(unittest.TestCase):
+    """
+    The numpy engine (Alignment.fillAntiDiagonals) should give the same alignment as the reference
+    python engine (Alignment.fillCells)
+    """
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def assertSameAlignment(self,dna1,dna2,mode,**kwargs):
+        reference = MyFLq.Alignment(dna1,dna2,mode=mode,engine='python',**kwargs)
+        alignment = MyFLq.Alignment(dna1,dna2,mode=mode,engine='numpy',**kwargs)
+        msg = '{} alignment of {} and {} ({})'.format(mode,dna1,dna2,kwargs)
+        self.assertTrue((reference.F_m == alignment.F_m).all(),msg=msg)
+        if mode == 'flank-index':
+            self.assertEqual(reference.flankOutIndex,alignment.flankOutIndex,msg=msg)
+        else:
+            self.assertEqual(reference.alnment,alignment.alnment,msg=msg)
+            self.assertEqual(reference.score,alignment.score,msg=msg)
+
+    def test_global(self):
+        rng = self.rng
+        for trial in range(150):
+            stutter = rng.choice([False,2,3,4,5])
+            dna1 = randomSeq(rng,rng.randint(1,40)) if trial%2 else randomSTR(rng)
+            dna2 = mutate(rng,dna1,rng.randint(0,5),stutter or 0) or 'A'
+            self.assertSameAlignment(dna1,dna2,'global',stutter=stutter)
+
+    def test_global_gapExtension(self):
+        rng = self.rng
+        for trial in range(50):
+            dna1 = randomSeq(rng,rng.randint(1,40))
+            dna2 = mutate(rng,dna1,rng.randint(0,5)) or 'A'
+            self.assertSameAlignment(dna1,dna2,'global',gapPenalty=-10,gapExtension=-5)
+
+    def test_primer_search(self):
+        rng = self.rng
+        for trial in range(100):
+            stutter = rng.choice([False,2,4])
+            primer = randomSeq(rng,rng.randint(1,30))
+            read = (randomSeq(rng,rng.randint(0,10)) + (mutate(rng,primer,rng.randint(0,3),stutter or 0) or 'A') +
+                    randomSeq(rng,rng.randint(len(primer)+1,len(primer)+15)))
+            self.assertSameAlignment(primer,read,'primer-search',stutter=stutter)
+
+    def test_flank_index(self):
+        rng = self.rng
+        for trial in range(100):
+            flank = randomSeq(rng,rng.randint(1,40)) if trial%2 else randomSTR(rng)
+            read = (mutate(rng,flank,rng.randint(0,4)) or 'A') + randomSeq(rng,rng.randint(0,15))
+            self.assertSameAlignment(flank,read,'flank-index')
+
+class BandedAlignmentTestCase(unittest.TestCase):
+    """
+    A global alignment with maxDifferences (see Alignment.fillBand) should equal the full alignment
+    when it has maxDifferences differences or less, and report more differences otherwise
+    """
+    def setUp(self):
+        self.rng = random.Random(2)
+
+    def assertBanded(self,dna1,dna2,stutter,maxDifferences):
+        full = MyFLq.Alignment(dna1,dna2,stutter=stutter)
+        banded = MyFLq.Alignment(dna1,dna2,stutter=stutter,maxDifferences=maxDifferences)
+        msg = 'alignment of {} and {} (stutter {}, maxDifferences {})'.format(dna1,dna2,stutter,maxDifferences)
+        if full.getDifferences() <= maxDifferences:
+            self.assertEqual(banded.alnment,full.alnment,msg=msg)
+            self.assertEqual(banded.score,full.score,msg=msg)
+            self.assertEqual(banded.getDifferences(),full.getDifferences(),msg=msg)
+            self.assertEqual(banded.getTransformCode(),full.getTransformCode(),msg=msg)
+        else: self.assertGreater(banded.getDifferences(),maxDifferences,msg=msg)
+
+    def test_random(self):
+        rng = self.rng
+        for trial in range(300):
+            stutter = rng.choice([False,2,3,4,5])
+            dna1 = randomSeq(rng,rng.randint(1,120)) if trial%2 else randomSTR(rng,maxRepeats=20,maxTail=30)
+            dna2 = (mutate(rng,dna1,rng.randint(0,4),stutter or 0) if rng.random() < 0.8
+                    else randomSeq(rng,rng.randint(1,60))) or 'A'
+            self.assertBanded(dna1,dna2,stutter,rng.choice([0,1,2,3]))
+
+    def test_stutters_around_band(self):
+        """
+        With maxDifferences stutters the alignment path reaches the band edge (maxDifferences*stutter
+        from the diagonal), with one more stutter it needs to leave the band
+        """
+        rng = self.rng
+        for trial in range(100):
+            repeat = rng.choice(['TCTA','AGA','GATA','AAAGA','TG'])
+            stutter = len(repeat)
+            maxDifferences = rng.choice([1,2,3])
+            flankF,flankR = randomSeq(rng,rng.randint(0,20)),randomSeq(rng,rng.randint(0,20))
+            repeats = rng.randint(maxDifferences+2,15)
+            dna1 = flankF+repeat*repeats+flankR
+            for stutters in (maxDifferences-1,maxDifferences,maxDifferences+1):
+                for change in (-stutters,stutters):
+                    dna2 = flankF+repeat*(repeats+change)+flankR
+                    if rng.random() < 0.3: dna2 = mutate(rng,dna2,1)
+                    self.assertBanded(dna1,dna2,stutter,maxDifferences)
+                    self.assertBanded(dna2,dna1,stutter,maxDifferences)
+
+def levenshtein(dna1,dna2):
+    """
+    Reference edit distance, dynamic programming row by row
+    """
+    previous = list(range(len(dna2)+1))
+    for i in range(1,len(dna1)+1):
+        row = [i]
+        for j in range(1,len(dna2)+1):
+            row.append(min(previous[j]+1,row[j-1]+1,previous[j-1]+(dna1[i-1] != dna2[j-1])))
+        previous = row
+    return previous[-1]
+
+class EditDistanceTestCase(unittest.TestCase):
+    """
+    editDistance should equal the reference edit distance, and never exceed it when bounded
+    (then the clustering prefilter is conservative)
+    """
+    def setUp(self):
+        self.rng = random.Random(3)
+
+    def assertEditDistance(self,dna1,dna2,maxDistances=()):
+        distance = levenshtein(dna1,dna2)
+        msg = 'edit distance of {} and {}'.format(dna1,dna2)
+        self.assertEqual(MyFLq.editDistance(dna1,dna2),distance,msg=msg)
+        for maxDistance in maxDistances:
+            self.assertEqual(MyFLq.editDistance(dna1,dna2,maxDistance),min(distance,maxDistance+1),
+                             msg=msg+' (maxDistance {})'.format(maxDistance))
+
+    def test_random(self):
+        rng = self.rng
+        for trial in range(300):
+            dna1 = randomSeq(rng,rng.randint(0,200),'ACGTN')
+            dna2 = (mutate(rng,dna1,rng.randint(0,10),rng.choice([0,2,4])) if rng.random() < 0.7
+                    else randomSeq(rng,rng.randint(0,200),'ACGTN'))
+            self.assertEditDistance(dna1,dna2,[rng.randint(0,12)])
+
+    def test_bounds(self):
+        """
+        Distances just below, at and above maxDistance, for sequences shorter and longer than 64 bp
+        """
+        rng = self.rng
+        self.assertEditDistance('','',[0,1])
+        self.assertEditDistance('','ACGT',[0,3,4,5])
+        self.assertEditDistance('ACGT','',[0,3,4,5])
+        for trial in range(200):
+            dna1 = randomSeq(rng,rng.choice([rng.randint(1,63),64,65,rng.randint(66,300)]))
+            dna2 = mutate(rng,dna1,rng.randint(0,8),rng.choice([0,4]))
+            distance = levenshtein(dna1,dna2)
+            self.assertEditDistance(dna1,dna2,[distance-1,distance,distance+1] if distance else [0,1])
+        for length in (63,64,65,128,129):
+            dna1 = randomSeq(rng,length)
+            for difference in (1,2,3): #only the length difference
+                self.assertEditDistance(dna1,dna1[:-difference],[difference-1,difference,difference+1])
+                self.assertEditDistance(dna1[difference:],dna1,[difference-1,difference,difference+1])
+
+class ClusterPrefilterTestCase(unittest.TestCase):
+    """
+    Locus.clusterUniqueReads should give the same cluster information with and without
+    the editDistance prefilter
+    """
+    def setUp(self):
+        self.rng = random.Random(4)
+
+    def makeLocus(self,alleles,locusType):
+        locus = MyFLq.Locus('test')
+        locus.info = {'locusType':locusType}
+        locus.uniqueAbundances = {allele:1 for allele in alleles}
+        return locus
+
+    def test_cluster_info(self):
+        from unittest import mock
+        rng = self.rng
+        for trial in range(15):
+            locusType = rng.choice([None,2,3,4,5])
+            repeat = randomSeq(rng,locusType or 4)
+            allele = (randomSeq(rng,rng.randint(0,30))+repeat*rng.randint(5,20)+randomSeq(rng,rng.randint(0,30)))
+            alleles = {allele,'[RL]','[-]'}
+            while len(alleles) < 20: alleles.add(mutate(rng,allele,rng.randint(1,4),locusType or 0) or 'A')
+            maxDifferences = rng.choice([1,2,3])
+            locus = self.makeLocus(alleles,locusType)
+            locus.clusterUniqueReads(maxDifferences=maxDifferences)
+            unfiltered = self.makeLocus(alleles,locusType)
+            with mock.patch.object(MyFLq,'editDistance',return_value=0):
+                unfiltered.clusterUniqueReads(maxDifferences=maxDifferences)
+            self.assertEqual(locus.uniqueClusterInfo,unfiltered.uniqueClusterInfo)
+
+def referenceReadAbundances(uniqueReads,threshold):
+    """
+    Original Locus.setReadAbundances threshold loop: the count cut-off is searched from the highest count down
+    """
+    uniqueCounts=sorted(set(uniqueReads.values()),reverse=True)
+    for minimumReadsForThreshold in uniqueCounts:
+        filteredReads=[v for v in uniqueReads.values() if v >= minimumReadsForThreshold]
+        totalReads = float(sum(filteredReads))
+        if float(min(filteredReads))/totalReads <= threshold:
+            minimumReadsForThreshold = uniqueCounts[uniqueCounts.index(minimumReadsForThreshold)-1]
+            break
+    filteredReads={read:uniqueReads[read] for read in uniqueReads if uniqueReads[read] >= minimumReadsForThreshold}
+    totalFiltered=float(sum(filteredReads.values()))
+    return {read:filteredReads[read]/totalFiltered for read in filteredReads}
+
+class ThresholdTestCase(unittest.TestCase):
+    """
+    The threshold cut-off from the count profile (Locus.getCountProfile and the binary search of
+    Locus.getThresholdCutoff) should keep the same uniques as the original threshold loop
+    """
+    def setUp(self):
+        self.rng = random.Random(6)
+
+    def readAbundances(self,uniqueReads,threshold):
+        locus = MyFLq.Locus('test')
+        locus.uniqueReads,locus.threshold = uniqueReads,threshold
+        locus.setReadAbundances()
+        return locus.uniqueAbundances
+
+    def test_random(self):
+        rng = self.rng
+        for trial in range(2000):
+            counts = [rng.choice([1,2,3,5,8,10,20,50,100,rng.randint(1,1000)]) for u in range(rng.randint(1,30))]
+            uniqueReads = {'read{}'.format(u):count for u,count in enumerate(counts)}
+            threshold = rng.choice([0,0.001,0.005,0.01,0.02,0.05,0.1,0.25,0.5,1,rng.random()*0.2])
+            self.assertEqual(self.readAbundances(uniqueReads,threshold),referenceReadAbundances(uniqueReads,threshold),
+                             msg='{} {}'.format(counts,threshold))
+
+    def test_edge_cases(self):
+        cases = [
+            ({'a':100},0.05), #single unique
+            ({'a':10,'b':10,'c':10},0.5), #all uniques under the threshold: all are kept
+            ({'a':1,'b':1},0.9),
+            ({'a':50,'b':25,'c':25},0.25), #ties at the threshold: 25/100 is not above it
+            ({'a':50,'b':30,'c':20},0.2),
+            ({'a':75,'b':25},0.25),
+            ({'a':3,'b':1,'c':1,'d':1},1/6.), #abundance exactly at a threshold that is not exact in binary
+            ({'a':100,'b':1,'c':1},0),
+            ({'a':100,'b':1,'c':1},1),
+        ]
+        for uniqueReads,threshold in cases:
+            self.assertEqual(self.readAbundances(uniqueReads,threshold),referenceReadAbundances(uniqueReads,threshold),
+                             msg='{} {}'.format(uniqueReads,threshold))
+        self.assertEqual(sorted(self.readAbundances({'a':50,'b':25,'c':25},0.25)),['a'])
+        self.assertEqual(self.readAbundances({'a':10,'b':10,'c':10},0.5),{'a':1/3.,'b':1/3.,'c':1/3.})
+
+    def test_empty(self):
+        self.assertEqual(referenceReadAbundances({},0.05),{})
+        self.assertEqual(MyFLq.Locus.getCountProfile([]),[])
+        self.assertIsNone(MyFLq.Locus.getThresholdCutoff([],0.05))
+        self.assertEqual(self.readAbundances({},0.05),{})
+
+    def test_profile_sweep(self):
+        """
+        One count profile can be used for several thresholds
+        """
+        rng = self.rng
+        counts = [rng.randint(1,200) for u in range(40)]
+        uniqueReads = {'read{}'.format(u):count for u,count in enumerate(counts)}
+        profile = MyFLq.Locus.getCountProfile(counts)
+        self.assertEqual(profile[-1][1],sum(counts))
+        for threshold in [t/1000. for t in range(0,200,5)]:
+            cutoff = MyFLq.Locus.getThresholdCutoff(profile,threshold)
+            self.assertEqual({read for read in uniqueReads if uniqueReads[read] >= cutoff},
+                             set(referenceReadAbundances(uniqueReads,threshold)))
+
+def referenceCompress(dna):
+    return ''.join([dna[na] for na in range(len(dna)) if dna[na]!=dna[na-1] or na == 0])
+
+def referenceGetFlankIndex(seq,flank,orientation,useCompress=False):
+    """
+    Reference flank index search: the original k-mer algorithm of Read.getFlankIndex, that splits
+    the sequence on each flank k-mer, and maps compressed positions back by compressing growing
+    prefixes of the sequence
+    """
+    if not flank: return (0 if orientation != 'reverse' else len(seq),None)
+    if orientation == 'reverse':
+        seq=MyFLq.complement(seq)
+        orientation=False
+    if seq.startswith(flank):
+        if orientation: return (len(flank),'clean')
+        else: return (len(seq)-len(flank)-1,'clean')
+    if useCompress:
+        uncompressedSeq=seq
+        seq=referenceCompress(seq)
+        flankEndHPL = -1
+        for i in range(len(flank)-1,-1,-1):
+            if flank[-1] != flank[i]: break
+            flankEndHPL+=1
+        flank=referenceCompress(flank)
+        if seq.startswith(flank):
+            for windex in range(len(flank),len(uncompressedSeq)):
+                if referenceCompress(uncompressedSeq[:windex]) == flank: break
+            if orientation: return (windex+flankEndHPL,'clean_compressed')
+            else: return (len(uncompressedSeq)-(windex+flankEndHPL)-1,'clean_compressed')
+    stats=[]
+    for flanki in range(len(flank),0,-1):
+        stats.append([])
+        for flankii in range(flanki-1,-1,-1):
+            findClosestI = seq.split(flank[flankii:flanki])
+            if len(findClosestI)==1: break
+            closestI = -1
+            for fI in findClosestI:
+                if abs(closestI + (len(fI)+1) + (flanki-flankii-1) - (flanki-1) ) <= abs(closestI - (flanki-1)):
+                    closestI += (len(fI)+1) + (flanki-flankii-1)
+                else: break
+            stats[-1].append(closestI+(len(flank)-flanki))
+    indexScores={}
+    for i in range(len(stats)):
+        for ii in range(len(stats[i])):
+            if stats[i][ii] not in indexScores: indexScores[stats[i][ii]]=0
+            indexScores[stats[i][ii]]+= int((i*ii)**(0.5))
+    windex=sorted(indexScores,key=lambda x:indexScores[x],reverse=True)[0]
+    if useCompress:
+        compressedFlank=seq[:windex+1]
+        for windex in range(windex,len(uncompressedSeq)):
+            if compressedFlank == referenceCompress(uncompressedSeq[:windex+1]): break
+        windex+=flankEndHPL
+        seq=uncompressedSeq
+    if orientation: return (windex+1,'unclean')
+    else: return (len(seq)-(windex+1)-1,'unclean')
+
+def homopolymerSeq(rng,length):
+    """
+    Returns a random sequence of length homopolymers of 1 to 6 bases
+    """
+    return ''.join(rng.choice('ACGT')*rng.choice([1,1,1,2,3,6]) for i in range(length))
+
+def homopolymerMutate(rng,seq,mutations):
+    """
+    Returns seq with mutations homopolymer length changes or substitutions
+    """
+    seq = list(seq)
+    for m in range(mutations):
+        if not seq: break
+        position = rng.randrange(len(seq))
+        if rng.random() < 0.5: seq.insert(position,seq[position])
+        elif position+1 < len(seq) and seq[position] == seq[position+1]: del seq[position]
+        else: seq[position] = rng.choice('ACGT')
+    return ''.join(seq)
+
+class FlankIndexTestCase(unittest.TestCase):
+    """
+    The k-mer flank index search (Read.getFlankIndex) and the mapping of compressed positions
+    (runLengthEncode) should give the same flank indexes as the original per-read algorithm,
+    with and without the precalculated flank data of a LocusIndex
+    """
+    def setUp(self):
+        self.rng = random.Random(5)
+
+    def getFlankIndex(self,seq,flank,orientation,useCompress,**kwargs):
+        """
+        Returns the flank index, or the kind of exception as handled by Read.flankOut and Read.process
+        """
+        try: return MyFLq.Read.getFlankIndex(seq,flank,orientation,useCompress=useCompress,**kwargs)
+        except IndexError: return 'IndexError'
+        except Exception: return 'Exception'
+
+    def referenceFlankIndex(self,seq,flank,orientation,useCompress):
+        try: return referenceGetFlankIndex(seq,flank,orientation,useCompress=useCompress)
+        except IndexError: return 'IndexError'
+        except Exception: return 'Exception'
+
+    def makeFlanks(self,rng,number):
+        flanks = []
+        for f in range(number):
+            kind = f%3
+            if kind == 0: flanks.append(randomSeq(rng,rng.randint(5,40)))
+            elif kind == 1: flanks.append(homopolymerSeq(rng,rng.randint(3,15)))
+            else: flanks.append(randomSTR(rng,repeat=randomSeq(rng,rng.randint(1,4)),maxRepeats=6)) #self-overlapping
+        return flanks
+
+    def makeRead(self,rng,flank):
+        kind = rng.random()
+        if kind < 0.5: return (mutate(rng,flank,rng.choice([0,1,2,3,5])) +
+                               randomSeq(rng,rng.randint(0,60)))
+        elif kind < 0.75: return homopolymerMutate(rng,flank,rng.choice([0,1,2,4]))+homopolymerSeq(rng,rng.randint(0,30))
+        elif kind < 0.8: return referenceCompress(flank)
+        elif kind < 0.9: return homopolymerMutate(rng,flank,2)[:rng.randint(0,len(flank)+3)]
+        else: return randomSeq(rng,rng.randint(0,50))
+
+    def test_runLengthEncode(self):
+        rng = self.rng
+        for trial in range(500):
+            dna = homopolymerSeq(rng,rng.randint(0,40)) if trial%2 else randomSeq(rng,rng.randint(0,40),'ACGTN')
+            compressed,runStarts = MyFLq.runLengthEncode(dna)
+            self.assertEqual(compressed,referenceCompress(dna))
+            self.assertEqual(MyFLq.compress(dna),compressed)
+            self.assertEqual(runStarts,[i for i in range(len(dna)) if i == 0 or dna[i] != dna[i-1]])
+
+    def test_getFlankIndex(self):
+        rng = self.rng
+        flanks = self.makeFlanks(rng,30)
+        flankKmers = {flank:MyFLq.LocusIndex.indexFlank(flank) for flank in flanks}
+        for trial in range(1500):
+            flank = rng.choice(flanks)
+            read = self.makeRead(rng,flank)
+            for orientation in ('forward','reverse'):
+                seq = read if orientation == 'forward' else MyFLq.complement(read)
+                for useCompress in (False,True):
+                    msg = '{} flank {} in {} (useCompress {})'.format(orientation,flank,seq,useCompress)
+                    reference = self.referenceFlankIndex(seq,flank,orientation,useCompress)
+                    self.assertEqual(self.getFlankIndex(seq,flank,orientation,useCompress),reference,msg=msg)
+                    self.assertEqual(self.getFlankIndex(seq,flank,orientation,useCompress,flankKmers=flankKmers,
+                                                        compressedFlank=MyFLq.LocusIndex.compressFlank(flank)),
+                                     reference,msg=msg)
+
+    def test_flankOut(self):
+        """
+        Processing reads with a LocusIndex or with the plain locusDict gives the same result
+        """
+        rng = self.rng
+        locusDict = {}
+        for l,flanks in enumerate(zip(*[iter(self.makeFlanks(rng,12))]*2)):
+            locusDict['locus{}'.format(l)] = {'ref_forwardP':randomSeq(rng,20),'ref_reverseP':randomSeq(rng,20),
+                                              'flank_forwardP':flanks[0],'flank_reverseP':flanks[1],
+                                              'locusType':rng.choice([None,4])}
+        locusIndex = MyFLq.LocusIndex(locusDict)
+        for trial in range(500):
+            locus = locusDict[rng.choice(sorted(locusDict))]
+            read = (locus['ref_forwardP']+self.makeRead(rng,locus['flank_forwardP'])+randomSTR(rng)+
+                    MyFLq.complement(self.makeRead(rng,locus['flank_reverseP']))+MyFLq.complement(locus['ref_reverseP']))
+            if trial%2: read = MyFLq.complement(read)
+            fastqEntry = ['@read',read,'+','I'*len(read)]
+            for useCompress in (False,True):
+                plain,indexed = [MyFLq.Read(fastqEntry).process(d,useCompress=useCompress)
+                                 for d in (locusDict,locusIndex)]
+                self.assertEqual((plain.locus,plain.seq,str(plain.qual),plain.qualLog),
+                                 (indexed.locus,indexed.seq,str(indexed.qual),indexed.qualLog),msg=read)
+
+def referenceAssignLocus(read,locusDict):
+    """
+    Original Read.assignLocus (without extraMethod), counting the primers of each locus with str.count
+    """
+    complement = MyFLq.complement
+    for locus in locusDict:
+        countF=read.seq.count(locusDict[locus]['ref_forwardP'])
+        countR=read.seq.count(complement(locusDict[locus]['ref_reverseP']))
+        countFc=read.seq.count(complement(locusDict[locus]['ref_forwardP']))
+        countRc=read.seq.count(locusDict[locus]['ref_reverseP'])
+        if (countF+countR+countFc+countRc) > 2 or max(countF,countR,countFc,countRc) > 1:
+            if 'ambiguousLocus' in read.qualLog:
+                read.qualLog['ambiguousLocus'].append((locus,(countF,countR,countFc,countRc)))
+            else: read.qualLog['ambiguousLocus']=[(locus,(countF,countR,countFc,countRc))]
+        elif (countF == countR == 1) or (countFc == countRc == 1):
+            if 'ambiguousLocus' in read.qualLog: read.qualLog['ambiguousLocus'].append(locus)
+            elif read.locus:
+                read.qualLog['ambiguousLocus']=[read.locus,locus]
+                read.locus = False
+            else:
+                read.locus = locus
+                if countFc == countRc == 1:
+                    read.seq = complement(read.seq)
+                    read.qual = read.qual[::-1]
+                    read.qualLog['originalStrand'] = False
+    if read.locus is None: read.locus = False
+    return read
+
+class PrimerAssignmentTestCase(unittest.TestCase):
+    """
+    Assigning reads with the PrimerAutomaton should give the same loci, orientation and
+    ambiguousLocus logs as counting each locus' primers with str.count, also for loci that share primers,
+    primers contained in or overlapping other primers, self-overlapping and palindromic primers
+    """
+    def setUp(self):
+        self.rng = random.Random(7)
+
+    def makeLocusDict(self,rng):
+        primers = {}
+        primers['A'] = (randomSeq(rng,20),randomSeq(rng,22))
+        primers['B'] = (primers['A'][0],randomSeq(rng,20)) #same forward primer as A
+        primers['C'] = (primers['A'][0][8:]+randomSeq(rng,8),randomSeq(rng,18)) #overlaps A's forward primer
+        primers['D'] = (primers['A'][0][3:15],MyFLq.complement(primers['A'][1])[2:16]) #contained in A's primers
+        primers['E'] = ('ATATATATAT','GCGCGCGC') #self-overlapping, and its own complement
+        primers['F'] = ('ACGTACGT'+randomSeq(rng,6),'TTTT'+randomSeq(rng,10))
+        primers['G'] = (primers['F'][1],primers['F'][0]) #F's primers swapped
+        return {locus:{'ref_forwardP':forwardP,'ref_reverseP':reverseP,'flank_forwardP':randomSeq(rng,10),
+                       'flank_reverseP':randomSeq(rng,10),'locusType':4} for locus,(forwardP,reverseP) in primers.items()}
+
+    def makeRead(self,rng,locusDict):
+        primers = [primer for locus in locusDict.values() for primer in
+                   (locus['ref_forwardP'],MyFLq.complement(locus['ref_reverseP']),
+                    MyFLq.complement(locus['ref_forwardP']),locus['ref_reverseP'])]
+        kind = rng.random()
+        if kind < 0.5:
+            locus = locusDict[rng.choice(sorted(locusDict))]
+            read = locus['ref_forwardP']+randomSTR(rng)+MyFLq.complement(locus['ref_reverseP'])
+            if rng.random() < 0.3: read = read[:rng.randrange(len(read))]+rng.choice(primers)+read[len(read)//2:]
+        elif kind < 0.9: read = ''.join(rng.choice(primers)+randomSeq(rng,rng.randint(0,4))
+                                       for p in range(rng.randint(1,4)))
+        else: read = randomSeq(rng,rng.randint(0,80))
+        if rng.random() < 0.2: read = mutate(rng,read,1)
+        return MyFLq.complement(read) if rng.random() < 0.5 else read
+
+    def test_countPrimers(self):
+        rng = self.rng
+        locusDict = self.makeLocusDict(rng)
+        locusDict['H'] = dict(locusDict['A'],ref_reverseP='') #empty primers are counted as str.count does
+        automaton = MyFLq.PrimerAutomaton(locusDict)
+        for trial in range(500):
+            seq = self.makeRead(rng,locusDict)
+            counts = {locus:tuple(seq.count(primer) for primer in
+                                  (locusDict[locus]['ref_forwardP'],MyFLq.complement(locusDict[locus]['ref_reverseP']),
+                                   MyFLq.complement(locusDict[locus]['ref_forwardP']),locusDict[locus]['ref_reverseP']))
+                      for locus in locusDict}
+            self.assertEqual(automaton.countPrimers(seq),[(locus,counts[locus]) for locus in locusDict
+                                                          if any(counts[locus])],msg=seq)
+
+    def test_assignLocus(self):
+        rng = self.rng
+        locusDict = self.makeLocusDict(rng)
+        locusIndex = MyFLq.LocusIndex(locusDict)
+        assigned = set()
+        for trial in range(2000):
+            seq = self.makeRead(rng,locusDict)
+            fastqEntry = ['@read',seq,'+',randomSeq(rng,len(seq),'ABCDEFGHI')]
+            reference = referenceAssignLocus(MyFLq.Read(fastqEntry),locusDict)
+            assigned.add(reference.locus if reference.locus or 'ambiguousLocus' not in reference.qualLog
+                         else 'ambiguous')
+            for read in (MyFLq.Read(fastqEntry).assignLocus(locusDict),MyFLq.Read(fastqEntry).assignLocus(locusIndex),
+                         MyFLq.Read(fastqEntry).assignLocus(locusDict,primerAutomaton=locusIndex.primerAutomaton)):
+                self.assertEqual((read.locus,read.seq,read.qual,read.qualLog),
+                                 (reference.locus,reference.seq,reference.qual,reference.qualLog),msg=seq)
+        self.assertTrue({False,'ambiguous','A','B','C','D'} <= assigned)
+
+class QualityMappingTestCase(unittest.TestCase):
+    """
+    Processing a read with range(len(qual)) as quality and mapping the result on the quality string
+    (Read.mapQual, as Analysis.processReads does for distinct reads) should give the quality
+    that processing the read with its quality string gives
+    """
+    def test_mapQual(self):
+        rng = random.Random(11)
+        locusDict = {}
+        for l in range(6):
+            flankF,flankR = randomSeq(rng,rng.randint(6,15)),randomSeq(rng,rng.randint(6,15))
+            if l%3 == 0: flankR = flankF[-3:]+flankR #flanks overlapping in reads without STR
+            locusDict['locus{}'.format(l)] = {'ref_forwardP':randomSeq(rng,20),'ref_reverseP':randomSeq(rng,20),
+                                              'flank_forwardP':flankF,'flank_reverseP':MyFLq.complement(flankR),
+                                              'locusType':4}
+        locusIndex = MyFLq.LocusIndex(locusDict)
+        conflicts = 0
+        for trial in range(1000):
+            locus = locusDict[rng.choice(sorted(locusDict))]
+            flankR = MyFLq.complement(locus['flank_reverseP'])
+            middle = rng.choice([randomSTR(rng),'',flankR[:3]])
+            read = (randomSeq(rng,rng.randint(0,5))+locus['ref_forwardP']+mutate(rng,locus['flank_forwardP'],rng.randint(0,1))+
+                    (middle+flankR if middle != flankR[:3] else flankR[3:])+MyFLq.complement(locus['ref_reverseP'])+
+                    randomSeq(rng,rng.randint(0,5)))
+            if rng.random() < 0.2: read = mutate(rng,read,2)
+            if trial%2: read = MyFLq.complement(read)
+            qual = randomSeq(rng,len(read),'ABCDEFGHIJ')
+            for useCompress in (False,True):
+                reference = MyFLq.Read(('@read',read,'+',qual)).process(locusIndex,useCompress=useCompress)
+                mapped = MyFLq.Read(('@read',read,'+',qual))
+                mapped.qual = range(len(qual))
+                mapped.process(locusIndex,useCompress=useCompress)
+                mappedQual = MyFLq.Read.mapQual(mapped.qual,qual)
+                self.assertEqual((mapped.locus,mapped.seq),(reference.locus,reference.seq),msg=read)
+                if isinstance(reference.qual,MyFLq.LocusConflictError):
+                    conflicts+=1
+                    self.assertIsInstance(mappedQual,MyFLq.LocusConflictError)
+                    self.assertEqual((mappedQual.value,mappedQual.message),(reference.qual.value,reference.qual.message))
+                else: self.assertEqual(mappedQual,reference.qual,msg=read)
+        self.assertTrue(conflicts)
+
+class ReadBatchTestCase(unittest.TestCase):
+    """
+    ReadBatch rows should give back the reads that were appended
+    """
+    def makeRead(self,seq,locus,qual=None,**qualLog):
+        read = MyFLq.Read(('@read',seq,'+',qual or 'I'*len(seq)))
+        read.locus = locus
+        read.qualLog.update(qualLog)
+        return read
+
+    def test_negative_rows(self):
+        batch = MyFLq.ReadBatch(withQualities=True)
+        for seq,qual in (('ACGT','ABCD'),('TTGA','EFGH')): batch.append(self.makeRead(seq,'TH01',qual))
+        batch.append(self.makeRead('GGCA','vWA','IJKL',ambiguousLocus=['TH01','vWA']))
+        for row in range(len(batch)):
+            self.assertEqual(vars(batch[row-len(batch)]),vars(batch[row]))
+        self.assertEqual(batch[-1].qual,'IJKL')
+        self.assertEqual(batch[-1].qualLog['ambiguousLocus'],['TH01','vWA'])
+        for row in (len(batch),-len(batch)-1):
+            with self.assertRaises(IndexError): batch[row]
+
+    def test_select_append(self):
+        """
+        Appending to a selected batch does not change the batch it was selected from, and vice versa
+        """
+        batch = MyFLq.ReadBatch(self.makeRead(seq,locus) for seq,locus in (('ACGT','TH01'),('TTGA','vWA')))
+        selected = batch.select([1])
+        compacted = batch.select([0],compact=True)
+        before = [vars(read) for read in batch]
+        selected.append(self.makeRead('GGCA','FGA'))
+        compacted.append(self.makeRead('CCAT','D8S1179'))
+        self.assertEqual([vars(read) for read in batch],before)
+        self.assertEqual([(read.seq,read.locus) for read in selected],[('TTGA','vWA'),('GGCA','FGA')])
+        self.assertEqual([(read.seq,read.locus) for read in compacted],[('ACGT','TH01'),('CCAT','D8S1179')])
+        batch.append(self.makeRead('AAAA','TPOX'))
+        self.assertEqual(len(selected.loci),len(set(selected.loci)))
+        self.assertNotIn('TPOX',selected.loci)
+
+class LoginTestCase(unittest.TestCase):
+    """
+    Pooled connections of Login should only be reused for the credentials they were made with
+    """
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.databases = [os.path.join(self.tempdir.name,name+'.sqlite') for name in ('a','b')]
+        self.login = MyFLq.Login()
+
+    def tearDown(self):
+        self.login.clear()
+        self.tempdir.cleanup()
+
+    def test_changed_database(self):
+        connA,sqlA = self.login(database=self.databases[0])
+        sqlA.execute('CREATE TABLE onlyInA (x INT)')
+        connB,sqlB = self.login(database=self.databases[1])
+        self.assertTrue(self.login.release(connA))
+        conn,sql = self.login()
+        self.assertIsNot(conn,connA)
+        sql.execute("SELECT name FROM sqlite_master WHERE name = 'onlyInA'")
+        self.assertEqual(sql.fetchall(),[])
+        for c in (conn,connB): self.login.release(c)
+
+    def test_reuse(self):
+        conn,sql = self.login(database=self.databases[0])
+        self.login.release(conn)
+        self.assertIs(self.login()[0],conn)
+
+class SQLiteTestCase(unittest.TestCase):
+    """
+    The MySQL queries of MyFLdb and MyFLq should run on an embedded SQLite database,
+    through the translation of SQLiteCursor
+    """
+    def setUp(self):
+        import tempfile,MyFLdb
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.conn,self.sql = MyFLdb.login(database='sqlite:'+os.path.join(self.tempdir.name,'test.sqlite'))
+
+    def tearDown(self):
+        import MyFLdb
+        MyFLdb.logout(self.conn,self.sql)
+        self.tempdir.cleanup()
+
+    def test_isSQLite(self):
+        import MyFLdb
+        for database in ('testdb','kit.sqlite','kit.db',':memory:'): self.assertFalse(MyFLdb.isSQLite(database))
+        for database in ('./kit.db','/tmp/testdb','sqlite:kit.sqlite'): self.assertTrue(MyFLdb.isSQLite(database))
+        self.assertEqual(MyFLdb.sqlitePath('sqlite:kit.sqlite'),'kit.sqlite')
+        for database in ('sqlite::memory:','sqlite:'):
+            self.assertRaises(ValueError,MyFLdb.login,database=database)
+
+    def test_translate(self):
+        import MyFLdb
+        translate = MyFLdb.SQLiteCursor.translate
+        self.assertEqual(translate("SELECT seqID FROM BASEseqs WHERE seqHash = %s FOR UPDATE;"),
+                         ['SELECT seqID FROM BASEseqs WHERE seqHash = ?'])
+        self.assertEqual(translate("SELECT '%s' FROM x WHERE a <=> NULL",withArgs=False),
+                         ["SELECT '%s' FROM x WHERE a  IS  NULL"])
+        self.assertEqual(translate("DROP TEMPORARY TABLE IF EXISTS changedAlleleEnds, LOCIalleles"),
+                         ['DROP TABLE IF EXISTS temp.changedAlleleEnds','DROP TABLE IF EXISTS temp.LOCIalleles'])
+        self.assertEqual(translate("CREATE TEMPORARY TABLE x\n SELECT a FROM y"),['CREATE TEMPORARY TABLE x AS SELECT a FROM y'])
+        self.assertEqual(translate("""CREATE TABLE t (
+        `id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        `name` CHAR(40) NOT NULL UNIQUE KEY COMMENT 'it''s a name', FOREIGN KEY (`name`) REFERENCES n (`name`),
+        `n` INT DEFAULT '-1' COMMENT 'number (of x, y)'
+        ) COMMENT 'table';"""),
+                         ["CREATE TABLE t (\n`id` INTEGER PRIMARY KEY AUTOINCREMENT,\n"
+                          "`name` CHAR(40) NOT NULL UNIQUE COLLATE NOCASE,\n`n` INT DEFAULT '-1',\n"
+                          "FOREIGN KEY (`name`) REFERENCES n (`name`)\n)"])
+
+    def test_makeTables(self):
+        import MyFLdb
+        MyFLdb.makeTables(self.sql)
+        MyFLdb.makeViews(self.sql)
+        MyFLdb.makeFunctions(self.sql)
+        self.sql.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {s['name'] for s in self.sql.fetchall()}
+        self.assertTrue({'BASEseqs','BASEnames','BASEtrack','BASEstat','LOCInames','LOCIalleles',
+                         'LOCIdigests','laboratories'} <= tables)
+        self.sql.execute("SELECT passphrase FROM laboratories WHERE labID = %s",('NA',))
+        self.assertEqual(self.sql.fetchone()['passphrase'],'NA')
+        #AUTO_INCREMENT, lastrowid and LAST_INSERT_ID() of a multi-row insert
+        self.sql.execute("INSERT INTO BASEseqs (sequence,seqHash) VALUES (%s,%s),(%s,%s)",
+                         ('ACGT',b'1'*20,'TTGA',b'2'*20))
+        self.assertEqual(self.sql.lastrowid,1)
+        self.sql.execute("SELECT LAST_INSERT_ID()")
+        self.assertEqual(self.sql.fetchone()['LAST_INSERT_ID()'],1)
+        self.sql.execute("SELECT getSeq(2) AS seq")
+        self.assertEqual(self.sql.fetchone()['seq'],'TTGA')
+        #CHAR columns compare case insensitive, as in MySQL
+        self.sql.execute("INSERT INTO BASEnames (locusName,locusType) VALUES (%s,%s)",('TH01',4))
+        self.sql.execute("SELECT locusName FROM BASEnames WHERE locusName = %s",('th01',))
+        self.assertEqual(self.sql.rowcount,1)
+        self.sql.execute("SELECT * FROM BASEcombined")
+        self.assertEqual(self.sql.rowcount,0)
+        #Upgrading is possible on an up to date database
+        MyFLdb.upgradeTables(self.sql)
+
+    def test_temporary_tables(self):
+        import MyFLdb
+        MyFLdb.makeTables(self.sql)
+        self.sql.execute("INSERT INTO LOCIalleles (locusName,alleleNumber,alleleSeq) VALUES (%s,%s,%s)",
+                         ('TH01','7','TCAT'))
+        #As Analysis.prepLocusDict masquerades LOCIalleles
+        self.sql.execute("""
+        CREATE TEMPORARY TABLE changedAlleleEnds (
+        `locusName` CHAR(40) NOT NULL UNIQUE KEY COMMENT 'id of the locus',
+        `removed_from_flank_forwardP` TEXT(1000),
+        `removed_from_flank_reverseP` TEXT(1000)
+        )
+        COMMENT 'temporary table for recalculating alleles';""")
+        self.sql.execute("INSERT INTO changedAlleleEnds VALUES (%s,%s,%s)",('TH01','G','C'))
+        self.sql.execute("""
+        CREATE TEMPORARY TABLE LOCIalleles
+            SELECT LOCIalleles.locusName,alleleNumber,alleleNomen,
+            CONCAT(removed_from_flank_forwardP,LOCIalleles.alleleSeq,removed_from_flank_reverseP) AS alleleSeq
+            FROM LOCIalleles JOIN changedAlleleEnds USING (locusName)
+        """)
+        self.sql.execute("SELECT alleleSeq FROM LOCIalleles WHERE locusName = %s FOR UPDATE",('TH01',))
+        self.assertEqual(self.sql.fetchall(),[{'alleleSeq':'GTCATC'}])
+        self.sql.execute("DROP TEMPORARY TABLE IF EXISTS changedAlleleEnds, LOCIalleles")
+        self.sql.execute("SELECT alleleSeq FROM LOCIalleles")
+        self.assertEqual(self.sql.fetchall(),[{'alleleSeq':'TCAT'}])
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    The set-based database processing should give the same tables as the row by row functions,
+    on an embedded SQLite database with the example kit of the website
+    """
+    sources = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'MyFLsite','static','sources')
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.makeDatabase('kit.sqlite')
+
+    def makeDatabase(self,name):
+        """Makes a database with the example kit in the temporary directory, and logs in to it"""
+        import MyFLdb
+        database = os.path.join(self.tempdir.name,name)
+        conn,sql = MyFLdb.login(database=database)
+        MyFLdb.makeTables(sql)
+        MyFLdb.makeViews(sql)
+        MyFLdb.makeFunctions(sql)
+        MyFLdb.logout(conn,sql)
+        MyFLq.login(database=database)
+        MyFLq.Locus.makeLocusDict(('csv',os.path.join(self.sources,'example_loci.csv')),submit=True,kitName='default')
+
+    def tearDown(self):
+        MyFLq.login.clear()
+        self.tempdir.cleanup()
+
+    def getRows(self,*tables):
+        with MyFLq.login.session() as sql:
+            rows = {}
+            for table in tables:
+                sql.execute("SELECT * FROM "+table)
+                rows[table] = sorted(sorted(row.items()) for row in sql.fetchall())
+        return rows
+
+    def test_processLoci(self):
+        MyFLq.makeEntries(os.path.join(self.sources,'example_alleles.csv'))
+        MyFLq.processLociNames()
+        MyFLq.processLociAlleles()
+        reference = self.getRows('LOCInames','LOCIalleles')
+        self.assertTrue(reference['LOCIalleles'])
+        self.assertEqual(MyFLq.processLoci(onlyChanged=False),sorted(dict(row)['locusName'] for row in reference['LOCInames']))
+        self.assertEqual(self.getRows('LOCInames','LOCIalleles'),reference)
+        self.assertEqual(MyFLq.processLoci(),[])
+
+    def test_processLoci_version(self):
+        MyFLq.makeEntries(os.path.join(self.sources,'example_alleles.csv'))
+        processed = MyFLq.processLoci()
+        version = MyFLq.version
+        try:
+            MyFLq.version += '+test'
+            self.assertEqual(MyFLq.processLoci(),processed)
+        finally: MyFLq.version = version
+
+    def test_makeBulkEntries(self):
+        alleles = os.path.join(self.sources,'example_alleles.csv')
+        MyFLq.makeEntries(alleles,bulk=False)
+        reference = self.getRows('BASEtrack','BASEstat','BASEseqs','BASEnames')
+        self.makeDatabase('bulk.sqlite')
+        bulkEntries = MyFLq.makeBulkEntries
+        try:
+            MyFLq.makeBulkEntries = lambda *args,**kwargs: bulkEntries(*args,chunkSize=7,**kwargs)
+            MyFLq.makeEntries(alleles,bulk=True)
+        finally: MyFLq.makeBulkEntries = bulkEntries
+        self.assertEqual(self.getRows('BASEtrack','BASEstat','BASEseqs','BASEnames'),reference)
+        #entryIDs continue after existing entries
+        entryIDs = MyFLq.makeBulkEntries([('ACGT','TH01','a'),('ACGA','TH01','NA')],chunkSize=1)
+        self.assertEqual(entryIDs,[len(reference['BASEtrack'])+1,len(reference['BASEtrack'])+2])
+        with MyFLq.login.session() as sql:
+            sql.execute("SELECT entryID,getSeq(seqID) AS seq FROM BASEstat WHERE entryID IN (%s,%s)",entryIDs)
+            self.assertEqual(sorted((s['entryID'],s['seq']) for s in sql.fetchall()),
+                             list(zip(entryIDs,('ACGT','ACGA'))))
+
+    def analyze(self,parallelProcessing=False):
+        """Analyzes the test fastq, returns the analysis and the maximum number of read chunks pending"""
+        class PendingExecutor:
+            def __init__(self,executor):
+                self.executor,self.pending,self.maxPending = executor,0,0
+            def submit(self,fn,*args):
+                future = self.executor.submit(fn,*args)
+                if fn is MyFLq.processReadChunk:
+                    self.pending+=1
+                    self.maxPending = max(self.pending,self.maxPending)
+                    result = future.result
+                    def collected(*args,**kwargs):
+                        self.pending-=1
+                        return result(*args,**kwargs)
+                    future.result = collected
+                return future
+            def shutdown(self,*args,**kwargs): self.executor.shutdown(*args,**kwargs)
+        class Analysis(MyFLq.Analysis):
+            chunkSize = 50
+            def setupParallelProcessing(self):
+                super().setupParallelProcessing()
+                self.executor = self.pendingExecutor = PendingExecutor(self.executor)
+        fastq = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_subsample_9947A.fastq.gz')
+        analysis = Analysis(fastq,kitName='default',flankOut=True,parallelProcessing=parallelProcessing,processNow=False)
+        analysis.process()
+        return analysis,(analysis.pendingExecutor.maxPending if parallelProcessing else 0)
+
+    def test_parallelProcessing(self):
+        MyFLq.makeEntries(os.path.join(self.sources,'example_alleles.csv'))
+        MyFLq.processLoci()
+        serial,maxPending = self.analyze()
+        parallel,maxPending = self.analyze(parallelProcessing=2)
+        self.assertTrue(0 < maxPending <= 2*2+1)
+        self.assertTrue(sum(len(locus.uniqueAbundances) for locus in serial.loci.values()))
+        self.assertEqual([(read.seq,read.locus,read.qual) for read in serial.reads],
+                         [(read.seq,read.locus,read.qual) for read in parallel.reads])
+        for locus in serial.loci:
+            self.assertEqual(serial.loci[locus].uniqueAbundances,parallel.loci[locus].uniqueAbundances)
+
+    def test_cache(self):
+        """
+        Processed reads are only cached in, and loaded from, a cacheDir that only the user can access
+        """
+        MyFLq.makeEntries(os.path.join(self.sources,'example_alleles.csv'))
+        MyFLq.processLoci()
+        fastq = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_subsample_9947A.fastq.gz')
+        cacheDir = os.path.join(self.tempdir.name,'cache')
+        analysis = MyFLq.Analysis(fastq,kitName='default',flankOut=True,cacheDir=cacheDir,processNow=False)
+        analysis.process()
+        self.assertEqual(os.stat(cacheDir).st_mode & 0o777,0o700)
+        cacheKey = analysis.getCacheKey()
+        self.assertEqual(os.listdir(cacheDir),[cacheKey+'.pickle'])
+        cached = MyFLq.Analysis(fastq,kitName='default',flankOut=True,cacheDir=cacheDir,processNow=False)
+        self.assertIsNotNone(cached.loadCache(cacheKey))
+        os.chmod(cacheDir,0o755)
+        with self.assertWarns(UserWarning): self.assertIsNone(cached.loadCache(cacheKey))
+        os.remove(os.path.join(cacheDir,cacheKey+'.pickle'))
+        with self.assertWarns(UserWarning): cached.saveCache(cacheKey,MyFLq.ReadBatch())
+        self.assertEqual(os.listdir(cacheDir),[])
+        os.chmod(cacheDir,0o700)
+        link = os.path.join(self.tempdir.name,'link')
+        os.symlink(cacheDir,link)
+        cached.cacheDir = link
+        with self.assertWarns(UserWarning): self.assertFalse(cached.checkCacheDir())
+
+if __name__ == '__main__':
+    unittest.main()